@@ -0,0 +1,630 @@
+"""
+Simple benchmarks for pyparams.
+
+Run with:
+
+    python bench.py
+
+Each benchmark prints the best of several timing runs.
+
+"""
+import getopt
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+
+import pyparams
+from pyparams.sources import DirectorySource, EnvSource, ArgvSource
+from pyparams.codegen import generate
+
+
+def _best(func, number, repeat=5):
+    """
+    Return the best time per call, in microseconds.
+
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) \
+                                                    / number * 1000000.0
+
+
+def _make_conf(num_params):
+    """
+    Create a Conf with 'num_params' string parameters, each with a long
+    option of the form --option-<n>.
+
+    """
+    return pyparams.Conf(
+        default_allow_unset_values = True,
+        param_dict = dict(
+            ("option-%d" % i, { "default"  : "x",
+                                "cmd_line" : ( None, "option-%d" % i ) })
+            for i in range(num_params)))
+
+
+def bench_cmd_line(num_params=1000):
+    """
+    Compare the option parser with getopt for a schema of many long options.
+
+    """
+    conf = _make_conf(num_params)
+    args = [ "--option-%d=val" % i for i in range(0, num_params, 10) ]
+    for i in range(1, num_params, 100):
+        args += [ "--option-%d" % i, "val" ]
+    args.append("positional")
+
+    def with_getopt():
+        long_opts_list = [ p.make_getopts_str()[1]
+                           for p in conf.params.values() ]
+        getopt.getopt(args, "", long_opts_list)
+
+    def with_parser():
+        pyparams._OptionParser(conf.params.values()).parse(args)
+
+    def with_cached_parser():
+        conf.schema._get_option_parser().parse(args)
+
+    print("cmd line, %d options, %d args:" % (num_params, len(args)))
+    print("    getopt:                  %10.1f us" % _best(with_getopt, 20))
+    print("    parser (incl. build):    %10.1f us" % _best(with_parser, 20))
+    print("    parser (prebuilt):       %10.1f us" %
+          _best(with_cached_parser, 20))
+
+
+def bench_yaml(num_params=5000):
+    """
+    Load a large YAML config file with and without the C loader.
+
+    """
+    conf = _make_conf(num_params)
+    fd, fname = tempfile.mkstemp(suffix=".yml")
+    with os.fdopen(fd, "w") as f:
+        for i in range(num_params):
+            f.write("OPTION_%d: value %d\n" % (i, i))
+
+    def load(pure):
+        with open(fname, "r") as f:
+            pyparams._yaml_load_all(f, pure=pure)
+
+    def parse():
+        with open(fname, "r") as f:
+            conf._parse_config_file(f)
+
+    try:
+        print("YAML file, %d parameters (C loader available: %s):" %
+                                    (num_params, pyparams._YAML_C_LOADER))
+        print("    load, pure python:       %10.1f us" %
+              _best(lambda: load(True), 3))
+        if pyparams._YAML_C_LOADER:
+            print("    load, C loader:          %10.1f us" %
+                  _best(lambda: load(False), 3))
+        print("    full parse and apply:    %10.1f us" % _best(parse, 3))
+    finally:
+        os.unlink(fname)
+
+
+def _peak_memory(func):
+    """
+    Return the peak memory allocated while running func, in KiB, or None if
+    tracemalloc is not available.
+
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def bench_json(num_params=100, num_unknown=20000):
+    """
+    Load a large, shared JSON config file, of which only a few keys are
+    parameters of our schema.
+
+    """
+    conf = _make_conf(num_params)
+    conf.default_allow_unknown_params = True
+    fd, fname = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        f.write("{\n")
+        for i in range(num_unknown):
+            f.write('"OTHER_%d" : { "list" : %s, "text" : "%s" },\n' %
+                    (i, json.dumps(list(range(20))), "x" * 200))
+        f.write(",\n".join('"OPTION_%d" : "value"' % i
+                           for i in range(num_params)))
+        f.write("\n}\n")
+
+    def with_json_load():
+        with open(fname, "r") as f:
+            for key, value in json.load(f).items():
+                param = conf.params_by_conffile_name.get(key)
+                if param:
+                    conf.set(param.name, value)
+
+    def incremental():
+        with open(fname, "r") as f:
+            conf._parse_json_format_config_file(f)
+
+    try:
+        print("JSON file, %d parameters, %d unknown keys, %d KiB:" %
+              (num_params, num_unknown, os.path.getsize(fname) // 1024))
+        for name, func in [ ("json.load", with_json_load),
+                            ("incremental", incremental) ]:
+            peak = _peak_memory(func)
+            print("    %-24s %10.1f us   peak memory: %s" %
+                  (name + ":", _best(func, 3),
+                   "%.0f KiB" % peak if peak is not None else "n/a"))
+    finally:
+        os.unlink(fname)
+
+
+def bench_schema(num_params=500, num_confs=1000):
+    """
+    Memory for many Conf objects with a few overrides each, with and without
+    a shared schema, and the speed of get().
+
+    """
+    param_dict = dict(
+            ("option-%d" % i, { "default"        : "a",
+                                "allowed_values" : [ "a", "b", "c" ],
+                                "cmd_line"       : ( None, "option-%d" % i ),
+                                "doc_spec"       : { "text" : "Option." } })
+            for i in range(num_params))
+    schema = pyparams.Schema(param_dict)
+
+    def make_confs(**kwargs):
+        confs = []
+        for i in range(num_confs):
+            conf = pyparams.Conf(**kwargs)
+            for j in range(3):
+                conf.set("option-%d" % ((i + j) % num_params), "b")
+            confs.append(conf)
+        return confs
+
+    print("%d Conf objects, %d parameters, 3 overrides each:" %
+                                                    (num_confs, num_params))
+    for name, kwargs in [ ("own param_dict", dict(param_dict=param_dict)),
+                          ("shared schema",  dict(schema=schema)) ]:
+        peak = _peak_memory(lambda: make_confs(**kwargs))
+        conf = make_confs(**kwargs)[0]
+        print("    %-24s %10.2f us/get   peak memory: %s" %
+              (name + ":", _best(lambda: conf.get("option-1"), 100000),
+               "%.0f KiB" % peak if peak is not None else "n/a"))
+
+
+def bench_validate_cache(num_params=50, num_keys=200):
+    """
+    Repeatedly apply the same large dict and list values, as a reload of an
+    unchanged config file does, with and without conversion cache.
+
+    """
+    values = {}
+    for i in range(num_params):
+        values["dict-%d" % i] = "{ %s }" % " ; ".join(
+                "key%d : a, b, c" % k for k in range(num_keys))
+        values["list-%d" % i] = ",".join("item%d" % k
+                                         for k in range(num_keys))
+
+    print("validate %d dict and %d list params, %d elements each:" %
+                                        (num_params, num_params, num_keys))
+    for name, cache_size in [ ("no cache", None), ("cache", 4) ]:
+        param_dict = {}
+        for pname in values:
+            param_dict[pname] = {
+                "default"    : None,
+                "param_type" : pyparams.PARAM_TYPE_STR_DICT
+                                    if pname.startswith("dict")
+                                    else pyparams.PARAM_TYPE_STR_LIST,
+                "cmd_line"   : None,
+                "cache_size" : cache_size }
+        conf = pyparams.Conf(param_dict)
+
+        def reload():
+            for pname, value in values.items():
+                conf.set(pname, value)
+        print("    %-24s %10.1f us" % (name + ":", _best(reload, 10)))
+
+
+def bench_shared_config(num_params=100, num_lines=10000):
+    """
+    Ingest a shared config file in the default format, in which 90% of the
+    keys are unknown and some of our parameters are ignored.
+
+    """
+    conf = _make_conf(num_params)
+    conf.default_allow_unknown_params = True
+    for i in range(0, num_params, 2):
+        conf.params["option-%d" % i].ignore = True
+    fd, fname = tempfile.mkstemp(suffix=".conf")
+    with os.fdopen(fd, "w") as f:
+        for i in range(num_lines):
+            if i % 10:
+                f.write("OTHER_%d value %d\n" % (i, i))
+            else:
+                f.write("OPTION_%d value\n" % ((i // 10) % num_params))
+
+    def parse():
+        with open(fname, "r") as f:
+            conf._parse_default_format_config_file(f)
+
+    try:
+        print("shared config file, %d lines, 90%% unknown keys:" % num_lines)
+        print("    default format:          %10.1f us" % _best(parse, 10))
+    finally:
+        os.unlink(fname)
+
+
+# Coroutine for the asyncio part of bench_override(). It is compiled at
+# runtime, so that this file can still be run with Python 2.
+_OVERRIDE_TASK_SRC = """
+async def override_task(conf, task_num, num_gets):
+    with conf.override({ "option-1" : "task-%d" % task_num }):
+        with conf.override({ "option-2" : "b" }):
+            with conf.override({ "option-3" : "c" }):
+                await asyncio.sleep(0)
+                for i in range(num_gets):
+                    conf.get("option-1")
+                return conf.get("option-1")
+
+async def run_tasks(conf, num_tasks, num_gets):
+    return await asyncio.gather(*[ override_task(conf, i, num_gets)
+                                   for i in range(num_tasks) ])
+"""
+
+
+def bench_override(num_tasks=1000, num_gets=100):
+    """
+    Cost of get() with and without active override layers, and nested
+    overrides in many concurrent asyncio tasks and threads.
+
+    """
+    conf = _make_conf(100)
+    print("override layers:")
+    print("    get, no overrides:       %10.3f us" %
+          _best(lambda: conf.get("option-1"), 100000))
+    with conf.override({ "option-1" : "a" }):
+        print("    get, 1 layer:            %10.3f us" %
+              _best(lambda: conf.get("option-1"), 100000))
+        with conf.override({ "option-2" : "b" }):
+            with conf.override({ "option-3" : "c" }):
+                print("    get, 3 layers:           %10.3f us" %
+                      _best(lambda: conf.get("option-1"), 100000))
+                print("    get, 3 layers, no hit:   %10.3f us" %
+                      _best(lambda: conf.get("option-50"), 100000))
+
+    def push_pop():
+        with conf.override({ "option-1" : "a" }):
+            pass
+    print("    push and pop a layer:    %10.3f us" % _best(push_pop, 100000))
+
+    def thread_func(task_num):
+        with conf.override({ "option-1" : "task-%d" % task_num }):
+            with conf.override({ "option-2" : "b" }):
+                with conf.override({ "option-3" : "c" }):
+                    for i in range(num_gets):
+                        conf.get("option-1")
+                    assert conf.get("option-1") == "task-%d" % task_num
+
+    def with_threads():
+        threads = [ threading.Thread(target=thread_func, args=(i,))
+                    for i in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    print("    8 threads, 3 layers:     %10.1f us" % _best(with_threads, 10))
+
+    if sys.version_info < (3, 7):
+        return
+    import asyncio
+    namespace = { "asyncio" : asyncio }
+    exec(_OVERRIDE_TASK_SRC, namespace)
+    run_tasks = namespace["run_tasks"]
+
+    def with_asyncio():
+        results = asyncio.run(run_tasks(conf, num_tasks, num_gets))
+        assert results == [ "task-%d" % i for i in range(num_tasks) ]
+    print("    %d asyncio tasks:      %10.1f us" %
+          (num_tasks, _best(with_asyncio, 1)))
+
+
+def bench_sources(num_params=500, num_files=20):
+    """
+    Re-acquire a configuration from a directory of unchanged config files,
+    the environment and the command line, with and without sources.
+
+    """
+    dir_name = tempfile.mkdtemp()
+    for i in range(num_files):
+        with open(os.path.join(dir_name, "%02d.conf" % i), "w") as f:
+            for j in range(i, num_params, num_files):
+                f.write("OPTION_%d value %d\n" % (j, i))
+    conf = _make_conf(num_params)
+    args = [ "--option-%d=val" % i for i in range(0, num_params, 50) ]
+
+    def classic():
+        for name in sorted(os.listdir(dir_name)):
+            conf._process_config_file(os.path.join(dir_name, name), False)
+        conf._process_env_vars()
+        conf._process_cmd_line(args)
+
+    with_sources = _make_conf(num_params)
+    with_sources.sources = [ DirectorySource(dir_name), EnvSource(),
+                             ArgvSource() ]
+
+    try:
+        print("re-acquire, %d parameters, %d unchanged files:" %
+                                                    (num_params, num_files))
+        print("    classic stages:          %10.1f us" % _best(classic, 10))
+        print("    sources:                 %10.1f us" %
+              _best(lambda: with_sources.acquire(args), 10))
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def bench_metrics(num_params=100):
+    """
+    Cost of get() and items() with access metrics disabled and enabled.
+
+    """
+    conf = _make_conf(num_params)
+    print("access metrics:")
+    for name in [ "disabled", "enabled", "sampling every 100" ]:
+        if name == "enabled":
+            conf.enable_metrics()
+        elif name.startswith("sampling"):
+            conf.enable_metrics(sample_every=100)
+        print("    get, %-19s %10.3f us   items: %8.1f us" %
+              (name + ":", _best(lambda: conf.get("option-1"), 100000),
+               _best(conf.items, 1000)))
+
+
+def bench_allowed_values(num_values=50000):
+    """
+    Check values against a large set of allowed values: An inline list, and
+    a file that is loaded into a set or searched in place.
+
+    """
+    values    = [ "id-%08d" % i for i in range(num_values) ]
+    probe     = values[-1]
+    fd, fname = tempfile.mkstemp()
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(values) + "\n")
+
+    def check(param):
+        return lambda: param.validate(probe)
+
+    try:
+        print("allowed values, %d values:" % num_values)
+        param = pyparams._Param("foo", allowed_values=values)
+        print("    inline list:             %10.3f us" %
+              _best(check(param), 100))
+        param = pyparams._Param("foo", allowed_values_file=fname)
+        param.validate(probe)
+        print("    file, frozenset:         %10.3f us" %
+              _best(check(param), 10000))
+        old_threshold = pyparams._VALUES_MMAP_THRESHOLD
+        pyparams._VALUES_MMAP_THRESHOLD = 0
+        try:
+            param = pyparams._Param("foo", allowed_values_file=fname)
+            param.validate(probe)
+        finally:
+            pyparams._VALUES_MMAP_THRESHOLD = old_threshold
+        print("    file, sorted mmap:       %10.3f us" %
+              _best(check(param), 10000))
+    finally:
+        os.unlink(fname)
+
+
+class _NullStream(object):
+    """
+    A stream that discards everything written to it.
+
+    """
+    def write(self, data):
+        pass
+
+
+def bench_write(num_params=100000):
+    """
+    Write a large configuration in each format, compared with building the
+    whole output as one string first.
+
+    """
+    conf = _make_conf(num_params)
+    for i in range(0, num_params, 10):
+        conf.set("option-%d" % i, "value %d" % i)
+    stream = _NullStream()
+
+    def as_string():
+        stream.write("".join([ "%s %s\n" % (p.conffile, conf.get(name))
+                               for name, p in conf.params.items() ]))
+
+    print("write, %d parameters:" % num_params)
+    funcs = [ ("one string", as_string) ] + \
+            [ (fmt, lambda fmt=fmt: conf.write(stream, format=fmt))
+              for fmt in [ pyparams.CONF_FORMAT_DEFAULT,
+                           pyparams.CONF_FORMAT_JSON,
+                           pyparams.CONF_FORMAT_YAML ] ]
+    for name, func in funcs:
+        peak = _peak_memory(func)
+        print("    %-24s %10.1f ms   peak memory: %s" %
+              (name + ":", _best(func, 1, repeat=3) / 1000.0,
+               "%.0f KiB" % peak if peak is not None else "n/a"))
+
+
+def bench_add_many(sizes=( 1000, 5000, 20000 )):
+    """
+    Build schemas of increasing size: The time per parameter should stay
+    the same.
+
+    """
+    print("schema construction:")
+    for num_params in sizes:
+        param_dict = dict(
+            ("option-%d" % i, { "default"  : "x",
+                                "cmd_line" : ( None, "option-%d" % i ) })
+            for i in range(num_params))
+
+        def one_by_one():
+            conf = pyparams.Conf()
+            for name, spec in param_dict.items():
+                conf.add(name, **spec)
+
+        print("    %6d params, add_many:  %8.2f us/param   add: %8.2f us/param"
+              % (num_params,
+                 _best(lambda: pyparams.Conf(param_dict), 1, 3) / num_params,
+                 _best(one_by_one, 1, 3) / num_params))
+
+
+def bench_codegen(num_params=200):
+    """
+    Startup cost of building a Conf and calling acquire(), compared with the
+    load() function of a generated module, with and without executing the
+    (already compiled) module first.
+
+    """
+    types = [ pyparams.PARAM_TYPE_STR, pyparams.PARAM_TYPE_INT,
+              pyparams.PARAM_TYPE_DURATION, pyparams.PARAM_TYPE_STR_LIST ]
+    param_dict = {}
+    for i in range(num_params):
+        ptype = types[i % len(types)]
+        spec  = { "default"  : { pyparams.PARAM_TYPE_STR      : "a",
+                                 pyparams.PARAM_TYPE_INT      : 1,
+                                 pyparams.PARAM_TYPE_DURATION : "30s",
+                                 pyparams.PARAM_TYPE_STR_LIST : "a,b" }[ptype],
+                  "param_type" : ptype,
+                  "cmd_line"   : ( None, "option-%d" % i ) }
+        if ptype == pyparams.PARAM_TYPE_STR:
+            spec["allowed_values"] = [ "a", "b", "c" ]
+        elif ptype == pyparams.PARAM_TYPE_INT:
+            spec["allowed_range"] = { "min" : 0, "max" : 1000 }
+        param_dict["option-%d" % i] = spec
+    args = [ "--option-%d=b" % i for i in range(0, num_params, 20) ] + \
+           [ "positional" ]
+
+    code = compile(generate(pyparams.Conf(param_dict)), "<generated>", "exec")
+    module = {}
+    exec(code, module)
+    load = module["load"]
+
+    def dynamic():
+        pyparams.Conf(param_dict).acquire(args)
+
+    def generated():
+        mod = {}
+        exec(code, mod)
+        mod["load"](args)
+
+    print("startup, %d parameters:" % num_params)
+    for name, func in [ ("Conf() + acquire()", dynamic),
+                        ("generated module + load()", generated),
+                        ("generated load() only", lambda: load(args)) ]:
+        print("    %-28s %10.1f us" % (name + ":", _best(func, 100)))
+
+
+def bench_freeze(num_params=100):
+    """
+    Cost of get() before and after freeze_for_fork().
+
+    """
+    conf = _make_conf(num_params)
+    print("get(), %d parameters:" % num_params)
+    print("    %-24s %10.3f us" % ("plain:",
+                                   _best(lambda: conf.get("option-1"),
+                                         100000)))
+    conf.freeze_for_fork(freeze_gc=False)
+    print("    %-24s %10.3f us" % ("frozen for fork:",
+                                   _best(lambda: conf.get("option-1"),
+                                         100000)))
+
+
+def bench_flags(num_keys=10000):
+    """
+    Evaluations of a feature flag per second, for integer and string keys.
+
+    """
+    conf = pyparams.Conf({ "new-ui" : { "param_type" :
+                                                pyparams.PARAM_TYPE_FLAG } })
+    conf.set("new-ui", "{ percent : 30% ; allow : 1, 2, 3 }")
+    rollout  = conf.get("new-ui")
+    int_keys = list(range(num_keys))
+    str_keys = [ "user-%d" % i for i in int_keys ]
+
+    def run(fn, keys):
+        def loop():
+            for k in keys:
+                fn(k)
+        return num_keys / (_best(loop, 1) / 1000000.0)
+
+    print("Feature flag, %d keys:" % num_keys)
+    for label, fn in [ ( "Conf.enabled()",
+                         lambda k: conf.enabled("new-ui", k) ),
+                       ( "Rollout.enabled()", rollout.enabled ) ]:
+        for kind, keys in [ ( "int", int_keys ), ( "str", str_keys ) ]:
+            print("    %-30s %10.0f /s" % ("%s, %s keys:" % (label, kind),
+                                           run(fn, keys)))
+
+
+def bench_follow(num_params=100, num_records=100000):
+    """
+    Records per second applied by Conf.follow() from a pipe, with and
+    without coalescing, compared to one set() per record.
+
+    """
+    conf  = _make_conf(num_params)
+    lines = [ ("OPTION_%d v%d\n" % (i % num_params, i)).encode("ascii")
+              for i in range(num_records) ]
+    buf   = b"".join(lines)
+
+    def run(**kwargs):
+        r, w   = os.pipe()
+        writer = threading.Thread(target=lambda: (os.write(w, buf),
+                                                  os.close(w)))
+        writer.start()
+        start = timeit.default_timer()
+        num_batches = conf.follow(r, **kwargs)
+        elapsed = timeit.default_timer() - start
+        writer.join()
+        os.close(r)
+        return num_records / elapsed, num_batches
+
+    start = timeit.default_timer()
+    for i in range(num_records):
+        conf.set("option-%d" % (i % num_params), "v%d" % i)
+    print("Feed of %d records, %d parameters:" % (num_records, num_params))
+    print("    %-24s %10.0f /s" % ("set() per record:",
+                                   num_records /
+                                        (timeit.default_timer() - start)))
+    for label, kwargs in [ ( "follow():", {} ),
+                           ( "follow(), coalesce:",
+                             { "backlog" : pyparams.FEED_BACKLOG_COALESCE } ) ]:
+        rate, num_batches = run(**kwargs)
+        print("    %-24s %10.0f /s (%d batches)" % (label, rate, num_batches))
+
+
+if __name__ == "__main__":
+    bench_cmd_line()
+    bench_yaml()
+    bench_json()
+    bench_schema()
+    bench_override()
+    bench_validate_cache()
+    bench_shared_config()
+    bench_sources()
+    bench_metrics()
+    bench_allowed_values()
+    bench_write()
+    bench_add_many()
+    bench_codegen()
+    bench_freeze()
+    bench_flags()
+    bench_follow()
@@ -106,7 +106,7 @@ CONF = Conf(
 CONF.acquire(sys.argv)
 
 # Now you can get specific parameter values:
-print CONF.get("baz")
+print(CONF.get("baz"))
 
 # You can set parameters (their type, permissible values and ranges are
 # checked):
@@ -114,10 +114,10 @@ CONF.set("baz", 199)
 
 # You can get the names of all defined parameters (whether values have been
 # set for them or not):
-print CONF.keys()
+print(CONF.keys())
 
 # You can get a dictionary with name/value for each parameter:
-print CONF.items()
+print(CONF.items())
 
 """
 
@@ -125,11 +125,40 @@ version = (0, 1, 0)
 __version__ = '.'.join(map(str, version))
 
 import os
+import re
+import errno
 import sys
-import getopt
+import mmap
 import textwrap
+import threading
 import json
-from ruamel import yaml as yaml
+import collections
+import gc
+import signal
+import zlib
+
+try:
+    from contextvars import ContextVar as _ContextVar
+except ImportError:
+    _ContextVar = None
+
+from pyparams.metrics import _Instrumented
+
+# YAML config files are supported if ruamel.yaml or PyYAML is installed. The
+# libyaml based C loader is used whenever it is available.
+try:
+    import ruamel.yaml
+    from ruamel.yaml import YAML as _RuamelYAML
+    _yaml           = None
+    _YAML_C_LOADER  = bool(getattr(ruamel.yaml, "__with_libyaml__", False))
+except ImportError:
+    _RuamelYAML = None
+    try:
+        import yaml as _yaml
+        _YAML_C_LOADER = bool(getattr(_yaml, "__with_libyaml__", False))
+    except ImportError:
+        _yaml          = None
+        _YAML_C_LOADER = False
 
 #
 # Define all the configuration variables, which can be specified on the command
@@ -141,11 +170,37 @@ PARAM_TYPE_INT          = "integer"
 PARAM_TYPE_BOOL         = "bool"
 PARAM_TYPE_STR_LIST     = "str-list"
 PARAM_TYPE_STR_DICT     = "str-dict"
-_PARAM_TYPES_ALLOWED    = [ PARAM_TYPE_STR, PARAM_TYPE_INT, PARAM_TYPE_BOOL,
-                            PARAM_TYPE_STR_LIST, PARAM_TYPE_STR_DICT ]
+PARAM_TYPE_FLOAT        = "float"
+PARAM_TYPE_DURATION     = "duration"
+PARAM_TYPE_BYTES        = "bytes"
+PARAM_TYPE_FLAG         = "flag"
 
 __NOT_DEFINED__         = "__NOT_DEFINED__"
 
+# Marks conffile names that are not in a key table, see Conf._make_key_table().
+_UNKNOWN                = object()
+
+# How config files are looked up in the config file locations: Use only the
+# first one that exists, or process all that exist, in order.
+CONF_FILE_FIRST_MATCH   = "first-match"
+CONF_FILE_MERGE_ALL     = "merge-all"
+
+# Output formats of Conf.write(), the first two are also the record formats
+# of Conf.follow().
+CONF_FORMAT_DEFAULT     = "default"
+CONF_FORMAT_JSON        = "json"
+CONF_FORMAT_YAML        = "yaml"
+
+# What Conf.follow() does with malformed records and invalid values.
+FEED_ERROR_RAISE        = "raise"
+FEED_ERROR_SKIP_RECORD  = "skip-record"
+FEED_ERROR_SKIP_BATCH   = "skip-batch"
+
+# How Conf.follow() deals with records that arrive faster than they are
+# applied.
+FEED_BACKLOG_BLOCK      = "block"
+FEED_BACKLOG_COALESCE   = "coalesce"
+
 # Use this as default value, if you want to allow a value-parameter to be
 # purely optional, without any default value.
 IGNORE_IF_NOT_SPECIFIED = "__IGNORE_IF_NOT_SPECIFIED__"
@@ -159,6 +214,109 @@ def _int_check(val, param_obj=None):
     return int(val)
 
 
+def _float_check(val, param_obj=None):
+    """
+    Return a converted float.
+
+    """
+    return float(val)
+
+
+# Units for durations, in seconds, largest first.
+_DURATION_UNITS      = [ ( "w",  7*24*3600 ), ( "d", 24*3600 ),
+                         ( "h",  3600 ), ( "m", 60 ), ( "s", 1 ),
+                         ( "ms", 0.001 ), ( "us", 0.000001 ) ]
+_DURATION_UNITS_DICT = dict(_DURATION_UNITS)
+_DURATION_RE         = re.compile(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*'
+                                  r'(us|ms|s|m|h|d|w)?\s*')
+
+# Units for byte sizes, largest first, so that the output of _format_bytes()
+# is as short as possible.
+_BYTES_UNITS = [ ( "EiB", 1024**6 ), ( "PiB", 1024**5 ), ( "TiB", 1024**4 ),
+                 ( "GiB", 1024**3 ), ( "MiB", 1024**2 ), ( "KiB", 1024 ),
+                 ( "EB",  1000**6 ), ( "PB",  1000**5 ), ( "TB",  1000**4 ),
+                 ( "GB",  1000**3 ), ( "MB",  1000**2 ), ( "kB",  1000 ) ]
+_BYTES_RE    = re.compile(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*'
+                          r'(?:([kKMGTPE])(i?))?B?\s*$')
+
+
+def _duration_check(val, param_obj=None):
+    """
+    Return a duration as a number of seconds (float).
+
+    Acceptable format:
+
+        * 30, 1.5                -> seconds
+        * "30s", "100ms", "1.5h" -> with a unit: us, ms, s, m, h, d or w
+        * "1h 30m"               -> several components are added up
+
+    """
+    if type(val) in [ int, float ]:
+        return float(val)
+    pos   = 0
+    total = 0.0
+    while pos < len(val):
+        m = _DURATION_RE.match(val, pos)
+        # Only the last component may be without unit
+        if not m or (not m.group(2) and m.end() != len(val)):
+            raise ParamError(str(val), "Malformed duration.")
+        total += float(m.group(1)) * _DURATION_UNITS_DICT[m.group(2) or "s"]
+        pos = m.end()
+    if not pos:
+        raise ParamError(str(val), "Malformed duration.")
+    return total
+
+
+def _bytes_check(val, param_obj=None):
+    """
+    Return a size in bytes (integer).
+
+    Acceptable format:
+
+        * 1024, "1024", "1024B"  -> bytes, which must be a whole number
+        * "10kB", "1.5GB"        -> SI units (powers of 1000)
+        * "512MiB", "4Ki"        -> IEC units (powers of 1024)
+
+    """
+    if type(val) is int:
+        return val
+    m = _BYTES_RE.match(val)
+    if not m:
+        raise ParamError(str(val), "Malformed size.")
+    num, prefix, binary = m.groups()
+    if not prefix and not float(num).is_integer():
+        # There is no such thing as a fraction of a byte
+        raise ParamError(str(val), "Malformed size.")
+    mult = 1
+    if prefix:
+        mult = (1024 if binary else 1000) ** \
+                                        ("KMGTPE".index(prefix.upper()) + 1)
+    return int(round(float(num) * mult))
+
+
+def _format_duration(val):
+    """
+    Return a duration (in seconds) in its shortest form with a unit.
+
+    """
+    for unit, secs in _DURATION_UNITS:
+        n = round(val / secs)
+        if n and abs(val / secs - n) < 1e-9:
+            return "%d%s" % (n, unit)
+    return "%gs" % val
+
+
+def _format_bytes(val):
+    """
+    Return a size (in bytes) in its shortest form with a unit.
+
+    """
+    for unit, size in _BYTES_UNITS:
+        if val and val % size == 0:
+            return "%d%s" % (val // size, unit)
+    return "%dB" % val
+
+
 def _str_check(val, param_obj=None):
     """
     Return a string object.
@@ -277,6 +435,202 @@ def _str_dict_check(val, param_obj=None):
         raise ParamError(str(val), "Malformed dict format.")
 
 
+_text_type = type(u"")
+
+
+class Rollout(object):
+    """
+    The value of a feature flag (PARAM_TYPE_FLAG).
+
+    The flag is enabled for 'percent' percent of all keys (such as user IDs)
+    and always for the keys in 'allow'. Whether a key is in the percentage
+    depends on a stable hash of the key and the 'salt': The same key gets
+    the same answer in every process, a larger percentage only adds keys,
+    and flags with different salts select independent sets of keys.
+
+    """
+    __slots__ = ( "percent", "allow", "salt", "_keys", "_seed",
+                  "_threshold" )
+
+    def __init__(self, percent, allow=(), salt=""):
+        self.percent    = percent
+        self.allow      = tuple(allow)
+        self.salt       = salt
+        # The allowed keys are looked up as they are given: As strings, as
+        # bytes and, if they are decimal numbers, as integers.
+        keys = set(self.allow)
+        for k in self.allow:
+            keys.add(k.encode("utf-8"))
+            if k.isdigit():
+                keys.add(int(k))
+        self._keys      = frozenset(keys)
+        self._seed      = zlib.crc32(salt.encode("utf-8"))
+        self._threshold = int(round(percent * 2**32 / 100.0))
+
+    def enabled(self, key):
+        """
+        Return True if the flag is enabled for the key.
+
+        Keys are strings, bytes or integers. Integers and strings are hashed
+        in their UTF-8 encoding, so 42 and "42" are the same key.
+
+        """
+        if key in self._keys:
+            return True
+        if type(key) is _text_type:
+            key = key.encode("utf-8")
+        elif type(key) is not bytes:
+            key = str(key).encode("utf-8")
+        # CRC-32 alone is linear: The sets selected with different salts
+        # would be strongly correlated. A multiplication mixes the bits.
+        return (zlib.crc32(key, self._seed) * 0x9E3779B1) & 0xffffffff < \
+                                                            self._threshold
+
+    def __eq__(self, other):
+        return isinstance(other, Rollout) and \
+               (self.percent, self.allow, self.salt) == \
+                                    (other.percent, other.allow, other.salt)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.percent, self.allow, self.salt))
+
+    def __repr__(self):
+        return "Rollout(percent=%r, allow=%r, salt=%r)" % \
+                                        (self.percent, self.allow, self.salt)
+
+
+# The words that turn a feature flag on or off.
+_FLAG_WORDS = { "on" : 100, "yes" : 100, "true" : 100,
+                "off" : 0,  "no"  : 0,   "false" : 0 }
+
+
+def _flag_check(val, param_obj=None):
+    """
+    Return a Rollout for a feature flag.
+
+    Acceptable format:
+
+        * True, "on", "yes", "true" -> enabled for all keys, False, "off",
+                                       "no", "false" for none
+        * 5, "5%", "2.5", "1"       -> enabled for that percentage of keys
+        * "{ percent:5% ; allow:alice,bob ; salt:exp-1 }"
+                                    -> and always for the listed keys, the
+                                       salt selects another set of keys
+        * a dictionary with the same keys, for example from a JSON file
+
+    """
+    if isinstance(val, Rollout):
+        return val
+    if type(val) is bool:
+        spec = { "percent" : 100 if val else 0 }
+    elif type(val) in [ int, float ]:
+        spec = { "percent" : val }
+    elif type(val) is dict:
+        spec = val
+    else:
+        val = val.strip()
+        if val.startswith("{"):
+            spec = _str_dict_check(val)
+        elif val.lower() in _FLAG_WORDS:
+            spec = { "percent" : _FLAG_WORDS[val.lower()] }
+        else:
+            # Numbers are percentages, also "1" and "0", so that a value
+            # means the same in a JSON file and on the command line.
+            spec = { "percent" : val }
+
+    unknown = set(spec) - set([ "percent", "allow", "salt" ])
+    if unknown:
+        raise ParamError(str(val), "Unknown rollout key '%s'." %
+                                                        sorted(unknown)[0])
+    percent = spec.get("percent", 0)
+    if type(percent) not in [ int, float ]:
+        percent = str(percent).strip()
+        if percent.endswith("%"):
+            percent = percent[:-1]
+    allow = spec.get("allow") or []
+    if type(allow) is not list:
+        allow = _str_list_check(str(allow))
+    return Rollout(float(percent), sorted([ str(k).strip() for k in allow ]),
+                   str(spec.get("salt") or ""))
+
+
+def _flag_validate(value, param_obj):
+    """
+    Check the percentage of a feature flag.
+
+    """
+    if not 0 <= value.percent <= 100:
+        raise ParamError(param_obj.name,
+                         "Rollout percentage %s is not between 0 and 100." %
+                                                    _format_percent(value))
+
+
+def _format_percent(value):
+    return "%s%%" % ("%.15g" % value.percent)
+
+
+def _format_flag(value):
+    """
+    Return a feature flag in its shortest form.
+
+    """
+    if not value.allow and not value.salt:
+        return _format_percent(value)
+    elems = [ "percent : %s" % _format_percent(value) ]
+    if value.allow:
+        elems.append("allow : %s" % ",".join(value.allow))
+    if value.salt:
+        elems.append("salt : %s" % value.salt)
+    return "{ %s }" % " ; ".join(elems)
+
+
+# Snapshots of the values, as published by pyparams.daemon and
+# pyparams.shared, are JSON encoded. Feature flags are encoded as objects
+# with this single key, and turned back into Rollout values when decoded.
+_ROLLOUT_KEY = "__rollout__"
+
+
+def _snapshot_default(value):
+    """
+    Encode a value that JSON has no type for, see _dump_snapshot().
+
+    """
+    if isinstance(value, Rollout):
+        return { _ROLLOUT_KEY : { "percent" : value.percent,
+                                  "allow"   : value.allow,
+                                  "salt"    : value.salt } }
+    raise TypeError("Object of type %s is not JSON serializable" %
+                                                        type(value).__name__)
+
+
+def _snapshot_object(obj):
+    if len(obj) == 1 and _ROLLOUT_KEY in obj:
+        return _flag_check(obj[_ROLLOUT_KEY])
+    return obj
+
+
+def _dump_snapshot(values):
+    """
+    Return a dictionary of parameter values as JSON encoded bytes.
+
+    Raises TypeError or ValueError if a value cannot be encoded.
+
+    """
+    return json.dumps(values, sort_keys=True,
+                      default=_snapshot_default).encode("utf-8")
+
+
+def _load_snapshot(data):
+    """
+    Return the dictionary of parameter values encoded by _dump_snapshot().
+
+    """
+    return json.loads(data.decode("utf-8"), object_hook=_snapshot_object)
+
+
 class ParamError(Exception):
     """
     Custom exception for the config module.
@@ -291,6 +645,56 @@ class ParamError(Exception):
         else:
             msg = "Parameter '%s': %s" % (name, msg)
         super(ParamError, self).__init__(msg)
+        # Python 3 exceptions don't have a 'message' attribute anymore.
+        self.message = msg
+
+def _yaml_load_all(stream, pure=False):
+    """
+    Return a list with all the documents in a YAML stream.
+
+    Uses the libyaml based C loader, if available and 'pure' is not set.
+
+    """
+    use_c = _YAML_C_LOADER and not pure
+    if _RuamelYAML is not None:
+        return list(_RuamelYAML(typ="safe", pure=not use_c).load_all(stream))
+    if _yaml is not None:
+        loader = _yaml.CSafeLoader if use_c else _yaml.SafeLoader
+        return list(_yaml.load_all(stream, Loader=loader))
+    raise FileFormatException("No YAML module installed.")
+
+
+def _yaml_key_lines(text):
+    """
+    Return a list with a dictionary for each document in a YAML stream, which
+    maps the keys of a mapping document to their line numbers.
+
+    The stream is composed again by the pure Python loader, so this is only
+    used to report errors.
+
+    """
+    if _RuamelYAML is not None:
+        constructor, _ = _RuamelYAML(typ="safe",
+                                     pure=True).get_constructor_parser(text)
+        composer       = constructor.composer
+    else:
+        constructor = composer = _yaml.SafeLoader(text)
+    construct = constructor.construct_object
+    result    = []
+    while composer.check_node():
+        node  = composer.get_node()
+        lines = {}
+        if node.id == "mapping":
+            for key_node, _ in node.value:
+                try:
+                    lines[construct(key_node, deep=True)] = \
+                                                key_node.start_mark.line + 1
+                except TypeError:
+                    # Unhashable key, the document won't be applied anyway
+                    pass
+        result.append(lines)
+    return result
+
 
 class FileFormatException(Exception):
     def __init__(self,*args,**kwargs):
@@ -300,6 +704,416 @@ class ParamIgnored(ParamError):
     pass
 
 
+#
+# Helpers for scanning a JSON document without decoding it. They operate on
+# bytes or on an mmap object.
+#
+_JSON_WS_RE      = re.compile(br'[ \t\n\r]*')
+_JSON_STRING_RE  = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_JSON_SCALAR_RE  = re.compile(br'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?'
+                              br'(?:[eE][-+]?[0-9]+)?|true|false|null')
+_JSON_NESTING_RE = re.compile(br'["\[\]{}]')
+_JSON_KEY_RE     = re.compile(br'[ \t\n\r]*("[^"\\]*(?:\\.[^"\\]*)*")'
+                              br'[ \t\n\r]*:[ \t\n\r]*', re.DOTALL)
+_JSON_SEP_RE     = re.compile(br'[ \t\n\r]*([,}])')
+
+_json_decoder    = json.JSONDecoder()
+
+
+def _json_skip_ws(buf, pos):
+    return _JSON_WS_RE.match(buf, pos).end()
+
+
+def _json_skip_value(buf, pos):
+    """
+    Return the position behind the JSON value that starts at 'pos'.
+
+    Strings and scalars are matched completely. Objects and arrays are only
+    scanned for their closing bracket, nothing inside is decoded.
+
+    """
+    c = buf[pos:pos+1]
+    if c == b'"':
+        m = _JSON_STRING_RE.match(buf, pos)
+        if m is None:
+            raise FileFormatException("Unterminated string.")
+        return m.end()
+    if c not in (b'{', b'['):
+        m = _JSON_SCALAR_RE.match(buf, pos)
+        if m is None:
+            raise FileFormatException("Expected a value.")
+        return m.end()
+    depth = 1
+    pos  += 1
+    while depth:
+        m = _JSON_NESTING_RE.search(buf, pos)
+        if m is None:
+            raise FileFormatException("Unterminated object or array.")
+        c = m.group()
+        if c == b'"':
+            m = _JSON_STRING_RE.match(buf, m.start())
+            if m is None:
+                raise FileFormatException("Unterminated string.")
+        elif c in (b'{', b'['):
+            depth += 1
+        else:
+            depth -= 1
+        pos = m.end()
+    return pos
+
+
+def _json_decode(buf, start, end):
+    """
+    Decode the JSON value between 'start' and 'end'.
+
+    """
+    try:
+        return _json_decoder.raw_decode(buf[start:end].decode("utf-8"))[0]
+    except ValueError as e:
+        raise FileFormatException(str(e))
+
+
+def _line_of(buf, pos):
+    """
+    Return the line number of the position 'pos' in the buffer.
+
+    """
+    line  = 1
+    start = buf.find(b"\n", 0, pos)
+    while start != -1:
+        line += 1
+        start = buf.find(b"\n", start+1, pos)
+    return line
+
+
+# Statistics of the conversion cache of a parameter, see _Param.cache_info().
+CacheInfo = collections.namedtuple("CacheInfo",
+                                   [ "hits", "misses", "maxsize", "currsize" ])
+
+
+# Files of allowed values up to this size are loaded into a frozenset. Larger
+# ones are searched in place, if they are sorted, see _ValueIndex.
+_VALUES_MMAP_THRESHOLD = 4*1024*1024
+
+
+class _ValueIndex(object):
+    """
+    The set of allowed values of a parameter, listed in a file.
+
+    The file contains one value per line. Empty lines are ignored, and lines
+    may end with LF or CRLF. The file is loaded on the first lookup.
+    Small files, and files for parameters that are not strings, are converted
+    into a frozenset. Large files of string values are memory-mapped and
+    searched with a binary search, which needs them to be sorted by byte value
+    (as with 'LC_ALL=C sort') and to contain no empty lines. Other large files
+    are loaded into a frozenset instead.
+
+    """
+    def __init__(self, path, param):
+        self.path   = path
+        self.param  = param
+        self.count  = None
+        self._set   = None
+        self._mm    = None
+
+    def _load(self):
+        try:
+            f = open(self.path, "rb")
+        except IOError as e:
+            raise ParamError(self.param.name,
+                             "Cannot read allowed values file '%s': %s" %
+                                                    (self.path, e.strerror))
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= _VALUES_MMAP_THRESHOLD and \
+                    self.param.param_type == PARAM_TYPE_STR:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    count = self._check_sorted(mm)
+                except:
+                    mm.close()
+                    raise
+                if count is not None:
+                    self._mm   = mm
+                    self.count = count
+                    return
+                mm.close()
+                f.seek(0)
+            values = [ v.rstrip(b"\r").decode("utf-8")
+                       for v in f.read().split(b"\n") ]
+        values = [ v for v in values if v ]
+        self._set  = frozenset(self.param.param_type_check_batch(values))
+        self.count = len(self._set)
+
+    @staticmethod
+    def _check_sorted(mm):
+        """
+        Return the number of values in the mapped file, or None if the file
+        is not sorted or contains empty lines.
+
+        """
+        count = 0
+        prev  = b""
+        for line in iter(mm.readline, b""):
+            line = line.rstrip(b"\r\n")
+            if not line or line < prev:
+                return None
+            prev   = line
+            count += 1
+        return count
+
+    def close(self):
+        """
+        Unmap the file. It is loaded again by the next lookup.
+
+        """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._set  = None
+        self.count = None
+
+    def __contains__(self, value):
+        if self.count is None:
+            self._load()
+        if self._set is not None:
+            try:
+                return value in self._set
+            except TypeError:
+                return False
+        try:
+            key = value.encode("utf-8")
+        except AttributeError:
+            return False
+        if not key:
+            # The file has no empty lines.
+            return False
+        mm     = self._mm
+        lo, hi = 0, len(mm)
+        while lo < hi:
+            mid   = (lo + hi) // 2
+            start = mm.rfind(b"\n", 0, mid) + 1
+            end   = mm.find(b"\n", start)
+            if end == -1:
+                end = len(mm)
+            line = mm[start:end]
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if line == key:
+                return True
+            if line < key:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+    def __len__(self):
+        if self.count is None:
+            self._load()
+        return self.count
+
+
+def _resolve_config_file(fname, locations, merge_all=False):
+    """
+    Look for the config file 'fname' in the config file locations.
+
+    Each location is a prefix for the file name. Every candidate is checked
+    with a single stat() call, stopping at the first one that exists, unless
+    'merge_all' is set.
+
+    Returns a tuple with the list of existing files and the list of all paths
+    that were tried.
+
+    """
+    found = []
+    tried = []
+    for prefix in locations:
+        path = os.path.expanduser(prefix+fname)
+        tried.append(path)
+        try:
+            os.stat(path)
+        except OSError as e:
+            if e.errno in [ errno.ENOENT, errno.ENOTDIR ]:
+                # Not having a config file in a location is allowed.
+                continue
+            raise ParamError(fname, "Error processing config file: %s" %
+                                                                e.strerror)
+        found.append(path)
+        if not merge_all:
+            break
+    return found, tried
+
+
+class ParamType(object):
+    """
+    A parameter type, which can be used as 'param_type' in parameter
+    definitions once it is registered with register_param_type().
+
+    Values are converted (and may be parsed into some efficient
+    representation) once, when they are set. Reading them is then just a
+    lookup.
+
+    """
+    def __init__(self, name, convert, convert_batch=None, validate=None,
+                 doc=None, takes_arg=True, is_list=False,
+                 allows_values=True):
+        """
+        Define a parameter type.
+
+        - name:           The name of the type.
+        - convert:        A function (value, param), which returns the
+                          converted value. It may raise any exception if the
+                          value cannot be converted.
+        - convert_batch:  Optional function (values, param), which converts a
+                          list of values in one go: The allowed values of a
+                          parameter and, for list types, the elements of a
+                          value that is already a list (as read from YAML or
+                          JSON config files). By default, convert is called
+                          for each allowed value, and list values are passed
+                          to convert as a whole.
+        - validate:       Optional function (value, param), which is called
+                          with the converted value, after allowed values and
+                          range have been checked. It raises ParamError if
+                          the value is not acceptable.
+        - doc:            Optional function (value), which returns a
+                          converted value as string, in the form in which it
+                          would be specified. Used for messages and for the
+                          documentation. By default, str() is used.
+        - takes_arg:      If not set, a command line option of this type
+                          does not take an argument: Its presence sets the
+                          value to True.
+        - is_list:        Set if converted values are lists. Allowed values
+                          and range then apply to each element.
+        - allows_values:  If not set, no allowed values or range can be
+                          defined for parameters of this type.
+
+        """
+        self.name           = name
+        self.convert        = convert
+        self.convert_batch  = convert_batch
+        self.validate       = validate
+        self.doc            = doc or str
+        self.takes_arg      = takes_arg
+        self.is_list        = is_list
+        self.allows_values  = allows_values
+
+
+_param_types = {}
+
+def register_param_type(param_type, replace=False):
+    """
+    Register a ParamType, so that it can be used in parameter definitions.
+
+    A type of the same name can only be registered again with 'replace'.
+
+    """
+    if param_type.name in _param_types and not replace:
+        raise ParamError("-Parameter type %s" % param_type.name,
+                         "Already registered.")
+    _param_types[param_type.name] = param_type
+
+
+def get_param_type(name):
+    """
+    Return the registered ParamType of that name.
+
+    """
+    try:
+        return _param_types[name]
+    except KeyError:
+        raise ParamError("-Parameter type %s" % name, "Not registered.")
+
+
+def _str_list_batch(values, param_obj=None):
+    """
+    Convert the allowed values of a list parameter.
+
+    _str_list_check() would just return a list even for a simple string like
+    "foo". Here, we just want to check that each specified value can be
+    converted to a string.
+
+    """
+    return [ str(v) for v in values ]
+
+
+def _str_dict_validate(value, param_obj):
+    """
+    Check the keys of a dictionary against the allowed and mandatory keys.
+
+    """
+    if param_obj.allowed_keys:
+        for k in value.keys():
+            if k not in param_obj.allowed_keys:
+                raise ParamError(param_obj.name,
+                         "'%s' is not an allowable key value." % k)
+    if param_obj.mandatory_keys:
+        for k in param_obj.mandatory_keys:
+            if k not in value.keys():
+                raise ParamError(param_obj.name,
+                         "Mandatory key '%s' not present." % k)
+
+
+for _t in [ ParamType(PARAM_TYPE_STR,      _str_check),
+            ParamType(PARAM_TYPE_INT,      _int_check),
+            ParamType(PARAM_TYPE_BOOL,     _bool_check,
+                      takes_arg=False, allows_values=False),
+            ParamType(PARAM_TYPE_STR_LIST, _str_list_check,
+                      convert_batch=_str_list_batch, is_list=True),
+            ParamType(PARAM_TYPE_STR_DICT, _str_dict_check,
+                      validate=_str_dict_validate),
+            ParamType(PARAM_TYPE_FLOAT,    _float_check),
+            ParamType(PARAM_TYPE_DURATION, _duration_check,
+                      doc=_format_duration),
+            ParamType(PARAM_TYPE_BYTES,    _bytes_check,
+                      doc=_format_bytes),
+            ParamType(PARAM_TYPE_FLAG,     _flag_check,
+                      validate=_flag_validate, doc=_format_flag,
+                      allows_values=False) ]:
+    register_param_type(_t)
+del _t
+
+
+class _FrozenList(tuple):
+    """
+    A list, as stored in the conversion cache.
+
+    """
+
+class _FrozenDict(tuple):
+    """
+    A dictionary, as stored in the conversion cache: A tuple of the items.
+
+    """
+
+def _freeze(value):
+    """
+    Return an immutable version of a converted value, for the cache.
+
+    Converted values are at most dictionaries of lists, so only those two
+    levels are frozen.
+
+    """
+    if isinstance(value, list):
+        return _FrozenList(value)
+    if isinstance(value, dict):
+        return _FrozenDict([ (k, _FrozenList(v) if isinstance(v, list) else v)
+                             for k, v in value.items() ])
+    return value
+
+def _thaw(value):
+    """
+    Return a new mutable copy of a value frozen by _freeze().
+
+    """
+    t = type(value)
+    if t is _FrozenList:
+        return list(value)
+    if t is _FrozenDict:
+        return dict([ (k, list(v) if type(v) is _FrozenList else v)
+                      for k, v in value ])
+    return value
+
+
 class _Param(object):
     """
     Information for a single parameter.
@@ -308,20 +1122,18 @@ class _Param(object):
     should be created and modified through the Conf object.
 
     """
-    PARAM_TYPE_CHECK_FUNCS = {
-        PARAM_TYPE_STR      : _str_check,
-        PARAM_TYPE_INT      : _int_check,
-        PARAM_TYPE_BOOL     : _bool_check,
-        PARAM_TYPE_STR_LIST : _str_list_check,
-        PARAM_TYPE_STR_DICT : _str_dict_check
-    }
+    # Attributes that can be changed without invalidating the conversion
+    # cache.
+    _CACHE_ATTRS = frozenset([ "value", "_cache", "_cache_lock",
+                               "_cache_hits", "_cache_misses",
+                               "_value_index" ])
 
     def __init__(self, name, default=None, allowed_values=None,
                  allowed_range=None, allowed_keys=None, mandatory_keys=None,
                  default_key=None,
                  param_type=PARAM_TYPE_STR,
                  conffile=None, cmd_line=None, ignore=False,
-                 doc_spec=None):
+                 doc_spec=None, cache_size=None, allowed_values_file=None):
         """
         Configuration for a given parameter.
 
@@ -353,8 +1165,16 @@ class _Param(object):
                             value is required.
         - param_type:       Indicate the type of the parameter. This module
                             defines the possible types in PARAM_TYPE_STR,
-                            PARAM_TYPE_INT and PARAM_TYPE_BOOL. It will be
-                            string by default.
+                            PARAM_TYPE_INT, PARAM_TYPE_BOOL,
+                            PARAM_TYPE_STR_LIST, PARAM_TYPE_STR_DICT,
+                            PARAM_TYPE_FLOAT, PARAM_TYPE_DURATION (such as
+                            "30s" or "1h 30m", stored as seconds),
+                            PARAM_TYPE_BYTES (such as "10kB" or "512MiB",
+                            stored as integer) and PARAM_TYPE_FLAG (a feature
+                            flag, such as "5%", stored as Rollout). It will
+                            be string by default.
+                            Other types can be added with
+                            register_param_type().
         - conffile:         The name that this parameter should have in the
                             configuration file. If omitted, this name is
                             constructed automatically by capitalizing the
@@ -384,22 +1204,50 @@ class _Param(object):
                             so that man-page suitable output can be generated
                             automatically. This value is a dictionary with the
                             three keys 'text', 'section' and 'argname'.
+        - cache_size:       If set, the results of validate() are kept in an
+                            LRU cache of this many entries, keyed by the raw
+                            (hashable) input value. Useful for lists and
+                            dictionaries, which are given as strings and
+                            would otherwise be split again on every reload.
+                            The cache is cleared whenever an attribute of the
+                            parameter definition is assigned. Changes made in
+                            place, such as allowed_keys.append(), are not
+                            noticed: Call cache_clear() after those.
+        - allowed_values_file:
+                            The name of a file that lists the permissible
+                            values, one per line. Use this instead of
+                            allowed_values for large sets of values. The file
+                            is read when the default value is checked, or, if
+                            there is no default, when the first value is
+                            checked. See _ValueIndex for details.
 
         """
+        # Set up the cache first, since validate() is used further down.
+        self.cache_size  = cache_size
+        self._cache      = collections.OrderedDict() if cache_size else None
+        self._cache_lock = threading.Lock()
+        self._cache_hits = self._cache_misses = 0
+
+        # Set together with allowed_values_file, see __setattr__().
+        self._value_index = None
+
         self.name        = name
         self.conffile    = conffile
         self.ignore      = ignore
         self.doc_spec    = doc_spec
 
-        if param_type not in _PARAM_TYPES_ALLOWED:
+        if param_type not in _param_types:
             raise ParamError(name, "Unknown parameter type '%s'." % param_type)
         self.param_type = param_type
+        self.ptype      = _param_types[param_type]
 
         # Special checking
-        if param_type == PARAM_TYPE_BOOL:
-            if allowed_values or allowed_range:
+        if not self.ptype.allows_values:
+            if allowed_values or allowed_range or allowed_values_file:
                 raise ParamError(name,
-                         "Allowed values or range not allowed for boolean.")
+                         "Allowed values or range not allowed for %s." %
+                            ("boolean" if param_type == PARAM_TYPE_BOOL
+                                       else "type '%s'" % param_type))
 
         if (allowed_keys or mandatory_keys or default_key) and \
                 param_type != PARAM_TYPE_STR_DICT:
@@ -434,18 +1282,13 @@ class _Param(object):
         self.mandatory_keys = mandatory_keys
         self.default_key    = default_key
 
+        if allowed_values and allowed_values_file:
+            raise ParamError(name, "Only one of allowed values and allowed "
+                                   "values file can be specified.")
+
         # Type check all values in 'allowed-values' list
         if allowed_values:
-            if param_type == PARAM_TYPE_STR_LIST:
-                # Special casing the string list, since the type-conversion
-                # function we use is very aggressive and would just return a
-                # list even for a simple string like "foo". We don't want this
-                # here, we just want to check that each specified value can be
-                # converted to a string.
-                self.allowed_values = [ str(a) for a in allowed_values ]
-            else:
-                self.allowed_values = [ self.param_type_check(a)
-                                        for a in allowed_values ]
+            self.allowed_values = self.param_type_check_batch(allowed_values)
         else:
             self.allowed_values = None
 
@@ -456,15 +1299,20 @@ class _Param(object):
                 raise ParamError(name,
                                  "Malformed dictionary for 'allowed_range'.")
             # The min or max in an allowed range can be None, indicating no
-            # upper or lower bound.
-            if allowed_range['min'] is not None:
-                self.param_type_check(allowed_range['min'])
-            if allowed_range['max'] is not None:
-                self.param_type_check(allowed_range['max'])
+            # upper or lower bound. Except for lists, the range is stored
+            # converted, so that for example "1m" and 60 are comparable.
+            allowed_range = dict(allowed_range)
+            for k in [ 'min', 'max' ]:
+                if allowed_range[k] is not None:
+                    v = self.param_type_check(allowed_range[k])
+                    if not self.ptype.is_list:
+                        allowed_range[k] = v
             self.allowed_range = allowed_range
         else:
             self.allowed_range = None
 
+        self.allowed_values_file = allowed_values_file
+
         # Type check the default value
         if default is not None:
             self.default  = self.param_type_check(default)
@@ -479,6 +1327,35 @@ class _Param(object):
 
         self.cmd_line = cmd_line
 
+    def __setattr__(self, name, value):
+        # Any change to the definition may change the outcome of validate().
+        if name not in self._CACHE_ATTRS and self.__dict__.get("_cache"):
+            self.cache_clear()
+        if name == "allowed_values_file":
+            if self._value_index is not None:
+                self._value_index.close()
+            self._value_index = _ValueIndex(value, self) if value else None
+        object.__setattr__(self, name, value)
+
+    def cache_info(self):
+        """
+        Return hits, misses, maximum and current size of the conversion cache.
+
+        """
+        return CacheInfo(self._cache_hits, self._cache_misses,
+                         self.cache_size,
+                         len(self._cache) if self._cache is not None else 0)
+
+    def cache_clear(self):
+        """
+        Drop all cached conversion results and reset the statistics.
+
+        """
+        with self._cache_lock:
+            if self._cache is not None:
+                self._cache = collections.OrderedDict()
+            self._cache_hits = self._cache_misses = 0
+
     def param_type_check(self, value):
         """
         Convert the value to the specified type, raise exception if not
@@ -486,9 +1363,12 @@ class _Param(object):
 
         """
         if value not in [ None, IGNORE_IF_NOT_SPECIFIED ]:
+            if type(value) is list and self.ptype.is_list and \
+                                    self.ptype.convert_batch is not None:
+                # The elements of a list value are converted in one go.
+                return self.param_type_check_batch(value)
             try:
-                return self.PARAM_TYPE_CHECK_FUNCS[self.param_type](
-                    value, self)
+                return self.ptype.convert(value, self)
             except:
                 raise ParamError(self.name,
                                  "Cannot convert '%s' to type '%s'." % \
@@ -496,25 +1376,81 @@ class _Param(object):
         else:
             return value
 
+    def param_type_check_batch(self, values):
+        """
+        Convert a list of values, using the batch converter of the type, if
+        it has one.
+
+        """
+        if self.ptype.convert_batch is None:
+            return [ self.param_type_check(v) for v in values ]
+        try:
+            return self.ptype.convert_batch(values, self)
+        except:
+            raise ParamError(self.name,
+                             "Cannot convert '%s' to type '%s'." % \
+                                                    (values, self.param_type))
+
     def validate(self, value):
         """
         Check if this is a permissable value for the parameter.
 
         If allowed-values are defined, they take precedence over allowed-range.
 
+        Returns the converted value. If the parameter has a cache, lists and
+        dictionaries are returned as new copies of the cached result, so
+        changing them doesn't affect the cache. The cache is protected by a
+        lock, since a schema may be shared by Conf objects in several threads.
+
         """
         if self.ignore:
             # No checking of parameter values if this one is marked to
             # be ignored.
             return value
 
+        if self._cache is None:
+            return self._validate(value)
+
+        # The type is part of the key, since for example 1 and True are
+        # equal, but are converted differently.
+        key = ( type(value), value )
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable input, such as a list or dict
+            return self._validate(value)
+        with self._cache_lock:
+            cache = self._cache
+            try:
+                result = cache.pop(key)
+            except KeyError:
+                pass
+            else:
+                cache[key] = result
+                self._cache_hits += 1
+                return _thaw(result)
+
+        result = self._validate(value)
+        with self._cache_lock:
+            self._cache_misses += 1
+            cache = self._cache
+            cache[key] = _freeze(result)
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return result
+
+    def _validate(self, value):
+        """
+        Convert and check a value, without using the cache.
+
+        """
         value = self.param_type_check(value)
 
         # If we have allowed range or value set then this test needs to be
         # applied to all elements of a list parameter. If our parameter is not
         # a list, we quickly put it in a single-element list, so we can just
         # use the same code for all types of parameters.
-        if self.param_type is PARAM_TYPE_STR_LIST:
+        if self.ptype.is_list:
             value_list = value
         else:
             value_list = [ value ]
@@ -527,7 +1463,12 @@ class _Param(object):
                 if not v in self.allowed_values:
                     raise ParamError(self.name,
                                      "'%s' is not one of the allowed values."
-                                                                    % v)
+                                                    % self.format_value(v))
+            elif self._value_index is not None:
+                if not v in self._value_index:
+                    raise ParamError(self.name,
+                                     "'%s' is not one of the allowed values."
+                                                    % self.format_value(v))
             if self.allowed_range:
                 min_val = self.allowed_range['min']
                 max_val = self.allowed_range['max']
@@ -535,21 +1476,23 @@ class _Param(object):
                         (max_val is not None and v > max_val):
                     raise ParamError(self.name,
                                      "'%s' is not in the allowed range."
-                                                                     % v)
-        if self.param_type is PARAM_TYPE_STR_DICT:
-            if self.allowed_keys:
-                for k in value.keys():
-                    if k not in self.allowed_keys:
-                        raise ParamError(self.name,
-                                 "'%s' is not an allowable key value." % k)
-            if self.mandatory_keys:
-                for k in self.mandatory_keys:
-                    if k not in value.keys():
-                        raise ParamError(self.name,
-                                 "Mandatory key '%s' not present." % k)
+                                                    % self.format_value(v))
+        if self.ptype.validate is not None and \
+                value not in [ None, IGNORE_IF_NOT_SPECIFIED ]:
+            self.ptype.validate(value, self)
 
         return value
 
+    def format_value(self, value):
+        """
+        Return a converted value as string, in the form in which it would be
+        specified, for example "30s" for a duration of 30 seconds.
+
+        """
+        if value in [ None, IGNORE_IF_NOT_SPECIFIED ]:
+            return str(value)
+        return self.ptype.doc(value)
+
     def make_getopts_str(self):
         """
         Return short and long option string for this parameter.
@@ -569,7 +1512,7 @@ class _Param(object):
         """
         if not self.cmd_line:
             return None, None
-        if self.param_type != PARAM_TYPE_BOOL:
+        if self.ptype.takes_arg:
             opt_indicators = ( ":", "=" )
         else:
             opt_indicators = ( "", "" )
@@ -592,7 +1535,7 @@ class _Param(object):
             dspec = { "text" : "", "section" : None, "argname" : "" }
 
         # We don't have a parameter name in the case of boolean flags
-        if self.param_type == PARAM_TYPE_BOOL:
+        if not self.ptype.takes_arg:
             argname = ""
         else:
             argname = dspec.get('argname')
@@ -642,7 +1585,12 @@ class _Param(object):
                             "    Default value: Ignored if not specified.\n")
                     else:
                         s.append(
-                            "    Default value: %s\n" % self.default)
+                            "    Default value: %s\n" %
+                                            self.format_value(self.default))
+                if self._value_index is not None:
+                    s.append("    Allowed values: %d values, listed in %s\n" %
+                             (len(self._value_index),
+                              self.allowed_values_file))
                 if self.conffile:
                     s.append("    Conf file equivalent: %s\n" % self.conffile)
 
@@ -655,11 +1603,480 @@ class _Param(object):
             return None, None
 
 
-class Conf(object):
+class _OptionParser(object):
     """
-    A configuration object.
+    Command line option parser for a set of parameters.
 
-    The object itself is configured with a number of parameter definitions.
+    The parser is built once from the parameter definitions. Short and long
+    options are looked up in dictionaries. Abbreviated long options are
+    resolved via a prefix trie: Each node of the trie knows the single long
+    option that can be reached from it, or that there are several of them.
+
+    The semantics are those of getopt.getopt(): Short options may be
+    clustered ("-gf val", "-gfval"), long options take their value as
+    "--opt=val" or "--opt val" and may be abbreviated to any unique prefix.
+    Option processing stops at the first non-option argument or at "--".
+
+    """
+    # Marks a trie node from which more than one long option can be reached.
+    _AMBIGUOUS = object()
+
+    def __init__(self, params):
+        """
+        Build the option lookup tables for the given _Param objects.
+
+        """
+        self.short_opts = {}
+        self.long_opts  = {}
+        self.trie       = [ {}, None ]
+
+        for param in params:
+            if not param.cmd_line:
+                continue
+            short_opt, long_opt = param.cmd_line
+            entry = (param, param.ptype.takes_arg)
+            if short_opt:
+                self.short_opts[short_opt] = entry
+            if long_opt:
+                self.long_opts[long_opt] = entry
+                node = self.trie
+                for c in long_opt:
+                    node = node[0].setdefault(c, [ {}, None ])
+                    node[1] = long_opt if node[1] is None else self._AMBIGUOUS
+
+    def _error(self, msg):
+        return ParamError("-Command line option", msg + ".")
+
+    def _complete(self, prefix):
+        """
+        Return the full name of the long option abbreviated by 'prefix'.
+
+        """
+        node = self.trie
+        for c in prefix:
+            node = node[0].get(c)
+            if node is None:
+                break
+        if node is None or node[1] is None:
+            # No option starts with the prefix, or the prefix is empty.
+            raise self._error("option --%s not recognized" % prefix)
+        if node[1] is self._AMBIGUOUS:
+            raise self._error("option --%s not a unique prefix" % prefix)
+        return node[1]
+
+    def parse(self, args):
+        """
+        Parse the argument list.
+
+        Returns a list of (param, value) tuples, in the order in which the
+        options appeared, and the list of remaining (positional) arguments.
+        The value is None for options that don't take an argument.
+
+        """
+        opts = []
+        i    = 0
+        num  = len(args)
+        while i < num:
+            arg = args[i]
+            if arg == "--":
+                i += 1
+                break
+            if arg[:1] != "-" or arg == "-":
+                break
+            i += 1
+
+            if arg[1] == "-":
+                name, sep, value = arg[2:].partition("=")
+                entry = self.long_opts.get(name)
+                if entry is None:
+                    name  = self._complete(name)
+                    entry = self.long_opts[name]
+                param, has_arg = entry
+                if has_arg:
+                    if not sep:
+                        if i == num:
+                            raise self._error("option --%s requires argument"
+                                              % name)
+                        value = args[i]
+                        i += 1
+                elif sep:
+                    raise self._error("option --%s must not have an argument"
+                                      % name)
+                else:
+                    value = None
+                opts.append((param, value))
+            else:
+                cluster = arg[1:]
+                while cluster:
+                    opt     = cluster[0]
+                    cluster = cluster[1:]
+                    entry   = self.short_opts.get(opt)
+                    if entry is None:
+                        raise self._error("option -%s not recognized" % opt)
+                    param, has_arg = entry
+                    if has_arg:
+                        if not cluster:
+                            if i == num:
+                                raise self._error("option -%s requires "
+                                                  "argument" % opt)
+                            cluster = args[i]
+                            i += 1
+                        opts.append((param, cluster))
+                        cluster = ""
+                    else:
+                        opts.append((param, None))
+
+        return opts, list(args[i:])
+
+
+if _ContextVar is None:
+    class _ContextVar(object):
+        """
+        Thread-local stand-in for contextvars.ContextVar, for Python versions
+        that don't have it.
+
+        """
+        def __init__(self, name, default=None):
+            self.name     = name
+            self._default = default
+            self._local   = threading.local()
+
+        def get(self):
+            return getattr(self._local, "value", self._default)
+
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            self._local.value = token
+
+
+# Protects the counters of active override layers of all Conf objects.
+_override_lock = threading.Lock()
+
+
+def _text_candidates(param, value):
+    """
+    Return possible string forms of a converted value, in order of
+    preference, for writing it to a config file.
+
+    """
+    if type(value) is bool:
+        return [ "true" if value else "false" ]
+    candidates = []
+    try:
+        if type(value) is list:
+            candidates.append(",".join(value))
+        elif type(value) is dict and param.param_type == PARAM_TYPE_STR_DICT:
+            candidates.append("{ %s }" % " ; ".join([
+                        "%s : %s" % (k, ",".join(v) if type(v) is list else v)
+                                for k, v in sorted(value.items()) ]))
+    except TypeError:
+        # Elements that are not strings
+        pass
+    candidates.append(param.format_value(value))
+    if type(value) is float:
+        candidates.append(repr(value))
+    return candidates
+
+
+def _write_text(param, value, format):
+    """
+    Return the text of a converted value for the given output format of
+    Conf.write(), or None if the value cannot be written so that it is read
+    back unchanged.
+
+    """
+    if format == CONF_FORMAT_JSON or \
+            (format == CONF_FORMAT_YAML and type(value) is not float):
+        # JSON, which is also valid YAML. Floats are written as strings for
+        # YAML, since YAML 1.1 reads numbers like 1e+100 as strings, and a
+        # duration would not accept those.
+        try:
+            text = json.dumps(value, sort_keys=True)
+            if param.param_type_check(json.loads(text)) == value:
+                return text
+        except (TypeError, ValueError, ParamError):
+            pass
+    for text in _text_candidates(param, value):
+        if format == CONF_FORMAT_DEFAULT:
+            # The default format strips values and cuts off comments, and a
+            # value ending in one of '{,;' continues on the next line.
+            if not text or text != text.strip() or text[-1] in "{,;" or \
+                    [ c for c in "#\n\r\t" if c in text ]:
+                continue
+        else:
+            text = json.dumps(text)
+        try:
+            if param.param_type_check(json.loads(text)
+                                      if format != CONF_FORMAT_DEFAULT
+                                      else text) == value:
+                return text
+        except ParamError:
+            pass
+    return None
+
+
+class _OverrideContext(object):
+    """
+    Context manager returned by Conf.override().
+
+    Entering pushes a layer onto the chain of override layers of the current
+    context, leaving pops it again. A layer is a (values, parent layer)
+    tuple.
+
+    """
+    def __init__(self, conf, values):
+        self.conf    = conf
+        self.values  = values
+        self._tokens = []
+
+    def __enter__(self):
+        conf = self.conf
+        with _override_lock:
+            if conf._override_layer is None:
+                conf._override_layer = _ContextVar("pyparams_override",
+                                                   default=None)
+            conf._num_override_layers += 1
+        layer = conf._override_layer
+        self._tokens.append(layer.set((self.values, layer.get())))
+        return conf
+
+    def __exit__(self, *exc_info):
+        conf = self.conf
+        conf._override_layer.reset(self._tokens.pop())
+        with _override_lock:
+            conf._num_override_layers -= 1
+        return False
+
+
+class _Subscription(object):
+    """
+    A callback registered for changes of a set of parameters.
+
+    """
+    def __init__(self, names, callback, executor=None):
+        self.names    = frozenset(names)
+        self.callback = callback
+        self.executor = executor
+
+
+def _freeze_value(value):
+    """
+    Return a value for a Conf that is frozen for fork: Lists become tuples,
+    also inside of dictionaries.
+
+    """
+    if type(value) is list:
+        return tuple([ _freeze_value(v) for v in value ])
+    if type(value) is dict:
+        return dict([ (k, _freeze_value(v)) for k, v in value.items() ])
+    return value
+
+
+# The keys of a parameter specification in a parameter dictionary.
+_PARAM_SPEC_ATTRS = frozenset([ 'default', 'allowed_values', 'allowed_range',
+                                'allowed_keys', 'mandatory_keys',
+                                'default_key', 'param_type', 'conffile',
+                                'cmd_line', 'ignore', 'doc_spec',
+                                'cache_size', 'allowed_values_file' ])
+
+
+class Schema(object):
+    """
+    A set of parameter definitions, which can be shared by Conf objects.
+
+    Every Conf object that is created with a shared schema only stores those
+    parameter values that differ from the defaults. The _Param objects, with
+    their allowed values, doc specs and the command line option tables, only
+    exist once, in the schema:
+
+        SCHEMA = Schema(param_dict)
+
+        conf_a = Conf(schema=SCHEMA, default_env_prefix="A_")
+        conf_b = Conf(schema=SCHEMA, default_env_prefix="B_")
+
+    A shared schema cannot be changed. A Conf object that is created with a
+    param_dict has its own, private schema, to which more parameters can be
+    added with Conf.add().
+
+    """
+    def __init__(self, param_dict=None):
+        """
+        Create the parameter definitions from a parameter dictionary, with
+        the same format as for Conf.
+
+        """
+        self.params                  = {}
+        self.params_by_conffile_name = {}
+
+        # Indexes of the options in use, for conflict checks.
+        self._all_short_opts_so_far  = set()
+        self._all_long_opts_so_far   = set()
+        self._option_parser          = None
+
+        if param_dict is not None:
+            self._add_many(param_dict)
+
+    def _resolve(self, name, spec, conffiles, short_opts, long_opts):
+        """
+        Check a parameter definition for conflicts with the parameters of
+        the schema and with those in the given indexes (of a batch of new
+        parameters), and fill in the automatic conffile name and command
+        line options.
+
+        Returns the keyword arguments for _Param(), or raises ParamError for
+        the first conflict.
+
+        """
+        unknown = set(spec) - _PARAM_SPEC_ATTRS
+        if unknown:
+            raise ParamError(sorted(unknown)[0],
+                             "Invalid parameter config attribute.")
+        if name in self.params:
+            raise ParamError(name, "Duplicate definition.")
+
+        spec      = dict(spec)
+        cmd_line  = spec.get("cmd_line", __NOT_DEFINED__)
+        conffile  = spec.get("conffile", __NOT_DEFINED__)
+        short_opt = long_opt = None
+        if cmd_line == __NOT_DEFINED__:
+            # Automatically create the command line short and long option if
+            # the user left it undefined. We use the first letter of the name
+            # for short and the full name for long. If the name consists of
+            # only one letter, we won't define a long option.
+            short_opt = name[0]
+            if len(name) > 1:
+                long_opt = name
+            else:
+                long_opt = None
+            cmd_line = (short_opt, long_opt)
+        elif cmd_line:
+            short_opt, long_opt = cmd_line
+
+        if conffile == __NOT_DEFINED__:
+            # Automatically create the conffile name of the parameter, if the
+            # user left it undefined. We use the name in all caps.
+            conffile = name.upper().replace("-", "_")
+
+        if conffile:
+            if conffile in self.params_by_conffile_name or \
+                    conffile in conffiles:
+                raise ParamError(conffile, "Duplicate definition.")
+
+        if short_opt:
+            if short_opt in self._all_short_opts_so_far or \
+                    short_opt in short_opts:
+                raise ParamError(name,
+                                 "Short option '-%s' already in use." %
+                                                                 short_opt)
+
+        if long_opt:
+            if long_opt in self._all_long_opts_so_far or \
+                    long_opt in long_opts:
+                raise ParamError(name,
+                                 "Long option '--%s' already in use." %
+                                                                 long_opt)
+
+        spec["cmd_line"] = cmd_line
+        spec["conffile"] = conffile
+        return spec
+
+    def _add_many(self, param_dict):
+        """
+        Add the parameters of a parameter dictionary, in one go.
+
+        All definitions are checked, against the existing parameters and
+        against each other, before any of them is added. Every conflict and
+        invalid definition is reported: If there is exactly one, its
+        ParamError is raised. Otherwise, a ParamError listing all of them is
+        raised, with the individual errors in its 'errors' attribute. In
+        either case, no parameter is added.
+
+        Only used while the schema is being built, see Conf.add_many().
+
+        """
+        errors     = []
+        new_params = []
+        conffiles  = set()
+        short_opts = set()
+        long_opts  = set()
+        for name, spec in param_dict.items():
+            try:
+                spec = self._resolve(name, spec, conffiles,
+                                     short_opts, long_opts)
+                param = _Param(name, **spec)
+            except ParamError as e:
+                errors.append(e)
+                continue
+            if param.conffile:
+                conffiles.add(param.conffile)
+            if param.cmd_line:
+                short_opt, long_opt = param.cmd_line
+                if short_opt:
+                    short_opts.add(short_opt)
+                if long_opt:
+                    long_opts.add(long_opt)
+            new_params.append(param)
+
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            e = ParamError("-Parameter definitions",
+                           "%d errors: %s" %
+                                (len(errors),
+                                 " ".join([ str(err) for err in errors ])))
+            e.errors = errors
+            raise e
+
+        for param in new_params:
+            self.params[param.name] = param
+            if param.conffile:
+                self.params_by_conffile_name[param.conffile] = param
+        self._all_short_opts_so_far.update(short_opts)
+        self._all_long_opts_so_far.update(long_opts)
+
+        # The option lookup tables are rebuilt on the next command line
+        # parse.
+        self._option_parser = None
+
+    def _add(self, name, default=None,
+             allowed_values=None, allowed_range=None, allowed_keys=None,
+             mandatory_keys=None, default_key=None,
+             param_type=PARAM_TYPE_STR, conffile=__NOT_DEFINED__,
+             cmd_line=__NOT_DEFINED__, ignore=False, doc_spec=None,
+             cache_size=None, allowed_values_file=None):
+        """
+        Add a parameter with fill configuration.
+
+        Only used while the schema is being built, see Conf.add().
+
+        """
+        self._add_many({ name : dict(
+                default=default, allowed_values=allowed_values,
+                allowed_range=allowed_range, allowed_keys=allowed_keys,
+                mandatory_keys=mandatory_keys, default_key=default_key,
+                param_type=param_type, conffile=conffile, cmd_line=cmd_line,
+                ignore=ignore, doc_spec=doc_spec, cache_size=cache_size,
+                allowed_values_file=allowed_values_file) })
+
+    def _get_option_parser(self):
+        """
+        Return the command line option parser for these parameters.
+
+        """
+        if self._option_parser is None:
+            self._option_parser = _OptionParser(self.params.values())
+        return self._option_parser
+
+
+class Conf(_Instrumented):
+    """
+    A configuration object.
+
+    The object itself is configured with a number of parameter definitions.
     These can either be passed in via a dictionary, or they can be individually
     added later on.
 
@@ -669,7 +2086,8 @@ class Conf(object):
                  default_env_prefix=None, default_allow_unset_values=False,
                  default_allow_unknown_params=False,
                  ignore_config_file_params=[],
-                 doc_section_order=None):
+                 doc_section_order=None, schema=None,
+                 conf_file_mode=CONF_FILE_FIRST_MATCH, sources=None):
         """
         Initialize the configuration object.
 
@@ -683,7 +2101,8 @@ class Conf(object):
                                        search (first to last) to look for the
                                        config file. Once it is found it is
                                        processed, no further directories are
-                                       searched after that. This value can be
+                                       searched after that (but see
+                                       conf_file_mode). This value can be
                                        overwritten in the acquire() call.
         - default_env_prefix:          A project or program specific prefix you
                                        can define, which is attached to the
@@ -720,10 +2139,33 @@ class Conf(object):
                                        order in which you want them printed. If
                                        omitted, sections are printed in
                                        alphabetical order.
+        - schema:                      A Schema object with the parameter
+                                       definitions, which is shared with
+                                       other Conf objects. Use this instead
+                                       of param_dict.
+        - conf_file_mode:              CONF_FILE_FIRST_MATCH (the default) to
+                                       process only the first config file
+                                       found in the locations, or
+                                       CONF_FILE_MERGE_ALL to process all of
+                                       them, in order. Values in later files
+                                       then take precedence.
+        - sources:                     A list of Source objects (see
+                                       pyparams.sources), from which acquire()
+                                       takes the values, instead of config
+                                       file, environment and command line.
 
         """
-        self.params                       = {}
-        self.params_by_conffile_name      = {}
+        if schema is None:
+            schema            = Schema(param_dict)
+            self._owns_schema = True
+        elif param_dict is not None:
+            raise ParamError("-Conf",
+                             "Specify either a param_dict or a schema.")
+        else:
+            self._owns_schema = False
+        self.schema                       = schema
+        self.params                       = schema.params
+        self.params_by_conffile_name      = schema.params_by_conffile_name
         self.default_allow_unset_values   = default_allow_unset_values
         self.default_allow_unknown_params = default_allow_unknown_params
         self.ignore_config_file_params    = ignore_config_file_params
@@ -733,56 +2175,142 @@ class Conf(object):
                         for l in default_conf_file_locations ]
         self.default_env_prefix           = default_env_prefix or ""
         self.doc_section_order            = doc_section_order
+        if conf_file_mode not in [ CONF_FILE_FIRST_MATCH,
+                                   CONF_FILE_MERGE_ALL ]:
+            raise ParamError("-Conf", "Unknown conf_file_mode '%s'." %
+                                                            conf_file_mode)
+        self.conf_file_mode               = conf_file_mode
+
+        # For diagnostics: The config files processed by the last acquire()
+        # (config_file is the last of them) and all the paths that were
+        # tried to find them.
+        self.config_file                  = None
+        self.config_files                 = []
+        self.config_files_tried           = []
+
+        self.sources                      = sources
+        # For each source: The change token and the values and result of the
+        # last time it was loaded.
+        self._source_cache                = {}
+
+        # Values that differ from the parameter's default. Reads fall
+        # through to the value stored in the _Param object of the schema.
+        self._values                      = {}
+        # Where each of those values came from, for write(): The stage of
+        # acquire() that was active when it was set (None for set()).
+        self._origins                     = {}
+        self._origin                      = None
+        # Serializes all writers of the values - set(), acquire() and the
+        # batches of follow() - so that none of them undoes another one.
+        # Readers don't take it. Re-entrant, since subscribers are called
+        # while it is held and may set values themselves.
+        self._write_lock                  = threading.RLock()
+        # Context-local override layers, see override(). The context
+        # variable is only created once it is needed.
+        self._override_layer              = None
+        self._num_override_layers         = 0
+        self._subscriptions               = []
+        self._subscriptions_by_param      = {}
+        self._pending_changes             = None
+        # The values of a Conf that is frozen for fork, and the parameter
+        # names by conffile name (None for ignored parameters), see
+        # freeze_for_fork().
+        self._frozen                      = None
+        self._frozen_conffile_names       = None
+        # The write end of the pipe that wakes the reload thread, see
+        # reload_on_sighup().
+        self._reload_pipe                 = None
+
+    def _make_key_table(self):
+        """
+        Return a dictionary, which classifies conffile names for ingestion.
 
-        self._all_short_opts_so_far       = []
-        self._all_long_opts_so_far        = []
+        Known parameters are mapped to their _Param object. Ignored
+        parameters and names in ignore_config_file_params are mapped to None:
+        They are skipped. Any name that is not in the table is unknown.
 
-        if param_dict is not None:
-            for param_name, param_conf in param_dict.items():
-                for k in param_conf.keys():
-                    if k not in [ 'default', 'allowed_values', 'allowed_range',
-                                  'allowed_keys', 'mandatory_keys',
-                                  'default_key', 'param_type', 'conffile',
-                                  'cmd_line', 'ignore', 'doc_spec']:
-                        raise ParamError(
-                            k, "Invalid parameter config attribute.")
-                self.add(name=param_name, **param_conf)
-
-    def _parse_default_format_config_file(self, f, allow_unknown_params=None):
+        """
+        table = dict.fromkeys(self.ignore_config_file_params)
+        for name, param in self.params_by_conffile_name.items():
+            table[name] = None if param.ignore else param
+        return table
+
+    def _set_checked(self, param, value):
+        """
+        Set the value of a known, not ignored parameter.
+
+        Returns None on success, or the error message.
+
+        """
+        try:
+            self._set(param, value)
+        except ParamError as e:
+            return str(e)
+        return None
+
+    def _ingest(self, table, key, value, allow_unknown_params):
+        """
+        Set a value given by conffile name, classified by a key table (see
+        _make_key_table()).
+
+        Returns None if the value was set or skipped, or the error message.
+
+        """
+        param = table.get(key, _UNKNOWN)
+        if param is None:
+            return None
+        if param is _UNKNOWN:
+            if allow_unknown_params:
+                return None
+            return "Unknown parameter '%s'." % key
+        return self._set_checked(param, value)
+
+    def _parse_default_format_config_file(self, f, allow_unknown_params=None,
+                                          errors=None):
         """
         Read through the config file and set con values.
 
         In config files dictionaries can stretch over multiple lines, breaking
         either behind '{' or behind ';' or behind ',' within a list value.
 
+        If an 'errors' list is passed in, errors are not raised. Instead, a
+        (line number, message) tuple is appended to the list for every error
+        and processing continues with the next line.
+
         """
         if allow_unknown_params is None:
             allow_unknown_params = self.default_allow_unknown_params
 
+        table = self._make_key_table()
         value = ""
         in_continuation = False
         continuation_chars = [ '{', ',', ';' ]
 
         for i, line in enumerate(f.readlines()):
-            line = line.strip()
             # Strip off any comments...
-            elems = line.split("#", 1)
-            line = elems[0].strip()
+            line = line.split("#", 1)[0].strip()
             # ... and skip if there's nothing left
             if not line:
                 continue
 
-            line = line.replace("\t", " ")
+            if "\t" in line:
+                line = line.replace("\t", " ")
 
             if not in_continuation:
                 # Brand new parameter, so we keep the parameter name
                 elems = line.split(" ", 1)
                 if len(elems) != 2:
-                    raise ParamError("-Line %d" % (i+1),
+                    if errors is None:
+                        raise ParamError("-Line %d" % (i+1),
                                      "Malformed line. Should have two tokens")
+                    errors.append((i+1,
+                                   "Malformed line. Should have two tokens"))
+                    continue
                 param_name, value = elems
                 param_name = param_name.strip()
                 value = value.strip()
+                # Errors are reported for the line on which the value starts.
+                start_line = i+1
                 if value[-1] in continuation_chars:
                     # If there is more to come for this parameter, we will skip
                     # the parameter evaluation.
@@ -798,135 +2326,262 @@ class Conf(object):
                     # the parameter evaluation.
                     continue
 
-            # Evaluate parameter
-            try:
-                param = self.params_by_conffile_name[param_name]
-                self.set(param.name, value)
-            except ParamIgnored:
-                pass
-            except ParamError as e:
-                raise ParamError("-Line %d" % (i+1), e.message)
-            except KeyError as e:
-                if not allow_unknown_params and \
-                        param_name not in self.ignore_config_file_params:
-                    raise ParamError("-Line %d" % (i+1),
-                                     "Unknown parameter '%s'." % param_name)
-                else:
-                    pass
-
-    def _parse_yml_format_config_file(self, f, allow_unknown_params=None):
-        ""
+            # Evaluate parameter. Skipped and unknown names are classified
+            # right here, since they may well be the majority in a shared
+            # config file.
+            param = table.get(param_name, _UNKNOWN)
+            if param is None or \
+                    (param is _UNKNOWN and allow_unknown_params):
+                continue
+            msg = self._ingest(table, param_name, value, allow_unknown_params)
+            if msg is not None:
+                if errors is None:
+                    raise ParamError("-Line %d" % start_line, msg)
+                errors.append((start_line, msg))
+
+    def _parse_yml_format_config_file(self, f, allow_unknown_params=None,
+                                      errors=None):
         """
-        Read through the config file and set con values.
+        Read through a YAML config file and set con values.
 
-        In config files dictionaries can stretch over multiple lines, breaking
-        either behind '{' or behind ';' or behind ',' within a list value.
+        The file may contain several YAML documents, each of which is a
+        mapping of conffile names to values. The documents are applied in
+        order, so values in later documents take precedence.
+
+        Raises FileFormatException if the file is not a stream of YAML
+        mappings of conffile names. See _parse_default_format_config_file()
+        for the 'errors' list. Errors are reported for the line of the key.
 
         """
         if allow_unknown_params is None:
             allow_unknown_params = self.default_allow_unknown_params
+        text = f.read()
         try:
-          yamlo = yaml.safe_load(f)
-        except:
-          raise FileFormatException
-        if type(yamlo)  != 'dict':
-            raise FileFormatException('Incorrect json.  File must contain a json list of key,values')
-        for key, value in yamlo.items():
-            try:
-                param = self.params_by_conffile_name[key]
-                self.set(param.name, value)
-            except ParamIgnored:
-                pass
-            except ParamError as e:
-                raise ParamError("-Line %d" % (i+1), e.message)
-            except KeyError as e:
-                if not allow_unknown_params and \
-                        param_name not in self.ignore_config_file_params:
-                    raise ParamError("-Line %d" % (i+1),
-                                     "Unknown parameter '%s'." % param_name)
+            docs = _yaml_load_all(text)
+        except Exception:
+            raise FileFormatException("Not a YAML file.")
+        if not [ d for d in docs if d is not None ] or \
+                [ d for d in docs if not isinstance(d, (dict, type(None))) ]:
+            raise FileFormatException("YAML file must contain mappings of "
+                                      "parameter names to values.")
+        # Default format lines with a ': ' in the value, such as
+        # 'MY_DICT { baz : 1 }', are valid YAML as well. They result in keys
+        # which are not a single word, though.
+        table = self._make_key_table()
+        for doc in docs:
+            for key in doc or ():
+                if not self._is_conffile_key(table, key):
+                    raise FileFormatException("Not a YAML config file.")
+        # The line numbers are only looked up if there is an error.
+        key_lines = []
+        def line_of(i, key):
+            if not key_lines:
+                key_lines.extend(_yaml_key_lines(text))
+            return key_lines[i].get(key)
+        for i, doc in enumerate(docs):
+            if doc is not None:
+                self._apply_config_mapping(
+                        doc, "-Document %d" % (i+1), allow_unknown_params,
+                        errors, table, lambda key, i=i: line_of(i, key))
+
+    def _is_conffile_key(self, table, key):
+        """
+        Return True if a key in a config mapping can be a conffile name.
+
+        Names in the key table (see _make_key_table()) are always accepted.
+        Any other key has to be a single word, so that it can be reported as
+        an unknown parameter.
+
+        """
+        if table.get(key, _UNKNOWN) is not _UNKNOWN:
+            return True
+        try:
+            return len(key.split()) == 1 and key.strip() == key
+        except AttributeError:
+            return False
+
+    def _apply_config_mapping(self, mapping, location, allow_unknown_params,
+                              errors=None, table=None, line_of=None):
+        """
+        Set the values from a dictionary of conffile names to values.
+
+        If 'line_of' is given, it returns the line number of a key, which is
+        then used to report an error. Otherwise, the 'location' is used as
+        name for any ParamError that is raised. If an 'errors' list is passed
+        in, errors are appended to it instead.
+
+        """
+        if table is None:
+            table = self._make_key_table()
+        for key, value in mapping.items():
+            msg = self._ingest(table, key, value, allow_unknown_params)
+            if msg is not None:
+                line = line_of(key) if line_of is not None else None
+                if line is not None:
+                    if errors is None:
+                        raise ParamError("-Line %d" % line, msg)
+                    errors.append((line, msg))
+                elif errors is None:
+                    raise ParamError(location, msg)
                 else:
-                    pass
+                    errors.append((None, "%s: %s" % (location[1:], msg)))
 
-    def _parse_json_format_config_file(self, f, allow_unknown_params=None):
+    def _parse_json_format_config_file(self, f, allow_unknown_params=None,
+                                       errors=None):
         """
-        Read through the config file and set con values.
+        Read through a JSON config file and set con values.
 
-        In config files dictionaries can stretch over multiple lines, breaking
-        either behind '{' or behind ';' or behind ',' within a list value.
+        The file needs to contain a single JSON object, mapping conffile names
+        to values. The file is memory-mapped, if possible, and scanned key by
+        key: Only the values of known parameters are decoded. The values of
+        unknown or ignored parameters are skipped without building them, so
+        that even very large shared config files can be processed with little
+        memory.
+
+        The structure of the whole file is checked before any value is set.
+        Raises FileFormatException if this is not a JSON object. See
+        _parse_default_format_config_file() for the 'errors' list.
 
         """
         if allow_unknown_params is None:
             allow_unknown_params = self.default_allow_unknown_params
+
+        mm = None
         try:
-          jso = json.load(f)
-        except:
-          raise FileFormatException
-        if type(jso)  != 'dict':
-            raise FileFormatException('Incorrect json.  File must contain a json list of key,values')
-        for key, value in jso.items():
-            try:
-                param = self.params_by_conffile_name[key]
-                self.set(param.name, value)
-            except ParamIgnored:
-                pass
-            except ParamError as e:
-                raise ParamError("-Line %d" % (i+1), e.message)
-            except KeyError as e:
-                if not allow_unknown_params and \
-                        param_name not in self.ignore_config_file_params:
-                    raise ParamError("-Line %d" % (i+1),
-                                     "Unknown parameter '%s'." % param_name)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = mm
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not a real file, or an empty one.
+            buf = f.read()
+            if not isinstance(buf, bytes):
+                buf = buf.encode("utf-8")
+        try:
+            # First pass: Check the structure and remember where the values
+            # of known parameters and any unknown parameters are.
+            table = self._make_key_table()
+            spans = []
+            pos   = _json_skip_ws(buf, 0)
+            if buf[pos:pos+1] != b'{':
+                raise FileFormatException("Not a JSON object.")
+            pos = _json_skip_ws(buf, pos+1)
+            if buf[pos:pos+1] == b'}':
+                pos += 1
+            else:
+                while True:
+                    m = _JSON_KEY_RE.match(buf, pos)
+                    if m is None:
+                        raise FileFormatException("Expected a key.")
+                    key_start, key_end = m.span(1)
+                    key = buf[key_start+1:key_end-1]
+                    if b"\\" in key:
+                        key = _json_decode(buf, key_start, key_end)
+                    else:
+                        key = key.decode("utf-8")
+                    value_start = m.end()
+                    pos = _json_skip_value(buf, value_start)
+                    param = table.get(key, _UNKNOWN)
+                    if param is _UNKNOWN:
+                        if not allow_unknown_params:
+                            spans.append((key, None, key_start, None, None))
+                    elif param is not None:
+                        spans.append((key, param, key_start,
+                                      value_start, pos))
+                    m = _JSON_SEP_RE.match(buf, pos)
+                    if m is None:
+                        raise FileFormatException("Expected ',' or '}'.")
+                    pos = m.end()
+                    if m.group(1) == b'}':
+                        break
+            if _json_skip_ws(buf, pos) != len(buf):
+                raise FileFormatException("Extra data after JSON object.")
+
+            # Second pass: Decode and set the values of known parameters.
+            for key, param, key_start, value_start, value_end in spans:
+                if param is None:
+                    msg = "Unknown parameter '%s'." % key
                 else:
-                    pass
+                    msg = self._set_checked(
+                                param, _json_decode(buf, value_start,
+                                                    value_end))
+                if msg is not None:
+                    line = _line_of(buf, key_start)
+                    if errors is None:
+                        raise ParamError("-Line %d" % line, msg)
+                    errors.append((line, msg))
+        finally:
+            if mm is not None:
+                mm.close()
+
+    def _parse_config_file(self, f, allow_unknown_params=None, errors=None):
+        """
+        Parse a config file in any of the supported formats.
+
+        The JSON and YAML formats are tried first, the default format last.
+        The first format that can read the file is used. See
+        _parse_default_format_config_file() for the 'errors' list.
 
-    def _parse_config_file(self, f, allow_unknown_params=None):
+        """
         try:
-            parsed_cfg_file = self._parse_yml_format_config_file(f, allow_unknown_params=allow_unknown_params)
+            return self._parse_json_format_config_file(
+                        f, allow_unknown_params=allow_unknown_params,
+                        errors=errors)
         except FileFormatException:
             pass
+        f.seek(0)
         try:
-            parsed_cfg_file = self._parse_json_format_config_file(f, allow_unknown_params=allow_unknown_params)
+            return self._parse_yml_format_config_file(
+                        f, allow_unknown_params=allow_unknown_params,
+                        errors=errors)
         except FileFormatException:
             pass
-        try:
-            parsed_cfg_file = self._parse_default_format_config_file(f, allow_unknown_params=allow_unknown_params)
-        except FileFormatException:
-            print("FileFormatError")
-        return parsed_cfg_file
+        f.seek(0)
+        return self._parse_default_format_config_file(
+                        f, allow_unknown_params=allow_unknown_params,
+                        errors=errors)
 
     def _process_config_file(self, fname, allow_unknown_params):
         """
         Open config file and process its content.
 
         """
+        self.config_file        = None
+        self.config_files       = []
+        self.config_files_tried = []
         if not fname:
             # It's possible that no config file is specified at all.
             return
-        if fname[0] not in [ "/", "." ]:
-            # Search for config file at default locations, since the user
-            # didn't specify an absolute path name.
-            for fn in [ prefix+fname for prefix
-                           in self.default_conf_file_locations ]:
-                try:
-                    with open(fn, "r") as f:
+        old_origin = self._origin
+        try:
+            if fname[0] not in [ "/", "." ]:
+                # Search for config file at default locations, since the
+                # user didn't specify an absolute path name.
+                found, self.config_files_tried = _resolve_config_file(
+                            fname, self.default_conf_file_locations,
+                            self.conf_file_mode == CONF_FILE_MERGE_ALL)
+                for fn in found:
+                    try:
+                        f = open(fn, "r")
+                    except IOError as e:
+                        raise ParamError(fname,
+                                         "Error processing config file: %s" %
+                                                                e.strerror)
+                    with f:
                         self.config_file = fn
+                        self.config_files.append(fn)
+                        self._origin = "config file %s" % fn
                         self._parse_config_file(f, allow_unknown_params)
-                except IOError as e:
-                    if "No such file" in e.strerror:
-                        # Quietly ignore failures to find the file. Not having
-                        # a config file is allowed.
-                        pass
-                    else:
-                        # Some other error?
-                        raise ParamError(fname,
-                                         "Error processing config file.")
-        else:
-            # Looks the user specified an absolute path name
-            with open(fname, "r") as f:
-                self.config_file = fname
-                self._parse_config_file(f, allow_unknown_params)
-
-    def _process_env_vars(self, env_prefix=None):
+            else:
+                # Looks the user specified an absolute path name
+                self.config_files_tried = [ fname ]
+                with open(fname, "r") as f:
+                    self.config_file  = fname
+                    self.config_files = [ fname ]
+                    self._origin      = "config file %s" % fname
+                    self._parse_config_file(f, allow_unknown_params)
+        finally:
+            self._origin = old_origin
+
+    def _process_env_vars(self, env_prefix=None, errors=None):
         """
         Look for environment variables for config values.
 
@@ -938,22 +2593,33 @@ class Conf(object):
         of "FOO_", then the environment variable we are looking for is
         FOO_MY_VAR.
 
+        If an 'errors' list is passed in, errors are not raised. Instead, a
+        (variable name, message) tuple is appended to the list for every
+        error.
+
         """
         env_prefix = env_prefix or self.default_env_prefix
         if not env_prefix:
             env_prefix = ""
-        for var_name, param in self.params_by_conffile_name.items():
-            full_var_name = env_prefix+var_name
-            value = os.environ.get(full_var_name)
-            if value is not None:
-                try:
-                    self.set(param.name, value)
-                except ParamIgnored:
-                    pass
-                except ParamError as e:
-                    raise ParamError("-Environment variable %s" % \
+        environ    = os.environ
+        old_origin = self._origin
+        try:
+            for var_name, param in self.params_by_conffile_name.items():
+                if param.ignore:
+                    continue
+                full_var_name = env_prefix+var_name
+                value = environ.get(full_var_name)
+                if value is not None:
+                    self._origin = "environment variable %s" % full_var_name
+                    msg = self._set_checked(param, value)
+                    if msg is not None:
+                        if errors is None:
+                            raise ParamError("-Environment variable %s" % \
                                                                full_var_name,
-                                      e.message)
+                                             msg)
+                        errors.append((full_var_name, msg))
+        finally:
+            self._origin = old_origin
 
     def _process_cmd_line(self, args, filter_list=None):
         """
@@ -966,102 +2632,60 @@ class Conf(object):
         of just certain parameters. For example, an initial parameter run,
         which only looks for parameters, such as the config-file location.
 
-        """
-        # Create short option string
-        short_opts_list  = []
-        long_opts_list   = []
-        param_opt_lookup = {}
+        Returns the list of remaining (positional) arguments.
 
-        for pname, param in self.params.items():
-            short_str, long_str = param.make_getopts_str()
-            if short_str:
-                short_opts_list.append(short_str)
-                param_opt_lookup["-%s" %
-                        (short_str if not short_str.endswith(':') else
-                                                short_str[:-1])] = param
-            if long_str:
-                long_opts_list.append(long_str)
-                param_opt_lookup["--%s" %
-                        (long_str if not long_str.endswith('=') else
-                                                long_str[:-1])] = param
-
-        short_opts_str = ''.join(short_opts_list)
+        """
+        opts, args = self.schema._get_option_parser().parse(args)
 
+        old_origin   = self._origin
+        self._origin = "command line"
         try:
-            opts, args = getopt.getopt(args, short_opts_str, long_opts_list)
-        except getopt.GetoptError as e:
-            raise ParamError("-Command line option", str(e) + ".")
-
-        for o, a in opts:
-            param = param_opt_lookup.get(o)
-            if not param:
-                raise ParamError(o, "Unknown parameter.")
-            if not param.ignore  and \
-                    ((not filter_list) or param.name in filter_list):
-                if param.param_type == PARAM_TYPE_BOOL:
-                    self.set(param.name, True)
-                else:
-                    self.set(param.name, a)
+            for param, a in opts:
+                if not param.ignore  and \
+                        ((not filter_list) or param.name in filter_list):
+                    if not param.ptype.takes_arg:
+                        self.set(param.name, True)
+                    else:
+                        self.set(param.name, a)
+        finally:
+            self._origin = old_origin
+
+        return args
 
     def add(self, name, default=None,
             allowed_values=None, allowed_range=None, allowed_keys=None,
             mandatory_keys=None, default_key=None,
             param_type=PARAM_TYPE_STR, conffile=__NOT_DEFINED__,
-            cmd_line=__NOT_DEFINED__, ignore=False, doc_spec=None):
+            cmd_line=__NOT_DEFINED__, ignore=False, doc_spec=None,
+            cache_size=None, allowed_values_file=None):
         """
         Add a parameter with fill configuration.
 
-        """
-        if name in self.params:
-            raise ParamError(name, "Duplicate definition.")
-        else:
-            short_opt = long_opt = None
-            if cmd_line == __NOT_DEFINED__:
-                # Automatically create the command line short and long option
-                # if the user left it undefined. We use the first letter of
-                # the name for short and the full name for long. If the name
-                # consists of only one letter, we won't define a long option.
-                short_opt = name[0]
-                if len(name) > 1:
-                    long_opt = name
-                else:
-                    long_opt = None
-                cmd_line = (short_opt, long_opt)
-            elif cmd_line:
-                short_opt, long_opt = cmd_line
-
-            if conffile == __NOT_DEFINED__:
-                # Automatically create the conffile name of the parameter, if
-                # the user left it undefined. We use the name in all caps.
-                conffile = name.upper().replace("-", "_")
+        Not possible if this Conf object was created with a shared schema.
 
-            if conffile:
-                if conffile in self.params_by_conffile_name:
-                    raise ParamError(conffile, "Duplicate definition.")
-
-            if short_opt:
-                if short_opt in self._all_short_opts_so_far:
-                    raise ParamError(name,
-                                     "Short option '-%s' already in use." %
-                                                                     short_opt)
-                else:
-                    self._all_short_opts_so_far.append(short_opt)
+        """
+        self._check_not_frozen()
+        if not self._owns_schema:
+            raise ParamError(name, "Cannot add to a shared schema.")
+        self.schema._add(name, default, allowed_values, allowed_range,
+                         allowed_keys, mandatory_keys, default_key,
+                         param_type, conffile, cmd_line, ignore, doc_spec,
+                         cache_size, allowed_values_file)
+
+    def add_many(self, param_dict):
+        """
+        Add several parameters, given in the same form as the param_dict
+        of the Conf object.
 
-            if long_opt:
-                if long_opt in self._all_long_opts_so_far:
-                    raise ParamError(name,
-                                     "Long option '--%s' already in use." %
-                                                                     long_opt)
-                else:
-                    self._all_long_opts_so_far.append(long_opt)
+        This is much faster than calling add() for each of them. All
+        definitions are checked before any parameter is added, and all
+        errors are reported together, see Schema._add_many().
 
-            self.params[name] = _Param(name, default, allowed_values,
-                                       allowed_range, allowed_keys,
-                                       mandatory_keys, default_key,
-                                       param_type, conffile,
-                                       cmd_line, ignore, doc_spec)
-            if conffile:
-                self.params_by_conffile_name[conffile] = self.params[name]
+        """
+        self._check_not_frozen()
+        if not self._owns_schema:
+            raise ParamError("-Conf", "Cannot add to a shared schema.")
+        self.schema._add_many(param_dict)
 
     def get(self, name):
         """
@@ -1073,7 +2697,29 @@ class Conf(object):
         param = self.params[name]
         if param.ignore:
             raise ParamIgnored(name, "Parameter configured to be ignored.")
-        return param.value
+        if self._num_override_layers:
+            layer = self._override_layer.get()
+            while layer is not None:
+                if name in layer[0]:
+                    return layer[0][name]
+                layer = layer[1]
+        return self._values.get(name, param.value)
+
+    def enabled(self, name, key):
+        """
+        Return True if the feature flag 'name' (a parameter of type
+        PARAM_TYPE_FLAG) is enabled for the key, such as a user ID.
+
+        The flag's value is read with get(), so overrides apply. See
+        Rollout.enabled().
+
+        """
+        flag = self.get(name)
+        try:
+            enabled = flag.enabled
+        except AttributeError:
+            raise ParamError(name, "Not a feature flag.")
+        return enabled(key)
 
     def keys(self):
         """
@@ -1091,11 +2737,111 @@ class Conf(object):
 
         Only parameters not configured to be ignored are shown.
 
+        """
+        values = self._values
+        if self._num_override_layers:
+            # Apply the override layers of the current context, the
+            # innermost one last.
+            layers = []
+            layer  = self._override_layer.get()
+            while layer is not None:
+                layers.append(layer[0])
+                layer = layer[1]
+            if layers:
+                values = dict(values)
+                for layer_values in reversed(layers):
+                    values.update(layer_values)
+        return dict(
+                   [ (name, values.get(name, param.value))
+                            for name, param in self.params.items()
+                                    if not param.ignore ]
+               )
+
+    def _check_not_frozen(self):
+        if self._frozen is not None:
+            raise ParamError("-Conf", "Frozen for fork, cannot be changed.")
+
+    def freeze_for_fork(self, freeze_gc=True):
+        """
+        Prepare the configuration for being shared with forked worker
+        processes. Call this in the parent, right before forking.
+
+        The current values (without overrides) are packed into a single
+        dictionary, in which lists become tuples. From then on, get(),
+        get_by_conffile_name() and items() only read this dictionary (and a
+        dictionary of parameter names by conffile name) and don't touch the
+        parameter definitions at all, so that reading values in a worker
+        changes (through reference counts) as few of the memory pages that
+        it shares with the parent as possible. The configuration cannot be
+        changed anymore: set(), acquire(), override(), add() and add_many()
+        raise ParamError.
+
+        If 'freeze_gc' is set and the gc module has freeze() (Python 3.7 and
+        later), it is called as well: All objects of the process - not only
+        those of this configuration - are moved into the permanent
+        generation, so that garbage collections in the workers don't touch
+        them. Returns True if that was done.
+
+        """
+        if self._frozen is None:
+            values = {}
+            for name, param in self.params.items():
+                if not param.ignore:
+                    values[name] = _freeze_value(self._values.get(name,
+                                                                  param.value))
+            params = self.params
+
+            # Plain functions, so that no bound method objects are created
+            # and no other attribute of this object is read.
+            def frozen_get(name):
+                try:
+                    return values[name]
+                except KeyError:
+                    if name in params:
+                        raise ParamIgnored(name,
+                                           "Parameter configured to be "
+                                           "ignored.")
+                    raise ParamError(name, "Unknown parameter.")
+
+            def frozen_items():
+                return dict(values)
+
+            # Metrics wrap whatever get() and items() are in place.
+            metrics = self.__dict__.get("metrics")
+            self.disable_metrics()
+            self._frozen_conffile_names = dict(
+                    [ (cname, None if param.ignore else param.name)
+                        for cname, param in
+                                self.params_by_conffile_name.items() ])
+            self._frozen = values
+            self.get     = frozen_get
+            self.items   = frozen_items
+            if metrics is not None:
+                self.enable_metrics(metrics)
+
+        if freeze_gc and hasattr(gc, "freeze"):
+            gc.freeze()
+            return True
+        return False
+
+    def _reset_values(self):
+        """
+        Set all parameters back to their default values.
+
+        """
+        self._values.clear()
+        self._origins.clear()
+
+    def cache_info(self):
+        """
+        Return a dictionary with the conversion cache statistics (a CacheInfo
+        tuple) of every parameter that was defined with a cache_size.
+
         """
         return dict(
-                   [ (name, self.params[name].value)
-                            for name in self.keys()
-                                    if not self.params[name].ignore ]
+                   [ (name, param.cache_info())
+                            for name, param in self.params.items()
+                                    if param.cache_size ]
                )
 
     def get_by_conffile_name(self, conffile_name):
@@ -1103,25 +2849,322 @@ class Conf(object):
         Retrieve just the value of a parameter, named by its conffile name.
 
         """
+        names = self._frozen_conffile_names
+        if names is not None:
+            # Frozen for fork: Don't touch the parameter definitions.
+            try:
+                name = names[conffile_name]
+            except KeyError:
+                raise ParamError(conffile_name, "Unknown parameter.")
+            if name is None:
+                raise ParamIgnored(conffile_name,
+                                   "Parameter configured to be ignored.")
+            return self.get(name)
         if conffile_name not in self.params_by_conffile_name:
             raise ParamError(conffile_name, "Unknown parameter.")
         param = self.params_by_conffile_name[conffile_name]
         if param.ignore:
             raise ParamIgnored(conffile_name,
                               "Parameter configured to be ignored.")
-        return param.value
+        return self.get(param.name)
 
     def set(self, name, value):
         """
         Set the value of a named parameter.
 
         """
+        self._check_not_frozen()
         if name not in self.params:
             raise ParamError(name, "Unknown parameter.")
         param = self.params[name]
         if param.ignore:
             raise ParamIgnored(name, "Parameter configured to be ignored.")
-        param.value = param.validate(value)
+        with self._write_lock:
+            self._set(param, value)
+
+    def _set(self, param, value):
+        """
+        Set the value of a known, not ignored parameter.
+
+        """
+        name      = param.name
+        old_value = self._values.get(name, param.value)
+        value     = param.validate(value)
+        if value == param.value:
+            self._values.pop(name, None)
+            self._origins.pop(name, None)
+        else:
+            self._values[name]  = value
+            self._origins[name] = self._origin
+        if name in self._subscriptions_by_param and value != old_value:
+            if self._pending_changes is not None:
+                self._pending_changes.setdefault(name, old_value)
+            else:
+                self._dispatch_changes({ name : old_value })
+
+    def _swap_values(self, values, origins):
+        """
+        Replace the values and their origins by new dictionaries, which
+        only contain values that differ from the defaults.
+
+        Readers see the old or the new values, never a mix. Changes of
+        subscribed parameters are added to the pending changes during
+        acquire(), and reported right away otherwise.
+
+        """
+        old_values    = self._values
+        self._values  = values
+        self._origins = origins
+        changes       = {}
+        for name in self._subscriptions_by_param:
+            param = self.params[name]
+            old   = old_values.get(name, param.value)
+            if values.get(name, param.value) != old:
+                changes[name] = old
+        if changes:
+            if self._pending_changes is not None:
+                for name, old in changes.items():
+                    self._pending_changes.setdefault(name, old)
+            else:
+                self._dispatch_changes(changes)
+
+    def _apply_batch(self, updates):
+        """
+        Set a batch of validated values at once.
+
+        'updates' is a list of (_Param, value, origin) tuples, which are
+        applied in order. The new values are prepared in a copy of the value
+        dictionary, which then replaces the current one: get() and items()
+        in other threads see either all of the batch or none of it. Other
+        writers wait until the batch is applied.
+
+        """
+        self._check_not_frozen()
+        with self._write_lock:
+            values  = dict(self._values)
+            origins = dict(self._origins)
+            for param, value, origin in updates:
+                name = param.name
+                if value == param.value:
+                    values.pop(name, None)
+                    origins.pop(name, None)
+                else:
+                    values[name]  = value
+                    origins[name] = origin
+            self._swap_values(values, origins)
+
+    def follow(self, stream, format=CONF_FORMAT_DEFAULT,
+               allow_unknown_params=None, on_error=FEED_ERROR_RAISE,
+               errors=None, backlog=FEED_BACKLOG_BLOCK, max_batch=1000,
+               on_batch=None, stop_event=None, poll_interval=0.1):
+        """
+        Apply a live feed of updates, which are read line by line from a
+        pipe, fifo or socket (a file descriptor or an object with fileno()),
+        until the end of the stream. See pyparams.feed for the details.
+
+        - format:               CONF_FORMAT_DEFAULT for 'NAME value' lines,
+                                as in config files, or CONF_FORMAT_JSON for
+                                one JSON object per line.
+        - allow_unknown_params: Ignore unknown names instead of treating
+                                them as errors. Defaults to the Conf's
+                                default_allow_unknown_params.
+        - on_error:             FEED_ERROR_RAISE (stop with a ParamError),
+                                FEED_ERROR_SKIP_RECORD (drop the record) or
+                                FEED_ERROR_SKIP_BATCH (drop its batch).
+        - errors:               A list, to which a (line number, message)
+                                tuple is appended for every skipped error.
+        - backlog:              FEED_BACKLOG_BLOCK (apply every record; at
+                                most max_batch are read ahead, so that a
+                                fast writer blocks) or FEED_BACKLOG_COALESCE
+                                (apply only the latest value of every
+                                parameter in a batch).
+        - max_batch:            The maximum number of records in a batch.
+        - on_batch:             Called with this Conf object after each
+                                applied batch, for example
+                                SharedConf.publish.
+        - stop_event:           A threading.Event, which ends following as
+                                well. It is checked every poll_interval
+                                seconds.
+
+        Returns the number of batches applied.
+
+        """
+        from pyparams.feed import follow
+        return follow(self, stream, format, allow_unknown_params, on_error,
+                      errors, backlog, max_batch, on_batch, stop_event,
+                      poll_interval)
+
+    def override(self, values=None, **kwargs):
+        """
+        Return a context manager, which temporarily overrides parameter
+        values for the current context only:
+
+            with CONF.override(batch_size=10):
+                ...
+
+        The values (given as dictionary and/or as keyword arguments) are
+        validated right away. Within the 'with' block, get(), items() and
+        get_by_conffile_name() return the overridden values, but only in the
+        thread or asyncio task that entered the block (and in tasks created
+        from it). Overrides can be nested. They are not reported to
+        subscribers, since the effective configuration doesn't change for
+        anyone else.
+
+        """
+        self._check_not_frozen()
+        values = dict(values or {}, **kwargs)
+        for name, value in values.items():
+            if name not in self.params:
+                raise ParamError(name, "Unknown parameter.")
+            param = self.params[name]
+            if param.ignore:
+                raise ParamIgnored(name, "Parameter configured to be ignored.")
+            values[name] = param.validate(value)
+        return _OverrideContext(self, values)
+
+    def subscribe(self, names, callback, executor=None):
+        """
+        Register a callback for changes of the named parameters.
+
+        The callback is called whenever the value of one or more of the
+        parameters has changed, via set() or acquire(). All changes made
+        during a single acquire() are reported in a single call. The callback
+        receives a dictionary, which maps the name of each changed parameter
+        to a tuple with the old and new value.
+
+        If an executor (for example from concurrent.futures) is specified,
+        the callback is submitted to it, instead of being called directly.
+
+        Returns a subscription object, which can be passed to unsubscribe().
+
+        """
+        if isinstance(names, str):
+            names = [ names ]
+        for name in names:
+            if name not in self.params:
+                raise ParamError(name, "Unknown parameter.")
+        sub = _Subscription(names, callback, executor)
+        self._subscriptions.append(sub)
+        for name in sub.names:
+            self._subscriptions_by_param.setdefault(name, []).append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """
+        Remove a subscription that was returned by subscribe().
+
+        """
+        self._subscriptions.remove(sub)
+        for name in sub.names:
+            subs = self._subscriptions_by_param[name]
+            subs.remove(sub)
+            if not subs:
+                del self._subscriptions_by_param[name]
+
+    def _dispatch_changes(self, old_values):
+        """
+        Inform subscribers about changed parameters.
+
+        The 'old_values' dictionary maps parameter names to the value they
+        had before the change. Parameters that have ended up with their old
+        value again are not reported.
+
+        """
+        changes = {}
+        for name, old_value in old_values.items():
+            new_value = self._values.get(name, self.params[name].value)
+            if new_value != old_value:
+                changes[name] = ( old_value, new_value )
+        if not changes:
+            return
+        for sub in list(self._subscriptions):
+            sub_changes = dict([ (name, changes[name]) for name in sub.names
+                                                         if name in changes ])
+            if sub_changes:
+                if sub.executor is not None:
+                    sub.executor.submit(sub.callback, sub_changes)
+                else:
+                    sub.callback(sub_changes)
+
+    def _acquire_sources(self, args, env_prefix, allow_unknown_params):
+        """
+        Take the values from the configured sources.
+
+        The resulting values replace all current values. A source whose
+        change token is the same as last time is not loaded again. Returns
+        the values and their origins, the positional arguments left by the
+        last source that processed the command line (or all arguments if
+        there is none), and the config files that were read and tried by
+        the sources.
+
+        """
+        scratch         = _ScratchConf(self, env_prefix, allow_unknown_params)
+        cache           = {}
+        merged          = {}
+        merged_origins  = {}
+        positional_args = args
+        files           = []
+        files_tried     = []
+        for source in self.sources:
+            token  = source.token(scratch, args)
+            cached = self._source_cache.get(id(source))
+            if token is not None and cached is not None and \
+                    cached[0] == token:
+                values, origins, result, source_files, source_tried = \
+                                                                cached[1:]
+            else:
+                scratch.recorded           = {}
+                scratch.recorded_origins   = {}
+                scratch.config_files       = []
+                scratch.config_files_tried = []
+                scratch._origin            = "source %s" % \
+                                                    type(source).__name__
+                scratch._reset_values()
+                result       = source.load(scratch, args)
+                values       = scratch.recorded
+                origins      = scratch.recorded_origins
+                source_files = scratch.config_files
+                source_tried = scratch.config_files_tried
+            cache[id(source)] = ( token, values, origins, result,
+                                  source_files, source_tried )
+            merged.update(values)
+            merged_origins.update(origins)
+            files.extend(source_files)
+            files_tried.extend(source_tried)
+            if result is not None:
+                positional_args = result
+        self._source_cache = cache
+
+        values  = dict([ (name, value) for name, value in merged.items()
+                            if value != self.params[name].value ])
+        origins = dict([ (name, merged_origins[name]) for name in values ])
+        return values, origins, positional_args, files, files_tried
+
+    def _acquire_shadow(self, args, env_prefix, allow_unknown_params):
+        """
+        Take the values from config file, environment and command line, on
+        top of the current values, without changing anything yet.
+
+        The values are set on a scratch Conf object (the shadow state),
+        which is returned together with the positional arguments.
+
+        """
+        shadow          = _ScratchConf(self, env_prefix)
+        shadow._values  = dict(self._values)
+        shadow._origins = dict(self._origins)
+        # Get the config file name: Process the command line parameters,
+        # but just look for the presence of the config-file-name parameter,
+        # by specifying the parameter-name (not the parameter value).
+        if self.conf_file_parameter:
+            shadow._process_cmd_line(args,
+                                     filter_list=[ self.conf_file_parameter ])
+            config_filename = Conf.get(shadow, self.conf_file_parameter)
+        else:
+            config_filename = None
+
+        shadow._process_config_file(config_filename, allow_unknown_params)
+        shadow._process_env_vars(env_prefix)
+        return shadow, shadow._process_cmd_line(args)
 
     def acquire(self, args, config_filename=None, env_prefix=None,
                 allow_unset_values=None, allow_unknown_params=None):
@@ -1141,36 +3184,228 @@ class Conf(object):
         path of the actually read config file is attached in the 'config_file'
         attribute.
 
-        """
-        # Get the config file name: Process the command line parameters, but
-        # just look for the presence of the config-file-name parameter, by
-        # specifying the parameter-name (not the parameter value).
-        if self.conf_file_parameter:
-            self._process_cmd_line(args,
-                                   filter_list=[ self.conf_file_parameter ])
-            config_filename = self.get(self.conf_file_parameter)
-        else:
-            config_filename = None
+        If the Conf object was created with a list of sources, the values are
+        taken from those instead (see pyparams.sources), starting with the
+        defaults each time. The 'env_prefix' and 'allow_unknown_params' are
+        then used as defaults for the sources.
 
-        self._process_config_file(config_filename, allow_unknown_params)
-        self._process_env_vars(env_prefix)
-        self._process_cmd_line(args)
+        acquire() is a transaction: All values are collected in a shadow
+        state and checked. Only if that succeeds, they replace the current
+        values, all at once. If anything fails, the exception is raised and
+        the configuration is left unchanged. Values set by other threads in
+        the meantime (with set() or follow()) wait for the commit, so they
+        are not lost.
 
-        if allow_unset_values is None:
-            allow_unset_values = self.default_allow_unset_values
+        Returns the list of positional arguments that remain after all command
+        line options have been processed.
 
-        if not allow_unset_values:
-            # Check if any of our parameters are set to None. This is NOT
-            # allowed, all of the parameters need to get a value from
-            # somewhere: Default, config file, environment or command line.
-            for pname in self.params.keys():
-                try:
-                    value = self.get(pname)
-                    if value is None:
-                        raise ParamError(pname,
+        """
+        self._check_not_frozen()
+        # Other writers wait until the new values are committed.
+        with self._write_lock:
+            # Changes are collected while processing the various sources and
+            # are reported to subscribers once at the end.
+            outermost = self._pending_changes is None
+            if outermost:
+                self._pending_changes = {}
+            try:
+                if self.sources is not None:
+                    values, origins, positional_args, files, files_tried = \
+                        self._acquire_sources(args, env_prefix,
+                                              allow_unknown_params)
+                else:
+                    shadow, positional_args = \
+                        self._acquire_shadow(args, env_prefix,
+                                             allow_unknown_params)
+                    values, origins = shadow._values, shadow._origins
+                    files, files_tried = shadow.config_files, \
+                                         shadow.config_files_tried
+
+                if allow_unset_values is None:
+                    allow_unset_values = self.default_allow_unset_values
+
+                if not allow_unset_values:
+                    # Check if any of our parameters are set to None. This
+                    # is NOT allowed, all of the parameters need to get a
+                    # value from somewhere: Default, config file, environment
+                    # or command line.
+                    for pname, param in self.params.items():
+                        if not param.ignore and \
+                                values.get(pname, param.value) is None:
+                            raise ParamError(pname,
                                     "Requires a value, nothing has been set.")
-                except ParamIgnored:
-                    pass
+
+                # Commit.
+                self._swap_values(values, origins)
+                self.config_file        = files[-1] if files else None
+                self.config_files       = files
+                self.config_files_tried = files_tried
+            except:
+                if outermost:
+                    # A failed acquire() doesn't report any changes.
+                    self._pending_changes = None
+                raise
+
+            if outermost:
+                changes, self._pending_changes = self._pending_changes, None
+                if changes:
+                    self._dispatch_changes(changes)
+            return positional_args
+
+    def reload_on_sighup(self, args, on_reload=None, on_error=None,
+                         **acquire_kwargs):
+        """
+        Install a SIGHUP handler, which runs acquire(args) again.
+
+        Since acquire() is a transaction, a reload either replaces all
+        values at once or leaves the configuration as it was. After a
+        successful reload, on_reload is called with this Conf object. If
+        the reload fails, on_error is called with the exception, or the
+        error is written to stderr. The program keeps running with its
+        previous configuration in that case.
+
+        The signal handler itself only writes a byte into a pipe. The reload
+        runs in a separate thread, which waits for any other writer of the
+        values and also calls the subscribers, on_reload and on_error.
+        Signals that arrive during a reload lead to one more reload. Calling
+        this again ends the thread of the previous call. Returns the
+        previous handler.
+
+        """
+        signum = getattr(signal, "SIGHUP", None)
+        if signum is None:
+            raise ParamError("-Conf", "SIGHUP is not available.")
+        import fcntl
+        args = list(args)
+
+        def reload_loop(r):
+            while True:
+                try:
+                    if not os.read(r, 4096):
+                        # The write end was closed by another call.
+                        os.close(r)
+                        return
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    self.acquire(args, **acquire_kwargs)
+                except Exception as e:
+                    if on_error is None:
+                        sys.stderr.write("Configuration reload failed, "
+                                         "keeping the previous "
+                                         "configuration: %s\n" % e)
+                    else:
+                        on_error(e)
+                    continue
+                if on_reload is not None:
+                    on_reload(self)
+
+        def handler(signum, frame):
+            # Nothing else is safe here: The interrupted code may hold any
+            # lock, or may be in the middle of acquire() itself.
+            if self._reload_pipe != w:
+                # Replaced by another call, the pipe is closed.
+                return
+            try:
+                os.write(w, b"x")
+            except OSError:
+                # The pipe is full, so a reload is pending anyway.
+                pass
+
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL,
+                    fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            previous = signal.signal(signum, handler)
+        except:
+            os.close(r)
+            os.close(w)
+            raise
+        if self._reload_pipe is not None:
+            os.close(self._reload_pipe)
+        self._reload_pipe = w
+        thread = threading.Thread(target=reload_loop, args=(r,),
+                                  name="pyparams-reload")
+        thread.daemon = True
+        thread.start()
+        return previous
+
+    def write(self, stream, format=CONF_FORMAT_DEFAULT, annotate=False):
+        """
+        Write the effective configuration to a stream.
+
+        The format is CONF_FORMAT_DEFAULT, CONF_FORMAT_JSON or
+        CONF_FORMAT_YAML. Reading the output as a config file, as acquire()
+        does, yields the same values. This includes default format lines
+        with dictionaries or ': ' in a value, which are not taken for YAML.
+        Values are written one at a time, so that even very large
+        configurations need little memory.
+
+        If 'annotate' is set, every value is followed by a comment that says
+        where it came from: 'default', 'config file <name>', 'environment
+        variable <name>', 'command line', 'source <class>', 'override' or
+        'set'. JSON output cannot be annotated.
+
+        Parameters without conffile name and ignored parameters are not
+        written. Unset values, and default values that cannot be written in
+        the format, are left out: Reading the output yields them anyway.
+        ParamError is raised for any other value that cannot be written.
+
+        """
+        if format not in [ CONF_FORMAT_DEFAULT, CONF_FORMAT_JSON,
+                           CONF_FORMAT_YAML ]:
+            raise ParamError("-Conf", "Unknown format '%s'." % format)
+        if annotate and format == CONF_FORMAT_JSON:
+            raise ParamError("-Conf", "JSON output cannot be annotated.")
+
+        overrides = {}
+        if self._num_override_layers:
+            layer = self._override_layer.get()
+            while layer is not None:
+                for name, value in layer[0].items():
+                    overrides.setdefault(name, value)
+                layer = layer[1]
+
+        if format == CONF_FORMAT_JSON:
+            stream.write("{")
+        sep = "\n"
+        for name in self.params:
+            param = self.params[name]
+            if param.ignore or not param.conffile:
+                continue
+            if name in overrides:
+                value, origin = overrides[name], "override"
+            elif name in self._values:
+                value, origin = self._values[name], \
+                                self._origins.get(name) or "set"
+            else:
+                value, origin = param.value, "default"
+            if value in [ None, IGNORE_IF_NOT_SPECIFIED ]:
+                text = None
+            else:
+                text = _write_text(param, value, format)
+            if text is None:
+                if value == param.value:
+                    continue
+                raise ParamError(name, "Value cannot be written in %s "
+                                       "format." % format)
+
+            if format == CONF_FORMAT_DEFAULT:
+                line = "%s %s" % (param.conffile, text)
+            elif format == CONF_FORMAT_YAML:
+                line = "%s: %s" % (json.dumps(param.conffile), text)
+            else:
+                stream.write("%s    %s : %s" %
+                             (sep, json.dumps(param.conffile), text))
+                sep = ",\n"
+                continue
+            if annotate:
+                line += "    # %s" % origin
+            stream.write(line + "\n")
+        if format == CONF_FORMAT_JSON:
+            stream.write("\n}\n")
 
     def dump(self):
         """
@@ -1181,17 +3416,21 @@ class Conf(object):
 
         """
         for pname, param in self.params.items():
-            print "* %s" % pname
-            print "    - default:          %s" % param.default
-            print "    - conffile:         %s" % param.conffile
-            print "    - type:             %s" % param.param_type
-            print "    - allowed_values:   %s" % param.allowed_values
-            print "    - allowed_range:    %s" % param.allowed_range
-            print "    - cmd_line:         %s" % str(param.cmd_line)
+            print("* %s" % pname)
+            print("    - default:          %s" % (param.default,))
+            print("    - conffile:         %s" % param.conffile)
+            print("    - type:             %s" % param.param_type)
+            print("    - allowed_values:   %s" % (param.allowed_values,))
+            if param.allowed_values_file:
+                print("    - allowed_values_file: %s" %
+                                                    param.allowed_values_file)
+            print("    - allowed_range:    %s" % (param.allowed_range,))
+            print("    - cmd_line:         %s" % str(param.cmd_line))
             if param.ignore:
-                print "    - IS IGNORED!"
+                print("    - IS IGNORED!")
             else:
-                print "    - current value:    %s" % str(param.value)
+                print("    - current value:    %s" %
+                                str(self._values.get(pname, param.value)))
 
 
     def make_doc(self, indent=0):
@@ -1244,7 +3483,7 @@ class Conf(object):
         if self.doc_section_order:
             snames = self.doc_section_order
         else:
-            snames = sections.keys()
+            snames = list(sections.keys())
             if snames and snames[0] is not None:
                 snames.sort(key=lambda k: k.lower())
 
@@ -1259,6 +3498,41 @@ class Conf(object):
         return '\n'.join(out).rstrip()
 
 
+class _ScratchConf(Conf):
+    """
+    A Conf object that shares the schema of another one and records every
+    value that is set, including those equal to the default.
+
+    Sources are loaded into a scratch object, so that the values of each
+    source are known separately. acquire() collects its shadow state in
+    one as well.
+
+    """
+    def __init__(self, conf, env_prefix=None, allow_unknown_params=None):
+        super(_ScratchConf, self).__init__(
+                schema                       = conf.schema,
+                conf_file_parameter          = conf.conf_file_parameter,
+                default_conf_file_locations  =
+                                        conf.default_conf_file_locations,
+                default_env_prefix           =
+                                        env_prefix or conf.default_env_prefix,
+                default_allow_unset_values   = True,
+                default_allow_unknown_params =
+                        conf.default_allow_unknown_params
+                                if allow_unknown_params is None
+                                else allow_unknown_params,
+                ignore_config_file_params    = conf.ignore_config_file_params,
+                conf_file_mode               = conf.conf_file_mode)
+        self.recorded         = {}
+        self.recorded_origins = {}
+
+    def _set(self, param, value):
+        super(_ScratchConf, self)._set(param, value)
+        self.recorded[param.name]         = self._values.get(param.name,
+                                                             param.value)
+        self.recorded_origins[param.name] = self._origin
+
+
 if __name__ == "__main__":
 #
 # --------------------------------------------------------------
@@ -1299,21 +3573,21 @@ if __name__ == "__main__":
 # Main section, running through the steps
 #
     def usage():
-        print "This is some usage info"
+        print("This is some usage info")
 
     try:
         CONF.acquire(sys.argv[1:], config_filename="bbb.txt")
     except ParamError as e:
-        print e
+        print(e)
         usage()
         exit(1)
 
-    print "@@@ action:   ", CONF.get("action")
-    print "@@@ region:   ", CONF.get("region")
-    print "@@@ quantity: ", CONF.get("quantity")
-    print "@@@ enable:   ", CONF.get("enable")
+    print("@@@ action:    %s" % CONF.get("action"))
+    print("@@@ region:    %s" % CONF.get("region"))
+    print("@@@ quantity:  %s" % CONF.get("quantity"))
+    print("@@@ enable:    %s" % CONF.get("enable"))
 
-    print "@@@ keys: ",  CONF.keys()
-    print "@@@ items: ", CONF.items()
+    print("@@@ keys:  %s" % CONF.keys())
+    print("@@@ items: %s" % CONF.items())
 
 
@@ -0,0 +1,234 @@
+"""
+Command line tools for pyparams.
+
+    python -m pyparams daemon --socket PATH SCHEMA [-- ARGS]
+    python -m pyparams validate [--jobs N] [--json REPORT] SCHEMA FILE...
+    python -m pyparams codegen [--output FILE] SCHEMA
+    python -m pyparams profile [--repeat N] [--stacks FILE] SCHEMA [-- ARGS]
+
+SCHEMA names the Conf object to use, in the form 'package.module:NAME'. If
+':NAME' is omitted, the object is expected to be called CONF.
+
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import sys
+
+from pyparams import Conf, ParamError
+
+
+def load_conf(spec):
+    """
+    Import and return the Conf object named by 'package.module[:NAME]'.
+
+    """
+    module_name, _, attr = spec.partition(":")
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        raise ParamError("-Schema %s" % spec, "Cannot import: %s" % e)
+    conf = getattr(module, attr or "CONF", None)
+    if not isinstance(conf, Conf):
+        raise ParamError("-Schema %s" % spec, "Not a Conf object.")
+    return conf
+
+
+def cmd_daemon(opts):
+    """
+    Own a Conf object and serve it on a unix domain socket.
+
+    """
+    from pyparams.daemon import ConfDaemon
+    daemon = ConfDaemon(load_conf(opts.schema), opts.socket, args=opts.args)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+    return 0
+
+
+# The schema used by the validate command, loaded once per worker process.
+_worker_conf = None
+
+def _init_validate_worker(schema, allow_unknown_params, allow_unset_values):
+    global _worker_conf
+    _worker_conf = load_conf(schema)
+    _worker_conf.default_allow_unknown_params = allow_unknown_params
+    _worker_conf.default_allow_unset_values   = allow_unset_values
+
+
+def _validate_file(fname):
+    """
+    Validate a single config file against the worker's schema.
+
+    Returns the file name and a list of (line number, message) tuples. The
+    line number is None for errors that don't relate to a specific line.
+
+    """
+    conf   = _worker_conf
+    errors = []
+    conf._reset_values()
+    try:
+        with open(fname, "r") as f:
+            conf._parse_config_file(f, errors=errors)
+    except (IOError, OSError) as e:
+        return fname, [ (None, "Cannot read file: %s" % e) ]
+    except ParamError as e:
+        errors.append((None, str(e)))
+
+    if not errors and not conf.default_allow_unset_values:
+        for pname in sorted(conf.keys()):
+            if conf.get(pname) is None:
+                errors.append((None, "Parameter '%s': Requires a value, "
+                                     "nothing has been set." % pname))
+    return fname, errors
+
+
+def cmd_validate(opts):
+    """
+    Validate many config files against a schema, in parallel.
+
+    Every error is printed as 'file:line: message'. Returns 1 if any file
+    had errors.
+
+    """
+    initargs = (opts.schema, opts.allow_unknown, opts.allow_unset)
+    # Load the schema here as well, so that errors are reported early.
+    load_conf(opts.schema)
+    if opts.jobs == 1:
+        _init_validate_worker(*initargs)
+        results = [ _validate_file(fname) for fname in opts.files ]
+    else:
+        pool = multiprocessing.Pool(opts.jobs, _init_validate_worker, initargs)
+        try:
+            chunksize = max(1, len(opts.files) // ((opts.jobs or 1) * 4))
+            results   = list(pool.imap(_validate_file, opts.files, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+
+    report = []
+    for fname, errors in results:
+        for line, msg in errors:
+            if line is None:
+                sys.stdout.write("%s: %s\n" % (fname, msg))
+            else:
+                sys.stdout.write("%s:%d: %s\n" % (fname, line, msg))
+            report.append({ "file" : fname, "line" : line, "message" : msg })
+    num_failed = len([ r for r in results if r[1] ])
+    sys.stdout.write("%d file(s) checked, %d with errors.\n" %
+                                                (len(results), num_failed))
+
+    if opts.json:
+        doc = { "files"  : len(results),
+                "failed" : num_failed,
+                "errors" : report }
+        if opts.json == "-":
+            json.dump(doc, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write("\n")
+        else:
+            with open(opts.json, "w") as f:
+                json.dump(doc, f, indent=2, sort_keys=True)
+
+    return 1 if num_failed else 0
+
+
+def cmd_codegen(opts):
+    """
+    Write a static configuration module for a schema, see pyparams.codegen.
+
+    """
+    from pyparams.codegen import generate
+    source = generate(load_conf(opts.schema), opts.schema)
+    if opts.output in [ None, "-" ]:
+        sys.stdout.write(source)
+    else:
+        with open(opts.output, "w") as f:
+            f.write(source)
+    return 0
+
+
+def cmd_profile(opts):
+    """
+    Measure imports, Conf construction and acquire(), see pyparams.startup.
+
+    """
+    from pyparams.startup import profile_startup, format_report
+    stages = profile_startup(opts.schema, opts.args, opts.repeat,
+                             opts.stacks)
+    sys.stdout.write("Startup of %s, best of %d run(s):\n\n" %
+                                                (opts.schema, opts.repeat))
+    sys.stdout.write(format_report(stages))
+    if opts.stacks:
+        sys.stdout.write("\nCollapsed call stacks written to %s.\n" %
+                                                                opts.stacks)
+    return 0
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(prog="python -m pyparams")
+    subparsers = parser.add_subparsers(dest="command")
+
+    p = subparsers.add_parser("daemon",
+                              help="Serve a configuration on a unix socket.")
+    p.add_argument("--socket", required=True,
+                   help="Path name of the unix domain socket.")
+    p.add_argument("schema", help="The Conf object, as 'module[:NAME]'.")
+    p.add_argument("args", nargs="*",
+                   help="Command line arguments passed to acquire().")
+    p.set_defaults(func=cmd_daemon)
+
+    p = subparsers.add_parser("validate",
+                              help="Validate config files against a schema.")
+    p.add_argument("--jobs", "-j", type=int, default=None,
+                   help="Number of worker processes (default: all cores).")
+    p.add_argument("--json", metavar="REPORT",
+                   help="Write a JSON report to this file ('-' for stdout).")
+    p.add_argument("--allow-unknown", action="store_true",
+                   help="Ignore unknown parameters in the config files.")
+    p.add_argument("--allow-unset", action="store_true",
+                   help="Don't complain about parameters without value.")
+    p.add_argument("schema", help="The Conf object, as 'module[:NAME]'.")
+    p.add_argument("files", nargs="+", help="The config files to check.")
+    p.set_defaults(func=cmd_validate)
+
+    p = subparsers.add_parser("codegen",
+                              help="Generate a static configuration module.")
+    p.add_argument("--output", "-o", metavar="FILE",
+                   help="Write the module to this file (default: stdout).")
+    p.add_argument("schema", help="The Conf object, as 'module[:NAME]'.")
+    p.set_defaults(func=cmd_codegen)
+
+    p = subparsers.add_parser("profile",
+                              help="Measure the startup cost of a schema.")
+    p.add_argument("--repeat", "-r", type=int, default=3,
+                   help="Number of runs to take the best times of.")
+    p.add_argument("--stacks", metavar="FILE",
+                   help="Write collapsed call stacks for flame graphs.")
+    p.add_argument("schema", help="The Conf object, as 'module[:NAME]'.")
+    p.add_argument("args", nargs="*",
+                   help="Command line arguments passed to acquire().")
+    p.set_defaults(func=cmd_profile)
+
+    return parser
+
+
+def main(argv=None):
+    opts = make_arg_parser().parse_args(argv)
+    if not getattr(opts, "func", None):
+        make_arg_parser().print_usage()
+        return 2
+    try:
+        return opts.func(opts)
+    except ParamError as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,607 @@
+"""
+Generate a static configuration module from a Conf object.
+
+    python -m pyparams codegen SCHEMA > myproject_config.py
+
+The generated module does all the work of building the schema at generation
+time. It has a Config class with one slot per (not ignored) parameter, the
+command line option and config file name tables as literals, one unrolled
+check function per parameter, and a load() function:
+
+    import myproject_config
+    config, args = myproject_config.load(sys.argv[1:])
+    print(config.port)
+
+load(argv, environ=None) has the same semantics as acquire() on a new Conf
+object: Defaults, config file (found with the same conf_file_parameter and
+locations), environment variables (with the default_env_prefix) and the
+command line, in that order. The same errors are raised. It returns a new
+Config object and the positional arguments. Config._asdict() returns the
+same dictionary as Conf.items().
+
+The generated module only imports ParamError, the type converters and the
+YAML loader from pyparams. It has to be generated again whenever the
+parameter definitions change.
+
+Only Conf objects without sources and with the built-in parameter types can
+be turned into code. Parameters must not use an allowed_values_file.
+
+"""
+
+import keyword
+import math
+import re
+
+from pyparams import ( ParamError, IGNORE_IF_NOT_SPECIFIED,
+                       CONF_FILE_MERGE_ALL,
+                       PARAM_TYPE_STR, PARAM_TYPE_INT, PARAM_TYPE_BOOL,
+                       PARAM_TYPE_STR_LIST, PARAM_TYPE_STR_DICT,
+                       PARAM_TYPE_FLOAT, PARAM_TYPE_DURATION,
+                       PARAM_TYPE_BYTES, PARAM_TYPE_FLAG,
+                       _str_check, _int_check, _bool_check, _str_list_check,
+                       _str_dict_check, _float_check, _duration_check,
+                       _bytes_check, _flag_check, _format_duration,
+                       _format_bytes )
+
+
+# For each built-in type: The converter, the name under which the
+# generated module imports it, the doc function (None for str) and the
+# type of the field, for the docstring of the Config class.
+_TYPES = {
+    PARAM_TYPE_STR      : ( _str_check,      "_str_check",      None,
+                            "str" ),
+    PARAM_TYPE_INT      : ( _int_check,      "_int_check",      None,
+                            "int" ),
+    PARAM_TYPE_BOOL     : ( _bool_check,     "_bool_check",     None,
+                            "bool" ),
+    PARAM_TYPE_STR_LIST : ( _str_list_check, "_str_list_check", None,
+                            "list of str" ),
+    PARAM_TYPE_STR_DICT : ( _str_dict_check, "_str_dict_check", None,
+                            "dict" ),
+    PARAM_TYPE_FLOAT    : ( _float_check,    "_float_check",    None,
+                            "float" ),
+    PARAM_TYPE_DURATION : ( _duration_check, "_duration_check",
+                            "_format_duration", "float (seconds)" ),
+    PARAM_TYPE_BYTES    : ( _bytes_check,    "_bytes_check",
+                            "_format_bytes", "int (bytes)" ),
+    PARAM_TYPE_FLAG     : ( _flag_check,     "_flag_check",     None,
+                            "Rollout" ),
+}
+
+_ATTR_RE = re.compile(r'[A-Za-z]\w*$')
+
+
+# The part of the generated module that is the same for every schema. The
+# tables and check functions it uses are generated.
+_RUNTIME = '''
+_UNSET              = ( None, _IGNORE )
+_UNKNOWN            = object()
+_CONTINUATION_CHARS = ( "{", ",", ";" )
+
+
+def _format(value, doc):
+    return str(value) if value in _UNSET else doc(value)
+
+
+def _ingest(config, key, value):
+    """
+    Set a value given by conffile name. Returns None if the value was set
+    or skipped, or the error message.
+
+    """
+    entry = _CONFFILE_NAMES.get(key, _UNKNOWN)
+    if entry is None:
+        return None
+    if entry is _UNKNOWN:
+        if _ALLOW_UNKNOWN_PARAMS:
+            return None
+        return "Unknown parameter '%s'." % key
+    attr, check = entry
+    try:
+        setattr(config, attr, check(value))
+    except ParamError as e:
+        return str(e)
+    return None
+
+
+def _parse_json(text, config):
+    """
+    Set the values of a JSON config file. Returns False if this is not a
+    JSON object.
+
+    """
+    if not text.lstrip(" \\t\\n\\r").startswith("{"):
+        return False
+    # Inner objects are decoded first, so the last one is the outermost.
+    outer = []
+
+    def hook(pairs):
+        outer[:] = [ pairs ]
+        return dict(pairs)
+
+    try:
+        json.loads(text, object_pairs_hook=hook)
+    except ValueError:
+        return False
+    for key, value in outer[0]:
+        msg = _ingest(config, key, value)
+        if msg is not None:
+            pos = text.find(json.dumps(key))
+            raise ParamError("-Line %d" % (text.count("\\n", 0, pos) + 1),
+                             msg)
+    return True
+
+
+def _parse_yaml(text, config):
+    """
+    Set the values of a YAML config file. Returns False if this is not a
+    stream of YAML mappings.
+
+    """
+    try:
+        docs = _yaml_load_all(text)
+    except Exception:
+        return False
+    docs = [ d for d in docs if d is not None ]
+    if not docs or [ d for d in docs if not isinstance(d, dict) ]:
+        return False
+    for i, doc in enumerate(docs):
+        for key, value in doc.items():
+            msg = _ingest(config, key, value)
+            if msg is not None:
+                raise ParamError("-Document %d" % (i+1), msg)
+    return True
+
+
+def _parse_default(f, config):
+    """
+    Set the values of a config file in the default format.
+
+    """
+    value           = ""
+    in_continuation = False
+    for i, line in enumerate(f.readlines()):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        if "\\t" in line:
+            line = line.replace("\\t", " ")
+        if not in_continuation:
+            elems = line.split(" ", 1)
+            if len(elems) != 2:
+                raise ParamError("-Line %d" % (i+1),
+                                 "Malformed line. Should have two tokens")
+            key, value = elems
+            key        = key.strip()
+            value      = value.strip()
+            start_line = i+1
+            if value[-1] in _CONTINUATION_CHARS:
+                in_continuation = True
+                continue
+        else:
+            value += line
+            if line[-1] not in _CONTINUATION_CHARS:
+                in_continuation = False
+            else:
+                continue
+        msg = _ingest(config, key, value)
+        if msg is not None:
+            raise ParamError("-Line %d" % start_line, msg)
+
+
+def _parse_config_file(f, config):
+    text = f.read()
+    if _parse_json(text, config) or _parse_yaml(text, config):
+        return
+    f.seek(0)
+    _parse_default(f, config)
+
+
+def _find_config_files(fname):
+    found = []
+    for prefix in _CONF_FILE_LOCATIONS:
+        path = os.path.expanduser(prefix+fname)
+        try:
+            os.stat(path)
+        except OSError as e:
+            if e.errno in [ errno.ENOENT, errno.ENOTDIR ]:
+                continue
+            raise ParamError(fname, "Error processing config file: %s" %
+                                                                e.strerror)
+        found.append(path)
+        if not _CONF_FILE_MERGE_ALL:
+            break
+    return found
+
+
+def _process_config_file(fname, config):
+    if fname[0] not in [ "/", "." ]:
+        for path in _find_config_files(fname):
+            try:
+                f = open(path, "r")
+            except IOError as e:
+                raise ParamError(fname, "Error processing config file: %s" %
+                                                                e.strerror)
+            with f:
+                _parse_config_file(f, config)
+    else:
+        with open(fname, "r") as f:
+            _parse_config_file(f, config)
+
+
+def _option_error(msg):
+    return ParamError("-Command line option", msg + ".")
+
+
+def _parse_cmd_line(args):
+    """
+    Return a list of (option table entry, value) tuples and the list of
+    positional arguments.
+
+    """
+    opts = []
+    i    = 0
+    num  = len(args)
+    while i < num:
+        arg = args[i]
+        if arg == "--":
+            i += 1
+            break
+        if arg[:1] != "-" or arg == "-":
+            break
+        i += 1
+
+        if arg[1] == "-":
+            name, sep, value = arg[2:].partition("=")
+            entry = _LONG_OPTS.get(name)
+            if entry is None:
+                # Abbreviations are rare, so they are resolved by a scan.
+                matches = [ n for n in _LONG_OPTS if n.startswith(name) ]
+                if not matches:
+                    raise _option_error("option --%s not recognized" % name)
+                if len(matches) > 1:
+                    raise _option_error("option --%s not a unique prefix" %
+                                                                        name)
+                name  = matches[0]
+                entry = _LONG_OPTS[name]
+            if entry[2]:
+                if not sep:
+                    if i == num:
+                        raise _option_error("option --%s requires argument"
+                                            % name)
+                    value = args[i]
+                    i += 1
+            elif sep:
+                raise _option_error("option --%s must not have an argument"
+                                    % name)
+            else:
+                value = True
+            opts.append((entry, value))
+        else:
+            cluster = arg[1:]
+            while cluster:
+                opt     = cluster[0]
+                cluster = cluster[1:]
+                entry   = _SHORT_OPTS.get(opt)
+                if entry is None:
+                    raise _option_error("option -%s not recognized" % opt)
+                if entry[2]:
+                    if not cluster:
+                        if i == num:
+                            raise _option_error("option -%s requires "
+                                                "argument" % opt)
+                        cluster = args[i]
+                        i += 1
+                    opts.append((entry, cluster))
+                    cluster = ""
+                else:
+                    opts.append((entry, True))
+
+    return opts, list(args[i:])
+
+
+def load(argv, environ=None):
+    """
+    Take the values from config file, environment and command line, like
+    Conf.acquire() does. Returns a new Config object and the list of
+    positional arguments.
+
+    """
+    if environ is None:
+        environ = os.environ
+    config     = Config()
+    opts, args = _parse_cmd_line(argv)
+
+    if _CONF_FILE_ATTR is not None:
+        for (attr, check, _), value in opts:
+            if attr == _CONF_FILE_ATTR:
+                setattr(config, attr, check(value))
+        fname = getattr(config, _CONF_FILE_ATTR)
+        if fname:
+            _process_config_file(fname, config)
+
+    for var_name, attr, check in _ENV_VARS:
+        value = environ.get(var_name)
+        if value is not None:
+            try:
+                setattr(config, attr, check(value))
+            except ParamError as e:
+                raise ParamError("-Environment variable %s" % var_name,
+                                 str(e))
+
+    for (attr, check, _), value in opts:
+        if attr is not None:
+            setattr(config, attr, check(value))
+
+    if not _ALLOW_UNSET_VALUES:
+        for name, attr in Config._FIELDS:
+            if getattr(config, attr) is None:
+                raise ParamError(name,
+                                 "Requires a value, nothing has been set.")
+
+    return config, args
+'''
+
+
+def _literal(value):
+    """
+    Return the Python source for a (converted) parameter value.
+
+    """
+    if type(value) is float and (math.isinf(value) or math.isnan(value)):
+        return "float(%r)" % str(value)
+    return repr(value)
+
+
+def _attr_name(name):
+    """
+    Return the name of the Config attribute for a parameter.
+
+    """
+    attr = re.sub(r'\W', "_", name)
+    if keyword.iskeyword(attr):
+        attr += "_"
+    if not _ATTR_RE.match(attr):
+        raise ParamError(name, "Cannot be turned into an attribute name.")
+    return attr
+
+
+def _check_source(param, attr):
+    """
+    Return the lines of the check function for a parameter, and the lines
+    of any constants it needs.
+
+    """
+    convert, convert_name, doc_name, _ = _TYPES[param.param_type]
+    name      = repr(param.name)
+    fmt       = "_format(%%s, %s)" % (doc_name or "str")
+    consts    = []
+    lines     = [ "def _check_%s(value):" % attr,
+                  "    if value not in _UNSET:",
+                  "        try:" ]
+    if param.param_type in [ PARAM_TYPE_STR_DICT, PARAM_TYPE_FLAG ]:
+        consts.append("_SPEC_%s = _Spec(%s, %s)" %
+                            (attr, name, _literal(param.default_key)))
+    if param.param_type == PARAM_TYPE_STR_DICT:
+        lines.append("            value = %s(value, _SPEC_%s)" %
+                                                        (convert_name, attr))
+    else:
+        lines.append("            value = %s(value)" % convert_name)
+    lines += [ "        except Exception:",
+               "            raise ParamError(%s, %r %% (value,))" %
+                        (name, "Cannot convert '%%s' to type '%s'." %
+                                                        param.param_type) ]
+
+    # Allowed values and range apply to each element of a list.
+    checks = []
+    if param.allowed_values:
+        try:
+            frozenset(param.allowed_values)
+            allowed = "frozenset(%s)" % _literal(list(param.allowed_values))
+        except TypeError:
+            allowed = _literal(tuple(param.allowed_values))
+        consts.append("_ALLOWED_%s = %s" % (attr, allowed))
+        checks += [ "if v not in _ALLOWED_%s:" % attr,
+                    "    raise ParamError(%s, \"'%%s' is not one of the "
+                    "allowed values.\" %% %s)" % (name, fmt % "v") ]
+    if param.allowed_range:
+        conds = []
+        if param.allowed_range["min"] is not None:
+            conds.append("v < %s" % _literal(param.allowed_range["min"]))
+        if param.allowed_range["max"] is not None:
+            conds.append("v > %s" % _literal(param.allowed_range["max"]))
+        if conds:
+            checks += [ "if %s:" % " or ".join(conds),
+                        "    raise ParamError(%s, \"'%%s' is not in the "
+                        "allowed range.\" %% %s)" % (name, fmt % "v") ]
+    if checks:
+        if param.ptype.is_list:
+            lines += [ "    for v in value:",
+                       "        if v == _IGNORE:",
+                       "            continue" ]
+        else:
+            lines += [ "    v = value",
+                       "    if v != _IGNORE:" ]
+        lines += [ "        " + c for c in checks ]
+
+    if param.allowed_keys or param.mandatory_keys:
+        lines.append("    if value not in _UNSET:")
+        if param.allowed_keys:
+            lines += [ "        for k in value.keys():",
+                       "            if k not in %s:" %
+                                            _literal(list(param.allowed_keys)),
+                       "                raise ParamError(%s, \"'%%s' is not "
+                       "an allowable key value.\" %% k)" % name ]
+        if param.mandatory_keys:
+            lines += [ "        for k in %s:" %
+                                    _literal(list(param.mandatory_keys)),
+                       "            if k not in value.keys():",
+                       "                raise ParamError(%s, \"Mandatory key "
+                       "'%%s' not present.\" %% k)" % name ]
+    if param.param_type == PARAM_TYPE_FLAG:
+        lines += [ "    if value not in _UNSET:",
+                   "        _flag_validate(value, _SPEC_%s)" % attr ]
+    lines.append("    return value")
+    return lines, consts
+
+
+def generate(conf, schema_name=None):
+    """
+    Return the source code of a module that loads the configuration of
+    'conf' without building its schema at run time.
+
+    'schema_name' is only used for the comment at the top of the module.
+
+    """
+    if conf.sources is not None:
+        raise ParamError("-Conf", "Cannot generate code for sources.")
+
+    params   = [ p for p in conf.params.values() if not p.ignore ]
+    attrs    = {}
+    by_attr  = {}
+    for param in params:
+        entry = _TYPES.get(param.param_type)
+        if entry is None or param.ptype.convert is not entry[0]:
+            raise ParamError(param.name,
+                             "Cannot generate code for type '%s'." %
+                                                        param.param_type)
+        if param.allowed_values_file:
+            raise ParamError(param.name,
+                             "Cannot generate code for an allowed values "
+                             "file.")
+        attr = _attr_name(param.name)
+        if attr in by_attr:
+            raise ParamError(param.name,
+                             "Same attribute name as parameter '%s'." %
+                                                        by_attr[attr].name)
+        attrs[param.name] = attr
+        by_attr[attr]     = param
+
+    conf_file_attr = None
+    if conf.conf_file_parameter:
+        if conf.conf_file_parameter not in attrs:
+            raise ParamError(conf.conf_file_parameter,
+                             "Config file parameter is ignored.")
+        conf_file_attr = attrs[conf.conf_file_parameter]
+
+    out = []
+    out += [ '"""',
+             "Configuration loader for %s." % (schema_name or "a Conf object"),
+             "",
+             "Generated by 'python -m pyparams codegen', do not edit. See "
+             "pyparams.codegen.",
+             "",
+             '"""',
+             "",
+             "import errno",
+             "import json",
+             "import os",
+             "",
+             "from pyparams import ( ParamError, _yaml_load_all,",
+             "                       _format_duration, _format_bytes )" ]
+    for convert_name in sorted(set([ _TYPES[p.param_type][1]
+                                     for p in params ])):
+        out.append("from pyparams import %s" % convert_name)
+    if [ p for p in params if p.param_type == PARAM_TYPE_FLAG ]:
+        out.append("from pyparams import Rollout, _flag_validate")
+    out += [ "",
+             "",
+             "_IGNORE = %r" % IGNORE_IF_NOT_SPECIFIED,
+             "" ]
+    out += _RUNTIME.split("\n")[1:]
+
+    # The Config class, with the defaults unrolled.
+    out += [ "",
+             "",
+             "class Config(object):",
+             '    """',
+             "    The configuration values.",
+             "" ]
+    width = max([ len(a) for a in attrs.values() ] or [ 0 ])
+    for param in params:
+        out.append("    %-*s  %s" % (width, attrs[param.name],
+                                     _TYPES[param.param_type][3]))
+    out += [ "",
+             '    """',
+             "    __slots__ = (" ]
+    out += [ "        %r," % attrs[p.name] for p in params ]
+    out += [ "    )",
+             "    # Parameter and attribute names, in parameter order.",
+             "    _FIELDS = (" ]
+    out += [ "        ( %r, %r )," % (p.name, attrs[p.name]) for p in params ]
+    out += [ "    )",
+             "",
+             "    def __init__(self):" ]
+    for param in params:
+        out.append("        self.%s = %s" % (attrs[param.name],
+                                             _literal(param.value)))
+    if not params:
+        out.append("        pass")
+    out += [ "",
+             "    def _asdict(self):",
+             "        return {" ]
+    for param in params:
+        out.append("            %r : self.%s," % (param.name,
+                                                  attrs[param.name]))
+    out += [ "        }",
+             "",
+             "",
+             "class _Spec(object):",
+             "    # Stands in for the parameter in conversions and checks.",
+             "    __slots__ = ( 'name', 'default_key' )",
+             "",
+             "    def __init__(self, name, default_key):",
+             "        self.name        = name",
+             "        self.default_key = default_key" ]
+
+    for param in params:
+        lines, consts = _check_source(param, attrs[param.name])
+        out += [ "", "" ] + consts + ([ "" ] if consts else []) + lines
+
+    # The tables. Ignored parameters are in the option and conffile name
+    # tables, but their values are skipped.
+    def entry(param):
+        if param.ignore:
+            return "( None, None, %r )" % param.ptype.takes_arg
+        return "( %r, _check_%s, %r )" % (attrs[param.name],
+                                          attrs[param.name],
+                                          param.ptype.takes_arg)
+
+    short_opts = []
+    long_opts  = []
+    for param in conf.params.values():
+        if param.cmd_line:
+            short_opt, long_opt = param.cmd_line
+            if short_opt:
+                short_opts.append("    %r : %s," % (short_opt, entry(param)))
+            if long_opt:
+                long_opts.append("    %r : %s," % (long_opt, entry(param)))
+    conffile_names = [ "    %r : None," % n
+                            for n in conf.ignore_config_file_params ]
+    env_vars       = []
+    for name, param in conf.params_by_conffile_name.items():
+        if param.ignore:
+            conffile_names.append("    %r : None," % name)
+        else:
+            conffile_names.append("    %r : ( %r, _check_%s )," %
+                                  (name, attrs[param.name],
+                                   attrs[param.name]))
+            env_vars.append("    ( %r, %r, _check_%s )," %
+                            (conf.default_env_prefix + name,
+                             attrs[param.name], attrs[param.name]))
+    out += [ "",
+             "",
+             "_SHORT_OPTS = {" ] + short_opts + [ "}",
+             "_LONG_OPTS = {" ] + long_opts + [ "}",
+             "_CONFFILE_NAMES = {" ] + conffile_names + [ "}",
+             "_ENV_VARS = (" ] + env_vars + [ ")",
+             "",
+             "_CONF_FILE_ATTR       = %r" % conf_file_attr,
+             "_CONF_FILE_LOCATIONS  = %r" %
+                                (tuple(conf.default_conf_file_locations),),
+             "_CONF_FILE_MERGE_ALL  = %r" %
+                                (conf.conf_file_mode == CONF_FILE_MERGE_ALL),
+             "_ALLOW_UNKNOWN_PARAMS = %r" % conf.default_allow_unknown_params,
+             "_ALLOW_UNSET_VALUES   = %r" % conf.default_allow_unset_values,
+             "" ]
+    return "\n".join(out)
@@ -0,0 +1,420 @@
+"""
+Serve a configuration to local processes over a unix domain socket.
+
+A single daemon process owns the Conf object: It runs acquire() and any later
+reloads. Client processes on the same host connect to the daemon's socket and
+receive the current parameter values with a single round-trip, instead of
+parsing config files, environment and command line themselves. Connections
+are persistent: Subscribed clients are sent a new snapshot whenever a reload
+changes any value.
+
+    # In the daemon:
+    daemon = ConfDaemon(CONF, "/run/myproject.sock", args=sys.argv[1:])
+    daemon.serve_forever()
+
+    # In a client:
+    conf = DaemonConf("/run/myproject.sock")
+    conf.get("foo")
+    if conf.poll():
+        ...                        # values have changed
+
+Every message is a frame consisting of a one-byte message type and a four
+byte payload length (network byte order), followed by the payload. Snapshot
+payloads carry an eight byte version number, followed by the JSON encoded
+parameter values. Feature flags are decoded as Rollout values again.
+
+Subscribers which don't read their notifications within SEND_TIMEOUT seconds
+are disconnected, so that a stuck client can't hold up the daemon.
+
+"""
+
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from pyparams import Conf, ParamError, _dump_snapshot, _load_snapshot
+from pyparams.metrics import _Instrumented
+
+
+_FRAME    = struct.Struct("!BI")
+_VERSION  = struct.Struct("!Q")
+
+# Requests, sent by the client.
+MSG_GET       = 1
+MSG_SUBSCRIBE = 2
+MSG_RELOAD    = 3
+
+# Responses and notifications, sent by the daemon.
+MSG_SNAPSHOT  = 16
+MSG_OK        = 17
+MSG_ERROR     = 18
+
+# Seconds the daemon waits for a client to accept a frame.
+SEND_TIMEOUT  = 5.0
+
+
+def _recv_exact(sock, num):
+    """
+    Read exactly 'num' bytes from the socket, or None if the peer has closed
+    the connection.
+
+    """
+    buf = b""
+    while len(buf) < num:
+        chunk = sock.recv(num - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return buf
+
+
+def _recv_frame(sock):
+    """
+    Read a single frame. Returns a (msg_type, payload) tuple, or (None, None)
+    if the peer has closed the connection.
+
+    """
+    hdr = _recv_exact(sock, _FRAME.size)
+    if hdr is None:
+        return None, None
+    msg_type, length = _FRAME.unpack(hdr)
+    payload = _recv_exact(sock, length) if length else b""
+    if payload is None:
+        return None, None
+    return msg_type, payload
+
+
+def _send_frame(sock, msg_type, payload=b"", timeout=None):
+    """
+    Send a single frame.
+
+    With a timeout, socket.timeout is raised if the peer didn't accept all of
+    the frame in time. The socket itself may remain in blocking mode.
+
+    """
+    data = _FRAME.pack(msg_type, len(payload)) + payload
+    if timeout is None:
+        sock.sendall(data)
+        return
+    deadline = time.time() + timeout
+    while data:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select([], [ sock ], [], remaining)[1]:
+            raise socket.timeout("Timed out sending to client.")
+        try:
+            sent = sock.send(data, socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                continue
+            raise
+        data = data[sent:]
+
+
+class ConfDaemon(object):
+    """
+    Owns a Conf object and serves its values over a unix domain socket.
+
+    """
+    def __init__(self, conf, path, args=None, **acquire_kwargs):
+        """
+        Create the daemon and acquire the initial configuration.
+
+        - conf:           The Conf object with the parameter definitions.
+        - path:           The path name of the unix domain socket.
+        - args:           The command line arguments passed to acquire().
+        - acquire_kwargs: Any further keyword arguments for acquire().
+
+        """
+        self.conf           = conf
+        self.path           = path
+        self.args           = list(args or [])
+        self.acquire_kwargs = acquire_kwargs
+        self.version        = 0
+
+        # _lock protects the snapshot and the subscribers, but is never held
+        # while talking to clients. Each connection has its own lock, so that
+        # frames from different threads don't interleave. Reloads are
+        # serialized, so that subscribers see the versions in order.
+        self._lock          = threading.Lock()
+        self._reload_lock   = threading.Lock()
+        self._values        = None
+        self._snapshot      = None
+        self._subscribers   = {}        # connection -> its send lock
+        self._sock          = None
+
+        self.reload()
+
+    def reload(self):
+        """
+        Run acquire() again and notify subscribers if any value has changed.
+
+        Returns True if a new version was published. If acquire() fails, the
+        Conf object keeps its previous values. If the values cannot be
+        encoded, ParamError is raised and the previous version remains
+        published.
+
+        """
+        with self._reload_lock:
+            # acquire() is a transaction, a failure leaves the Conf object
+            # unchanged.
+            self.conf.acquire(self.args, **self.acquire_kwargs)
+            # Publishing is not counted as a read by the access metrics.
+            values = Conf.items(self.conf)
+            if values == self._values:
+                return False
+            try:
+                data = _dump_snapshot(values)
+            except (TypeError, ValueError) as e:
+                raise ParamError("-Config daemon %s" % self.path,
+                                 "Cannot serialize snapshot: %s" % e)
+            with self._lock:
+                self.version  += 1
+                self._values   = values
+                self._snapshot = snapshot = _VERSION.pack(self.version) + data
+                subscribers    = list(self._subscribers.items())
+            for conn, send_lock in subscribers:
+                try:
+                    with send_lock:
+                        _send_frame(conn, MSG_SNAPSHOT, snapshot,
+                                    timeout=SEND_TIMEOUT)
+                except socket.error:
+                    # Gone or too slow: Drop the client, its serving thread
+                    # will notice the closed connection.
+                    self._drop_subscriber(conn)
+            return True
+
+    def _drop_subscriber(self, conn):
+        with self._lock:
+            if self._subscribers.pop(conn, None) is None:
+                return
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def bind(self):
+        """
+        Create the listening socket. Any stale socket file is removed.
+
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(64)
+
+    def serve_forever(self):
+        """
+        Accept and serve client connections until shutdown() is called.
+
+        Each connection is served in its own thread.
+
+        """
+        if self._sock is None:
+            self.bind()
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (socket.error, OSError, AttributeError):
+                # Listening socket was closed by shutdown()
+                return
+            t = threading.Thread(target=self._serve_connection, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def shutdown(self):
+        """
+        Stop accepting connections and remove the socket file.
+
+        """
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, {}
+        for conn in subscribers:
+            conn.close()
+
+    def _serve_connection(self, conn):
+        """
+        Answer the requests of a single client, until it disconnects.
+
+        """
+        send_lock = threading.Lock()
+        try:
+            while True:
+                msg_type, _ = _recv_frame(conn)
+                if msg_type is None:
+                    break
+                if msg_type == MSG_RELOAD:
+                    try:
+                        self.reload()
+                        reply = ( MSG_OK, b"" )
+                    except ParamError as e:
+                        reply = ( MSG_ERROR, str(e).encode("utf-8") )
+                    with send_lock:
+                        _send_frame(conn, *reply, timeout=SEND_TIMEOUT)
+                    continue
+                # Holding the send lock while subscribing makes sure that the
+                # current snapshot goes out before any newer notification.
+                with send_lock:
+                    with self._lock:
+                        snapshot = self._snapshot
+                        if msg_type == MSG_SUBSCRIBE:
+                            self._subscribers[conn] = send_lock
+                    if msg_type in (MSG_GET, MSG_SUBSCRIBE):
+                        _send_frame(conn, MSG_SNAPSHOT, snapshot,
+                                    timeout=SEND_TIMEOUT)
+                    else:
+                        _send_frame(conn, MSG_ERROR,
+                                    ("Unknown message type %d." %
+                                                    msg_type).encode("utf-8"),
+                                    timeout=SEND_TIMEOUT)
+        except socket.error:
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.pop(conn, None)
+            conn.close()
+
+
+class DaemonConf(_Instrumented):
+    """
+    Client side view of a configuration served by a ConfDaemon.
+
+    The values are held in a local cache, so get() does not talk to the
+    daemon. When subscribed, new versions pushed by the daemon are picked up
+    by poll(). The socket can also be handed to an event loop via fileno().
+
+    """
+    def __init__(self, path, subscribe=True, timeout=None):
+        """
+        Connect to the daemon and fetch the current snapshot.
+
+        - path:      The path name of the daemon's unix domain socket.
+        - subscribe: If set, the daemon pushes a new snapshot whenever the
+                     configuration changes.
+        - timeout:   Socket timeout in seconds for blocking operations.
+
+        """
+        self.path       = path
+        self.subscribed = subscribe
+        self.version    = 0
+        self._values    = {}
+        self._sock      = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+        except socket.error as e:
+            self._sock.close()
+            raise ParamError("-Config daemon %s" % path,
+                             "Cannot connect: %s" % e)
+        self._request(MSG_SUBSCRIBE if subscribe else MSG_GET)
+
+    def _apply_snapshot(self, payload):
+        version, = _VERSION.unpack_from(payload, 0)
+        self._values = _load_snapshot(payload[_VERSION.size:])
+        changed = version != self.version
+        self.version = version
+        return changed
+
+    def _read_frame(self):
+        msg_type, payload = _recv_frame(self._sock)
+        if msg_type is None:
+            raise ParamError("-Config daemon %s" % self.path,
+                             "Connection closed.")
+        return msg_type, payload
+
+    def _request(self, msg_type):
+        """
+        Send a request and process frames until its response arrived.
+
+        Any snapshot notifications received in between are applied.
+
+        """
+        _send_frame(self._sock, msg_type)
+        while True:
+            reply_type, payload = self._read_frame()
+            if reply_type == MSG_SNAPSHOT:
+                self._apply_snapshot(payload)
+                if msg_type != MSG_RELOAD:
+                    return
+            elif reply_type == MSG_OK:
+                return
+            elif reply_type == MSG_ERROR:
+                raise ParamError("-Config daemon %s" % self.path,
+                                 payload.decode("utf-8"))
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def poll(self, timeout=0):
+        """
+        Apply any snapshots pushed by the daemon.
+
+        Waits at most 'timeout' seconds for the first one. Returns True if
+        the version has changed.
+
+        """
+        changed = False
+        while select.select([ self._sock ], [], [], timeout)[0]:
+            msg_type, payload = self._read_frame()
+            if msg_type == MSG_SNAPSHOT:
+                changed = self._apply_snapshot(payload) or changed
+            timeout = 0
+        return changed
+
+    def refresh(self):
+        """
+        Explicitly fetch the current snapshot from the daemon.
+
+        """
+        self._request(MSG_GET)
+
+    def reload(self):
+        """
+        Ask the daemon to run acquire() again and update the local cache.
+
+        Raises ParamError with the daemon's message if that failed.
+
+        """
+        self._request(MSG_RELOAD)
+        if not self.subscribed:
+            self._request(MSG_GET)
+
+    def get(self, name):
+        """
+        Retrieve the cached value of a named parameter.
+
+        """
+        try:
+            return self._values[name]
+        except KeyError:
+            raise ParamError(name, "Unknown parameter.")
+
+    def keys(self):
+        """
+        Return the name of all parameters.
+
+        """
+        return list(self._values.keys())
+
+    def items(self):
+        """
+        Return a dictionary with name/value for all parameters.
+
+        """
+        return dict(self._values)
+
+    def close(self):
+        self._sock.close()
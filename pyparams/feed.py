@@ -0,0 +1,236 @@
+"""
+Apply a live feed of configuration updates, see Conf.follow().
+
+A configuration management agent pushes updates to a running program
+through a pipe, a fifo or a socket, one record per line:
+
+    threading.Thread(target=CONF.follow, args=(fd,),
+                     kwargs={ "on_batch" : shared.publish }).start()
+
+In the default format, a record is a 'NAME value' line, as in a config file
+(comments and empty lines are skipped). In the JSON format, a record is a
+JSON object on a single line, which maps any number of conffile names to
+values.
+
+Records that are available together are applied as one batch: All values
+are validated first and then become visible at once (see
+Conf._apply_batch()). Readers never see half a batch, subscribers are
+informed once per batch and on_batch can publish every new version. When
+records arrive slowly, every record is its own batch and applied as soon as
+its line is complete.
+
+Errors - malformed records, unknown names, invalid values - either stop
+following with a ParamError, or skip the record or its whole batch. With
+FEED_BACKLOG_COALESCE, only the latest value of each parameter in a batch is
+validated, and an error only skips that value.
+
+"""
+
+import errno
+import json
+import os
+import select
+
+from pyparams import ( ParamError, _UNKNOWN,
+                       CONF_FORMAT_DEFAULT, CONF_FORMAT_JSON,
+                       FEED_ERROR_RAISE, FEED_ERROR_SKIP_RECORD,
+                       FEED_ERROR_SKIP_BATCH,
+                       FEED_BACKLOG_BLOCK, FEED_BACKLOG_COALESCE )
+
+
+_READ_SIZE = 65536
+
+
+def _parse_default(line):
+    """
+    Return the (conffile name, value) pairs of a 'NAME value' record.
+
+    """
+    if "#" in line:
+        line = line.split("#", 1)[0]
+    line = line.strip()
+    if not line:
+        return []
+    if "\t" in line:
+        line = line.replace("\t", " ")
+    elems = line.split(" ", 1)
+    if len(elems) != 2:
+        raise ValueError("Malformed line. Should have two tokens")
+    return [ ( elems[0], elems[1].strip() ) ]
+
+
+def _parse_json(line):
+    """
+    Return the (conffile name, value) pairs of a JSON object record.
+
+    """
+    if not line.strip():
+        return []
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ValueError("Malformed JSON record: %s" % e)
+    if not isinstance(record, dict):
+        raise ValueError("Not a JSON object.")
+    return list(record.items())
+
+
+_PARSERS = {
+    CONF_FORMAT_DEFAULT : _parse_default,
+    CONF_FORMAT_JSON    : _parse_json,
+}
+
+
+class _LineReader(object):
+    """
+    Collect the complete lines read from a file descriptor.
+
+    """
+    def __init__(self, fd):
+        self.fd       = fd
+        self.lines    = []      # (line number, bytes) tuples
+        self.partial  = b""
+        self.line_num = 0
+        self.eof      = False
+
+    def readable(self, timeout):
+        try:
+            r, _, _ = select.select([ self.fd ], [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        return bool(r)
+
+    def fill(self):
+        """
+        Read once, which blocks until data is available.
+
+        """
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except OSError as e:
+            if e.errno in [ errno.EINTR, errno.EAGAIN ]:
+                return
+            raise
+        if not data:
+            # A last line without a newline is a record as well.
+            self.eof = True
+            data     = b"\n" if self.partial else b""
+        parts        = (self.partial + data).split(b"\n")
+        self.partial = parts.pop()
+        for part in parts:
+            self.line_num += 1
+            self.lines.append(( self.line_num, part ))
+
+    def take(self, num):
+        lines, self.lines = self.lines[:num], self.lines[num:]
+        return lines
+
+
+def _check_record(parse, line, table, allow_unknown_params, validate):
+    """
+    Parse a record and look up its parameters in a key table (see
+    Conf._make_key_table()). The values are validated if 'validate' is set.
+
+    Returns a list of (_Param, value) tuples and None, or None and the error
+    message.
+
+    """
+    try:
+        pairs = parse(line.decode("utf-8"))
+    except (ValueError, UnicodeDecodeError) as e:
+        return None, str(e)
+    record = []
+    for name, value in pairs:
+        param = table.get(name, _UNKNOWN)
+        if param is None:
+            continue
+        if param is _UNKNOWN:
+            if allow_unknown_params:
+                continue
+            return None, "Unknown parameter '%s'." % name
+        if validate:
+            try:
+                value = param.validate(value)
+            except ParamError as e:
+                return None, str(e)
+        record.append(( param, value ))
+    return record, None
+
+
+def follow(conf, stream, format, allow_unknown_params, on_error, errors,
+           backlog, max_batch, on_batch, stop_event, poll_interval):
+    """
+    Implementation of Conf.follow().
+
+    """
+    if format not in _PARSERS:
+        raise ParamError("-Feed", "Unsupported record format '%s'." % format)
+    if on_error not in [ FEED_ERROR_RAISE, FEED_ERROR_SKIP_RECORD,
+                         FEED_ERROR_SKIP_BATCH ]:
+        raise ParamError("-Feed", "Unknown error handling '%s'." % on_error)
+    if backlog not in [ FEED_BACKLOG_BLOCK, FEED_BACKLOG_COALESCE ]:
+        raise ParamError("-Feed", "Unknown backlog handling '%s'." % backlog)
+    if allow_unknown_params is None:
+        allow_unknown_params = conf.default_allow_unknown_params
+
+    parse       = _PARSERS[format]
+    table       = conf._make_key_table()
+    reader      = _LineReader(stream if isinstance(stream, int)
+                                     else stream.fileno())
+    num_batches = 0
+
+    while True:
+        # Wait for a complete line, then add whatever else has arrived.
+        while not reader.lines and not reader.eof:
+            if stop_event is not None:
+                if stop_event.is_set():
+                    return num_batches
+                if not reader.readable(poll_interval):
+                    continue
+            reader.fill()
+        if not reader.lines:
+            return num_batches
+        while len(reader.lines) < max_batch and not reader.eof and \
+                reader.readable(0):
+            reader.fill()
+
+        updates  = []
+        latest   = {}
+        rejected = False
+        for line_num, line in reader.take(max_batch):
+            record, msg = _check_record(parse, line, table,
+                                        allow_unknown_params,
+                                        backlog == FEED_BACKLOG_BLOCK)
+            if msg is not None:
+                if on_error == FEED_ERROR_RAISE:
+                    raise ParamError("-Line %d" % line_num, msg)
+                if errors is not None:
+                    errors.append(( line_num, msg ))
+                rejected = rejected or on_error == FEED_ERROR_SKIP_BATCH
+            elif backlog == FEED_BACKLOG_COALESCE:
+                for param, value in record:
+                    latest[param.name] = ( param, value, line_num )
+            else:
+                updates.extend([ ( param, value, "feed line %d" % line_num )
+                                 for param, value in record ])
+
+        # Coalesced values are only validated once they are the latest.
+        for param, value, line_num in sorted(latest.values(),
+                                             key=lambda u: u[2]):
+            try:
+                updates.append(( param, param.validate(value),
+                                 "feed line %d" % line_num ))
+            except ParamError as e:
+                if on_error == FEED_ERROR_RAISE:
+                    raise ParamError("-Line %d" % line_num, str(e))
+                if errors is not None:
+                    errors.append(( line_num, str(e) ))
+                rejected = rejected or on_error == FEED_ERROR_SKIP_BATCH
+
+        if updates and not rejected:
+            conf._apply_batch(updates)
+            num_batches += 1
+            if on_batch is not None:
+                on_batch(conf)
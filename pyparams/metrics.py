@@ -0,0 +1,231 @@
+"""
+Opt-in access metrics for configuration objects.
+
+Conf, SharedConf and DaemonConf objects can count how often each parameter
+is read with get(), get_by_conffile_name() or items(), remember when it was
+last read and, optionally, sample the call sites of the reads:
+
+    metrics = CONF.enable_metrics(sample_every=100)
+    ...
+    metrics.report()                   # name -> AccessStats
+    metrics.unread(CONF.keys())        # parameters that were never read
+
+Metrics are disabled by default and then cost nothing: Enabling them
+replaces the object's get() and items() methods with counting versions,
+disabling them restores the original ones. Reads by pyparams itself (for
+example when acquire() looks for the config file name, or when a snapshot
+is published) are not counted.
+
+Counts are not protected by a lock. When many threads read the same
+parameter at the same time, a few reads may not be counted.
+
+"""
+
+import collections
+import os
+import sys
+import time
+
+
+AccessStats = collections.namedtuple("AccessStats",
+                                     [ "count", "last_read", "call_sites" ])
+
+# Frames in this directory are skipped when sampling call sites.
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_in_package_cache = {}
+
+
+def _in_package(filename):
+    """
+    Return True if the file is one of the pyparams modules.
+
+    """
+    try:
+        return _in_package_cache[filename]
+    except KeyError:
+        result = os.path.dirname(os.path.abspath(filename)) == _PACKAGE_DIR
+        _in_package_cache[filename] = result
+        return result
+
+
+class AccessMetrics(object):
+    """
+    Read counts, last read times and sampled call sites of parameters.
+
+    """
+    def __init__(self, sample_every=0, export=None, export_interval=60.0,
+                 clock=time.time):
+        """
+        Create a new metrics object.
+
+        - sample_every:     If set, the call site of every n-th read is
+                            recorded.
+        - export:           A function, which is called with the result of
+                            report() at most once every 'export_interval'
+                            seconds. It is called by a read, so nothing is
+                            exported while nothing is read. Exceptions are
+                            not caught.
+        - clock:            The function that returns the current time.
+
+        """
+        self.sample_every    = sample_every
+        self.export          = export
+        self.export_interval = export_interval
+        self.clock           = clock
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all collected data.
+
+        """
+        self._counts      = {}
+        self._last_read   = {}
+        self._call_sites  = {}
+        self._countdown   = self.sample_every
+        if self.export is not None:
+            self._next_export = self.clock() + self.export_interval
+        else:
+            self._next_export = None
+
+    def record(self, name):
+        """
+        Count a read of a single parameter.
+
+        """
+        now                   = self.clock()
+        counts                = self._counts
+        counts[name]          = counts.get(name, 0) + 1
+        self._last_read[name] = now
+        if self.sample_every:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                self._countdown = self.sample_every
+                self._sample([ name ])
+        if self._next_export is not None and now >= self._next_export:
+            self._export(now)
+
+    def record_all(self, names):
+        """
+        Count a read of several parameters, for example by items().
+
+        """
+        now       = self.clock()
+        counts    = self._counts
+        last_read = self._last_read
+        for name in names:
+            counts[name]    = counts.get(name, 0) + 1
+            last_read[name] = now
+        if self.sample_every:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                self._countdown = self.sample_every
+                self._sample(names)
+        if self._next_export is not None and now >= self._next_export:
+            self._export(now)
+
+    def _sample(self, names):
+        """
+        Record the first caller outside of pyparams as call site.
+
+        """
+        frame = sys._getframe(2)
+        while frame is not None and _in_package(frame.f_code.co_filename):
+            frame = frame.f_back
+        if frame is None:
+            return
+        site = ( frame.f_code.co_filename, frame.f_lineno,
+                 frame.f_code.co_name )
+        for name in names:
+            sites       = self._call_sites.setdefault(name, {})
+            sites[site] = sites.get(site, 0) + 1
+
+    def _export(self, now):
+        # Schedule the next export first, so that a failing hook isn't
+        # called on every read.
+        self._next_export = now + self.export_interval
+        self.export(self.report())
+
+    def report(self, names=None):
+        """
+        Return a dictionary of parameter names to AccessStats tuples.
+
+        Each tuple has the number of reads, the time of the last read and a
+        dictionary of sampled call sites - ( filename, line, function ) - to
+        the number of times they were sampled. Parameters in 'names' are
+        included even if they were never read.
+
+        """
+        result = {}
+        for name in set(self._counts) | set(names or []):
+            result[name] = AccessStats(self._counts.get(name, 0),
+                                       self._last_read.get(name),
+                                       dict(self._call_sites.get(name, {})))
+        return result
+
+    def unread(self, names):
+        """
+        Return the sorted list of the given parameter names that were never
+        read.
+
+        """
+        return sorted([ name for name in names if name not in self._counts ])
+
+
+class _Instrumented(object):
+    """
+    Mix-in class for objects with get() and items() methods, which adds
+    enable_metrics() and disable_metrics().
+
+    """
+    metrics = None
+
+    def enable_metrics(self, metrics=None, **kwargs):
+        """
+        Start counting reads of parameters.
+
+        Either an AccessMetrics object is passed in (which may be shared by
+        several objects), or a new one is created with the given keyword
+        arguments. Returns the AccessMetrics object.
+
+        """
+        if metrics is None:
+            metrics = AccessMetrics(**kwargs)
+        self.disable_metrics()
+        # Instance level get() and items() (see Conf.freeze_for_fork()) are
+        # restored by disable_metrics().
+        unmetered  = dict([ (n, self.__dict__[n]) for n in [ "get", "items" ]
+                                if n in self.__dict__ ])
+        get        = self.get
+        items      = self.items
+        record     = metrics.record
+        record_all = metrics.record_all
+
+        def metered_get(name):
+            value = get(name)
+            record(name)
+            return value
+
+        def metered_items():
+            values = items()
+            record_all(values)
+            return values
+
+        self.get        = metered_get
+        self.items      = metered_items
+        self.metrics    = metrics
+        self._unmetered = unmetered
+        return metrics
+
+    def disable_metrics(self):
+        """
+        Stop counting reads. The collected data remains in the AccessMetrics
+        object.
+
+        """
+        if "metrics" not in self.__dict__:
+            return
+        self.__dict__.pop("get", None)
+        self.__dict__.pop("items", None)
+        self.__dict__.pop("metrics", None)
+        self.__dict__.update(self.__dict__.pop("_unmetered", {}))
@@ -0,0 +1,258 @@
+"""
+Share a configuration snapshot with worker processes.
+
+A parent process publishes the values of its Conf object into a shared,
+memory-mapped segment. Worker processes - forked or spawned - attach to that
+segment read-only and see every newly published version:
+
+    shared = SharedConf.create()
+    shared.publish(CONF)               # after acquire() or any later update
+
+    pool = multiprocessing.Pool(initializer=init_worker, initargs=(shared,))
+
+    # In the worker:
+    shared.get("foo")
+
+The segment starts with a small header, containing a sequence counter and the
+length of the snapshot data, followed by the snapshot itself (JSON encoded,
+feature flags are decoded as Rollout values again).
+The sequence counter is odd while the parent writes a new snapshot. Readers
+only decode the snapshot if the counter changed since their last read.
+Otherwise, reading a value is a header check and a dictionary lookup. If the
+counter stays odd for longer than a second - the parent died while writing -
+readers raise ParamError instead of waiting forever.
+
+Forked workers inherit the parent's writable mapping. It is replaced by a
+read-only one in the child right after the fork.
+
+"""
+
+import mmap
+import multiprocessing.util
+import os
+import struct
+import tempfile
+import time
+import weakref
+
+from pyparams import Conf, ParamError, _dump_snapshot, _load_snapshot
+from pyparams.metrics import _Instrumented
+
+
+_MAGIC  = b"PYPARAMS"
+_HEADER = struct.Struct("<8sQQ")    # magic, sequence counter, data length
+
+# Default size of a newly created segment.
+DEFAULT_SEGMENT_SIZE = 1024*1024
+
+# How long readers wait for a snapshot that is being written, in seconds.
+_WRITE_TIMEOUT = 1.0
+
+# Writable segments of this process, which become read-only in forked
+# children.
+_writable_segments = weakref.WeakSet()
+
+def _after_fork_in_child():
+    for shared in list(_writable_segments):
+        shared._make_read_only()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class SharedConf(_Instrumented):
+    """
+    A versioned configuration snapshot in a shared memory segment.
+
+    Create a writable segment in the parent with create(), attach to an
+    existing one with attach(). Instances can be passed to worker processes
+    (for example as Pool initializer arguments): When they are pickled for a
+    spawned process, they attach read-only to the same segment.
+
+    """
+    def __init__(self, path, mm, writable):
+        """
+        Use create() or attach() instead of calling this directly.
+
+        """
+        self.path     = path
+        self.writable = writable
+        self._mm      = mm
+        self._seq     = None
+        self._values  = {}
+        self._pid     = os.getpid()
+        if writable:
+            _writable_segments.add(self)
+            if not hasattr(os, "register_at_fork"):
+                # Only processes started by multiprocessing are covered.
+                multiprocessing.util.register_after_fork(
+                                        self, SharedConf._make_read_only)
+
+    @classmethod
+    def create(cls, size=DEFAULT_SEGMENT_SIZE, path=None):
+        """
+        Create a new, empty segment of 'size' bytes.
+
+        If no path is specified, the backing file is created in /dev/shm, if
+        available, otherwise in the default temp directory.
+
+        """
+        if path is None:
+            tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, path = tempfile.mkstemp(prefix="pyparams-", dir=tmp_dir)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, _HEADER.size + size)
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(mm, 0, _MAGIC, 0, 2)
+        mm[_HEADER.size:_HEADER.size+2] = b"{}"
+        return cls(path, mm, True)
+
+    @classmethod
+    def attach(cls, path):
+        """
+        Attach read-only to an existing segment.
+
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if mm[:len(_MAGIC)] != _MAGIC:
+            mm.close()
+            raise ParamError("-Shared config %s" % path,
+                             "Not a pyparams segment.")
+        return cls(path, mm, False)
+
+    def _make_read_only(self):
+        """
+        Replace a writable mapping, inherited by a forked child, with a
+        read-only one.
+
+        """
+        if not self.writable:
+            return
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self._mm.close()
+        self._mm      = mm
+        self.writable = False
+        _writable_segments.discard(self)
+
+    def __reduce__(self):
+        # Spawned workers re-attach to the segment by its path.
+        return (SharedConf.attach, (self.path,))
+
+    def publish(self, conf):
+        """
+        Write the current values of a Conf object as a new version.
+
+        Only possible on the segment created by create(). Returns the new
+        version number.
+
+        """
+        if self.writable and os.getpid() != self._pid:
+            # Forked without an at-fork hook.
+            self._make_read_only()
+        if not self.writable:
+            raise ParamError("-Shared config %s" % self.path,
+                             "Segment is attached read-only.")
+        try:
+            # Publishing is not counted as a read by the access metrics.
+            data = _dump_snapshot(Conf.items(conf))
+        except (TypeError, ValueError) as e:
+            raise ParamError("-Shared config %s" % self.path,
+                             "Cannot serialize snapshot: %s" % e)
+        if _HEADER.size + len(data) > len(self._mm):
+            raise ParamError("-Shared config %s" % self.path,
+                             "Snapshot of %d bytes exceeds segment size." %
+                                                                   len(data))
+        _, seq, length = _HEADER.unpack_from(self._mm, 0)
+        # An odd sequence number tells readers that a write is in progress.
+        _HEADER.pack_into(self._mm, 0, _MAGIC, seq+1, length)
+        self._mm[_HEADER.size:_HEADER.size+len(data)] = data
+        _HEADER.pack_into(self._mm, 0, _MAGIC, seq+2, len(data))
+        return (seq+2) // 2
+
+    def _refresh(self):
+        """
+        Decode the snapshot, if a new version was published since last time.
+
+        """
+        mm       = self._mm
+        deadline = None
+        tries    = 0
+        while True:
+            _, seq, length = _HEADER.unpack_from(mm, 0)
+            if seq == self._seq:
+                return
+            if not seq & 1:
+                data = mm[_HEADER.size:_HEADER.size+length]
+                if _HEADER.unpack_from(mm, 0)[1] == seq:
+                    break
+            # The writer is busy: Spin briefly, then back off, but don't
+            # wait forever for a writer that may have died.
+            tries += 1
+            if tries > 100:
+                now = time.time()
+                if deadline is None:
+                    deadline = now + _WRITE_TIMEOUT
+                elif now > deadline:
+                    raise ParamError("-Shared config %s" % self.path,
+                                     "Snapshot is being written for too "
+                                     "long, the writer may have died.")
+                time.sleep(0.001)
+        self._values = _load_snapshot(data)
+        self._seq    = seq
+
+    def version(self):
+        """
+        Return the version number of the most recently published snapshot.
+
+        Version 0 means that nothing has been published yet.
+
+        """
+        return _HEADER.unpack_from(self._mm, 0)[1] // 2
+
+    def get(self, name):
+        """
+        Retrieve the value of a named parameter from the latest snapshot.
+
+        """
+        self._refresh()
+        try:
+            return self._values[name]
+        except KeyError:
+            raise ParamError(name, "Unknown parameter.")
+
+    def items(self):
+        """
+        Return a dictionary with name/value for all parameters of the latest
+        snapshot.
+
+        """
+        self._refresh()
+        return dict(self._values)
+
+    def close(self):
+        """
+        Unmap the segment.
+
+        """
+        _writable_segments.discard(self)
+        self._mm.close()
+
+    def unlink(self):
+        """
+        Close and remove the segment. Call this in the parent when done.
+
+        """
+        self.close()
+        os.unlink(self.path)
@@ -0,0 +1,257 @@
+"""
+Configurable sources of parameter values for Conf.acquire().
+
+By default, acquire() takes values from a config file, the environment and
+the command line, in that order. A Conf object can instead be given a list
+of sources, from lowest to highest precedence:
+
+    CONF = Conf(param_dict,
+                sources=[ ConfigFileSource(),
+                          DirectorySource("/etc/myproject.d"),
+                          EnvSource(),
+                          ArgvSource() ])
+    CONF.acquire(sys.argv[1:])
+
+Every source reports a change token, which is cheap to compute: A file's
+modification time and size, for example. On the next acquire(), a source
+whose token is unchanged is neither read nor validated again. Its values
+from the previous run are used instead. Periodically re-acquiring a
+configuration from unchanged sources therefore costs only a few stat()
+calls.
+
+Custom providers derive from Source and override read() and, ideally,
+token(). The base class provides no values.
+
+"""
+
+import json
+import os
+
+from pyparams import ( ParamError, CONF_FILE_MERGE_ALL,
+                       _resolve_config_file, _ScratchConf )
+
+
+class Source(object):
+    """
+    Base class of all sources.
+
+    Sub-classes override read(), or load() if they need access to the
+    private parsing functions of the scratch Conf object. The base class
+    itself is a source without any values.
+
+    """
+    def token(self, conf, args):
+        """
+        Return a value that changes whenever the values of this source may
+        have changed, or None if the source has to be read every time.
+
+        'conf' is the Conf object, 'args' are the command line arguments
+        passed to acquire().
+
+        """
+        return None
+
+    def read(self, conf, args):
+        """
+        Return a dictionary of parameter names to (unconverted) values.
+
+        The default is an empty dictionary. Sub-classes which override load()
+        instead don't need to implement this.
+
+        """
+        return {}
+
+    def load(self, conf, args):
+        """
+        Set the values of this source on a scratch Conf object.
+
+        Returns the list of positional arguments, if this source processes
+        the command line, otherwise None.
+
+        """
+        for name, value in self.read(conf, args).items():
+            conf.set(name, value)
+        return None
+
+
+def _file_token(path):
+    """
+    Return modification time, size and inode of a file, or None if it does
+    not exist.
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return ( st.st_mtime, st.st_size, st.st_ino )
+
+
+class FileSource(Source):
+    """
+    A config file with a fixed path name, in any of the supported formats.
+
+    A missing file has no values.
+
+    """
+    def __init__(self, path, allow_unknown_params=None):
+        self.path                 = path
+        self.allow_unknown_params = allow_unknown_params
+
+    def token(self, conf, args):
+        return ( "file", _file_token(self.path) )
+
+    def load(self, conf, args):
+        conf.config_files_tried.append(self.path)
+        try:
+            f = open(self.path, "r")
+        except IOError as e:
+            if not os.path.exists(self.path):
+                return None
+            raise ParamError("-Config file %s" % self.path,
+                             "Cannot read: %s" % e.strerror)
+        conf.config_files.append(self.path)
+        with f:
+            conf._parse_config_file(f, self.allow_unknown_params)
+        return None
+
+
+class DirectorySource(Source):
+    """
+    All config files in a directory, processed in order of their names.
+
+    Only files whose names end with one of the 'suffixes' are used. Hidden
+    files are skipped.
+
+    """
+    def __init__(self, path, suffixes=( ".conf", ".json", ".yml", ".yaml" ),
+                 allow_unknown_params=None):
+        self.path                 = path
+        self.suffixes             = tuple(suffixes)
+        self.allow_unknown_params = allow_unknown_params
+
+    def _files(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return [ os.path.join(self.path, n) for n in sorted(names)
+                    if not n.startswith(".") and n.endswith(self.suffixes) ]
+
+    def token(self, conf, args):
+        return ( "dir", _file_token(self.path),
+                 tuple([ ( fn, _file_token(fn) ) for fn in self._files() ]) )
+
+    def load(self, conf, args):
+        for fn in self._files():
+            FileSource(fn, self.allow_unknown_params).load(conf, args)
+        return None
+
+
+class ConfigFileSource(Source):
+    """
+    The config file, as processed by acquire() without sources: The name is
+    given by the Conf's conf_file_parameter (or 'fname') and is looked up in
+    the default_conf_file_locations.
+
+    """
+    def __init__(self, fname=None):
+        self.fname = fname
+
+    def _fname(self, conf, args):
+        if self.fname or not conf.conf_file_parameter:
+            return self.fname
+        # Only look for the config file option on the command line, without
+        # setting anything.
+        param = conf.params[conf.conf_file_parameter]
+        value = param.value
+        opts, _ = conf.schema._get_option_parser().parse(args)
+        for p, a in opts:
+            if p is param:
+                value = param.validate(a)
+        return value
+
+    def token(self, conf, args):
+        fname = self._fname(conf, args)
+        if not fname:
+            return ( "config", None )
+        if fname[0] in [ "/", "." ]:
+            found = [ fname ]
+        else:
+            found, _ = _resolve_config_file(
+                            fname, conf.default_conf_file_locations,
+                            conf.conf_file_mode == CONF_FILE_MERGE_ALL)
+        return ( "config", fname,
+                 tuple([ ( fn, _file_token(fn) ) for fn in found ]) )
+
+    def load(self, conf, args):
+        conf._process_config_file(self._fname(conf, args),
+                                  conf.default_allow_unknown_params)
+        self.config_files       = conf.config_files
+        self.config_files_tried = conf.config_files_tried
+        return None
+
+
+class EnvSource(Source):
+    """
+    Environment variables, named by the conffile names of the parameters and
+    a prefix. By default, the Conf's default_env_prefix is used.
+
+    """
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+
+    def token(self, conf, args):
+        prefix  = self.prefix or conf.default_env_prefix or ""
+        environ = os.environ
+        return ( "env", prefix,
+                 tuple([ environ.get(prefix+name)
+                         for name in conf.params_by_conffile_name ]) )
+
+    def load(self, conf, args):
+        conf._process_env_vars(self.prefix)
+        return None
+
+
+class ArgvSource(Source):
+    """
+    Command line options. Unless 'args' are given here, the arguments passed
+    to acquire() are used.
+
+    """
+    def __init__(self, args=None):
+        self.args = args
+
+    def token(self, conf, args):
+        return ( "argv", tuple(self.args if self.args is not None else args) )
+
+    def load(self, conf, args):
+        return conf._process_cmd_line(self.args if self.args is not None
+                                      else args)
+
+
+class DictSource(Source):
+    """
+    A dictionary of values, keyed by parameter name, or by conffile name if
+    'by_conffile_name' is set.
+
+    """
+    def __init__(self, values, by_conffile_name=False):
+        self.values           = values
+        self.by_conffile_name = by_conffile_name
+
+    def token(self, conf, args):
+        try:
+            return ( "dict", json.dumps(self.values, sort_keys=True) )
+        except (TypeError, ValueError):
+            return None
+
+    def load(self, conf, args):
+        if not self.by_conffile_name:
+            return Source.load(self, conf, args)
+        conf._apply_config_mapping(self.values, "-Dictionary",
+                                   conf.default_allow_unknown_params)
+        return None
+
+    def read(self, conf, args):
+        return self.values
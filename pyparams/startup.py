@@ -0,0 +1,264 @@
+"""
+Measure the startup cost of pyparams for a schema.
+
+    python -m pyparams profile [--repeat N] [--stacks FILE] SCHEMA [-- ARGS]
+
+A program's startup time is spent importing pyparams and its optional YAML
+library, building the Conf object of the schema module and running the
+stages of acquire(). Imports can only be measured in a fresh interpreter,
+so every measurement runs in a child process, which does exactly what the
+program would do, with the same sys.path, working directory and
+environment:
+
+    - import the YAML library that pyparams uses (if any),
+    - import pyparams,
+    - import the schema module (which builds the Conf object),
+    - call acquire(ARGS) on the Conf object.
+
+Times are the best of several runs. Allocations are measured in a separate
+run with tracemalloc (Python 3.4 or later), since tracing slows down every
+allocation. If a stacks file is given, a third run traces every function
+call with sys.setprofile() and writes the time spent in each call stack in
+the collapsed format of flamegraph.pl and similar tools:
+
+    import pyparams;pyparams:<module>;pyparams.metrics:<module> 1234
+
+The counts are microseconds. Only the standard library is used.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from pyparams import ParamError
+
+
+# The program run by the child processes. It must not import pyparams
+# before the import is measured.
+_DRIVER = r'''
+import sys, json, time, importlib
+_clock = getattr(time, "perf_counter", time.time)
+mode, out_name, schema = sys.argv[1:4]
+args = sys.argv[4:]
+stages = []
+stacks = {}
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def _label(frame):
+    return "%s:%s" % (frame.f_globals.get("__name__", "?"),
+                      frame.f_code.co_name)
+
+def _traced(name, fn):
+    stack = [ name ]
+    last  = [ _clock() ]
+    def tracer(frame, event, arg):
+        now = _clock()
+        key = ";".join(stack)
+        stacks[key] = stacks.get(key, 0) + now - last[0]
+        if event == "call":
+            stack.append(_label(frame))
+        elif event == "c_call":
+            stack.append("%s:%s" % (getattr(arg, "__module__", None) or
+                                    "builtins", arg.__name__))
+        elif len(stack) > 1:
+            stack.pop()
+        last[0] = _clock()
+    sys.setprofile(tracer)
+    try:
+        return fn()
+    finally:
+        sys.setprofile(None)
+
+def measure(name, fn, optional=False):
+    stage = { "name" : name, "parent" : None, "seconds" : None,
+              "allocated" : None, "error" : None }
+    stages.append(stage)
+    if mode == "memory" and tracemalloc:
+        before = tracemalloc.get_traced_memory()[0]
+    t = _clock()
+    try:
+        if mode == "stacks":
+            return _traced(name, fn)
+        return fn()
+    except ImportError as e:
+        stage["error"] = "not installed" if optional else str(e)
+    except SystemExit as e:
+        stage["error"] = "exited with status %s" % e.code
+    except Exception as e:
+        stage["error"] = str(e) or type(e).__name__
+    finally:
+        stage["seconds"] = _clock() - t
+        if mode == "memory" and tracemalloc:
+            stage["allocated"] = tracemalloc.get_traced_memory()[0] - before
+
+if mode == "memory" and tracemalloc:
+    tracemalloc.start()
+
+# The same YAML library that pyparams picks.
+if measure("import ruamel.yaml",
+           lambda: importlib.import_module("ruamel.yaml"), True) is None:
+    measure("import yaml", lambda: importlib.import_module("yaml"), True)
+pyparams = measure("import pyparams",
+                   lambda: importlib.import_module("pyparams"))
+
+conf = None
+if pyparams is not None:
+    # Schema and Conf objects are built while the schema module is
+    # imported. Their construction time is reported separately.
+    build  = { "name" : "building Conf", "parent" : None, "seconds" : 0.0,
+               "allocated" : None, "error" : None }
+    depth  = [ 0 ]
+    def timed_init(init):
+        def wrapper(self, *a, **kw):
+            depth[0] += 1
+            t = _clock()
+            try:
+                return init(self, *a, **kw)
+            finally:
+                depth[0] -= 1
+                if not depth[0]:
+                    build["seconds"] += _clock() - t
+        return wrapper
+    saved = ( pyparams.Schema.__init__, pyparams.Conf.__init__ )
+    pyparams.Schema.__init__ = timed_init(saved[0])
+    pyparams.Conf.__init__   = timed_init(saved[1])
+    module_name, _, attr = schema.partition(":")
+    name   = "import %s" % module_name
+    module = measure(name, lambda: importlib.import_module(module_name))
+    pyparams.Schema.__init__, pyparams.Conf.__init__ = saved
+    build["parent"] = name
+    stages.append(build)
+    if module is not None:
+        conf = getattr(module, attr or "CONF", None)
+        if not isinstance(conf, pyparams.Conf):
+            stages[-2]["error"] = "Not a Conf object."
+            conf = None
+
+if conf is not None:
+    # The stages of acquire() are timed by wrapping the load() methods of
+    # the sources, or the methods of the Conf class: acquire() runs them on
+    # a shadow Conf object.
+    if conf.sources is not None:
+        parts = [ ( source, "load", "source %s" % type(source).__name__ )
+                  for source in conf.sources ]
+    else:
+        cls   = pyparams.Conf
+        parts = [ ( cls, "_process_config_file", "config file" ),
+                  ( cls, "_process_env_vars",    "environment" ),
+                  ( cls, "_process_cmd_line",    "command line" ) ]
+    timed = []
+    def timed_part(fn, stage):
+        def wrapper(*a, **kw):
+            t = _clock()
+            try:
+                return fn(*a, **kw)
+            finally:
+                stage["seconds"] += _clock() - t
+        return wrapper
+    for obj, meth, label in parts:
+        stage = { "name" : label, "parent" : "acquire()", "seconds" : 0.0,
+                  "allocated" : None, "error" : None }
+        timed.append(stage)
+        setattr(obj, meth, timed_part(getattr(obj, meth), stage))
+    measure("acquire()", lambda: conf.acquire(args))
+    stages.extend(timed)
+
+with open(out_name, "w") as f:
+    json.dump({ "stages" : stages, "stacks" : stacks,
+                "tracemalloc" : tracemalloc is not None }, f)
+'''
+
+
+def _run_driver(mode, schema, args, python):
+    """
+    Run the driver program in a child process and return its results.
+
+    """
+    fd, out_name = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ os.path.abspath(p)
+                                          for p in sys.path if p ] +
+                                        [ env.get("PYTHONPATH", "") ])
+    try:
+        proc = subprocess.Popen([ python, "-c", _DRIVER, mode, out_name,
+                                  schema ] + list(args),
+                                env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        if proc.returncode:
+            lines = err.decode("utf-8", "replace").strip().splitlines()
+            raise ParamError("-Profile %s" % schema,
+                             "Child process failed: %s" %
+                                    (lines[-1] if lines else proc.returncode))
+        with open(out_name, "r") as f:
+            return json.load(f)
+    finally:
+        os.remove(out_name)
+
+
+def profile_startup(schema, args=(), repeat=3, stacks_file=None,
+                    python=None):
+    """
+    Measure the startup of a program that uses the given schema, which is
+    named like 'package.module[:NAME]', and calls acquire(args).
+
+    Returns a list of stages, each a dictionary with 'name', 'parent' (the
+    name of the enclosing stage or None), 'seconds' (the best of 'repeat'
+    runs), 'allocated' (bytes still allocated at the end of the stage, or
+    None without tracemalloc) and 'error'.
+
+    If 'stacks_file' is given, the collapsed call stacks are written to it.
+
+    """
+    python = python or sys.executable
+    stages = None
+    for _ in range(max(1, repeat)):
+        run = _run_driver("time", schema, args, python)["stages"]
+        if stages is None:
+            stages = run
+        else:
+            for stage, other in zip(stages, run):
+                stage["seconds"] = min(stage["seconds"], other["seconds"])
+
+    memory = _run_driver("memory", schema, args, python)
+    if memory["tracemalloc"]:
+        for stage, other in zip(stages, memory["stages"]):
+            stage["allocated"] = other["allocated"]
+
+    if stacks_file:
+        stacks = _run_driver("stacks", schema, args, python)["stacks"]
+        with open(stacks_file, "w") as f:
+            for key in sorted(stacks):
+                usecs = int(round(stacks[key] * 1000000))
+                if usecs:
+                    f.write("%s %d\n" % (key, usecs))
+    return stages
+
+
+def format_report(stages):
+    """
+    Return the stages as a table, one line per stage, with a total.
+
+    """
+    lines = [ "%-40s %10s %14s" % ("stage", "time", "allocated") ]
+    total = 0.0
+    for stage in stages:
+        indent = "  " if stage["parent"] else ""
+        if stage["parent"] is None:
+            total += stage["seconds"]
+        if stage["error"]:
+            cols = "  %s" % stage["error"]
+        else:
+            cols = " %7.2f ms" % (stage["seconds"] * 1000.0)
+            if stage["allocated"] is not None:
+                cols += " %10.1f KiB" % (stage["allocated"] / 1024.0)
+        lines.append("%-40s%s" % (indent + stage["name"], cols))
+    lines.append("%-40s %7.2f ms" % ("total", total * 1000.0))
+    return "\n".join(lines) + "\n"
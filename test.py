@@ -1,19 +1,65 @@
+import gc
+import getopt
+import io
+import json
+import multiprocessing
 import os
+import re
 import shutil
+import socket
+import signal
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
+import pyparams
 from pyparams import ( _bool_check,
                        _str_list_check,
                        _str_dict_check,
+                       _duration_check,
+                       _bytes_check,
+                       _flag_check,
+                       _format_duration,
+                       _format_bytes,
                        _Param,
+                       _OptionParser,
+                       _yaml_load_all,
+                       FileFormatException,
                        ParamError,
+                       ParamIgnored,
                        PARAM_TYPE_BOOL,
                        PARAM_TYPE_INT,
                        PARAM_TYPE_STR_LIST,
                        PARAM_TYPE_STR_DICT,
-                       Conf
+                       PARAM_TYPE_FLOAT,
+                       PARAM_TYPE_DURATION,
+                       PARAM_TYPE_BYTES,
+                       PARAM_TYPE_FLAG,
+                       Rollout,
+                       ParamType,
+                       register_param_type,
+                       get_param_type,
+                       CONF_FILE_MERGE_ALL,
+                       CONF_FORMAT_DEFAULT,
+                       CONF_FORMAT_JSON,
+                       CONF_FORMAT_YAML,
+                       FEED_ERROR_SKIP_RECORD,
+                       FEED_ERROR_SKIP_BATCH,
+                       FEED_BACKLOG_COALESCE,
+                       Conf,
+                       Schema
                      )
+import pyparams.shared
+from pyparams.shared import SharedConf
+import pyparams.daemon
+from pyparams.daemon import ConfDaemon, DaemonConf
+from pyparams.sources import ( Source, FileSource, DirectorySource,
+                               ConfigFileSource, EnvSource, ArgvSource,
+                               DictSource )
+from pyparams import __main__ as pyparams_main
+from pyparams import codegen
 
 
 class LowLevelFunctionTests(unittest.TestCase):
@@ -57,6 +103,80 @@ class LowLevelFunctionTests(unittest.TestCase):
         self.assertEqual({ 'foo' : [ '123', 'ddd' ], 'bar' : 'ggg' },
                          _str_dict_check( "{ foo : 123 , ddd ; bar : ggg }"))
 
+    def test_duration_check(self):
+        """
+        Test the function that converts durations to seconds.
+
+        """
+        for v, secs in [ ( 30, 30.0 ), ( 1.5, 1.5 ), ( "30", 30.0 ),
+                         ( "30s", 30.0 ), ( "100ms", 0.1 ), ( "1.5h", 5400.0 ),
+                         ( "1h 30m", 5400.0 ), ( " 2d3s ", 172803.0 ),
+                         ( "1w", 604800.0 ), ( "250us", 0.00025 ) ]:
+            self.assertAlmostEqual(secs, _duration_check(v))
+        for v in [ "", "s", "10x", "1h-30m", "-1s", "1.2.3s" ]:
+            self.assertRaises(ParamError, _duration_check, v)
+        for secs, s in [ ( 30.0, "30s" ), ( 5400.0, "90m" ), ( 0.1, "100ms" ),
+                         ( 604800.0, "1w" ), ( 1.25, "1250ms" ),
+                         ( 0.0, "0s" ) ]:
+            self.assertEqual(s, _format_duration(secs))
+
+    def test_bytes_check(self):
+        """
+        Test the function that converts sizes to bytes.
+
+        """
+        for v, num in [ ( 1024, 1024 ), ( "1024", 1024 ), ( "1024B", 1024 ),
+                        ( "10kB", 10000 ), ( "10K", 10000 ),
+                        ( "1.5GB", 1500000000 ), ( "512MiB", 512*1024**2 ),
+                        ( "4Ki", 4096 ), ( " 2 TiB ", 2*1024**4 ),
+                        ( "2.0", 2 ), ( "0.5kB", 500 ) ]:
+            self.assertEqual(num, _bytes_check(v))
+        for v in [ "", "MB", "10XB", "10 MiBs", "-1", "1.5", "1.5B" ]:
+            self.assertRaises(ParamError, _bytes_check, v)
+        for num, s in [ ( 512*1024**2, "512MiB" ), ( 10000, "10kB" ),
+                        ( 1023, "1023B" ), ( 0, "0B" ) ]:
+            self.assertEqual(s, _format_bytes(num))
+
+    def test_flag_check(self):
+        """
+        Test the function that converts feature flags, and the bucketing of
+        keys.
+
+        """
+        for v, flag in [ ( True, Rollout(100) ), ( "off", Rollout(0) ),
+                         ( 5, Rollout(5) ), ( " 2.5% ", Rollout(2.5) ),
+                         ( "{ percent:5% ; allow:bob,alice ; salt:x }",
+                           Rollout(5, [ "alice", "bob" ], "x") ),
+                         ( { "allow" : "bob" }, Rollout(0, [ "bob" ]) ),
+                         ( "TRUE", Rollout(100) ), ( "no", Rollout(0) ) ]:
+            self.assertEqual(flag, _flag_check(v))
+        # Numeric strings are percentages, the same as numbers
+        for v in [ 0, 1, 1.5 ]:
+            self.assertEqual(Rollout(v), _flag_check(str(v)))
+            self.assertEqual(_flag_check(v), _flag_check(str(v)))
+        for v in [ "", "abc", "y", "{ foo:1 }", "{ percent:x }" ]:
+            self.assertRaises(Exception, _flag_check, v)
+
+        # Buckets are stable (the same in every process and Python version)
+        # and independent for different salts.
+        self.assertEqual([ 1, 2, 5, 6, 7, 8, 9, 13, 16, 19 ],
+                         [ k for k in range(20) if Rollout(50).enabled(k) ])
+        self.assertEqual([ 1, 2, 4, 6, 8, 11, 18 ],
+                         [ k for k in range(20)
+                                if Rollout(50, salt="exp").enabled(
+                                                        u"user-%d" % k) ])
+        keys = [ "user-%d" % i for i in range(20000) ]
+        five = set([ k for k in keys if Rollout(5).enabled(k) ])
+        ten  = set([ k for k in keys if Rollout(10).enabled(k) ])
+        half = set([ k for k in keys if Rollout(50).enabled(k) ])
+        salt = set([ k for k in keys if Rollout(50, salt="x").enabled(k) ])
+        self.assertTrue(900 < len(five) < 1100)
+        self.assertTrue(five < ten)
+        self.assertTrue(4500 < len(half & salt) < 5500)
+        self.assertTrue(Rollout(0, [ "42" ]).enabled(42))
+        self.assertTrue(Rollout(0, [ "42" ]).enabled(b"42"))
+        self.assertFalse(Rollout(0, [ "42" ]).enabled(43))
+
     def test_param_error_class(self):
         """
         Test the message formatting in the ParamError class.
@@ -222,6 +342,271 @@ class ParamClassTests(unittest.TestCase):
                                 "'A' is not in the allowed range.",
                                 p.validate, "a,f,A")
 
+    def test_param_numeric_types(self):
+        """
+        Testing float, duration and bytes parameters.
+
+        """
+        p = _Param(name='foo', param_type=PARAM_TYPE_FLOAT, default="0.5",
+                   allowed_range=dict(min=0, max="1.5"))
+        self.assertEqual(0.5, p.value)
+        self.assertEqual(1.25, p.validate("1.25"))
+        self.assertRaisesRegexp(ParamError,
+                                "'2.0' is not in the allowed range.",
+                                p.validate, 2)
+
+        p = _Param(name='foo', param_type=PARAM_TYPE_DURATION, default="30s",
+                   allowed_range=dict(min="100ms", max="1h"),
+                   cmd_line=( None, "timeout" ),
+                   doc_spec=dict(text="Timeout."))
+        self.assertEqual(30.0, p.value)
+        self.assertEqual(90.0, p.validate("1m30s"))
+        self.assertEqual(60.0, p.validate(60))
+        self.assertRaisesRegexp(ParamError,
+                                "'2h' is not in the allowed range.",
+                                p.validate, "2h")
+        self.assertRaisesRegexp(ParamError,
+                                "Cannot convert '1x' to type 'duration'.",
+                                p.validate, "1x")
+        self.assertTrue("Default value: 30s\n" in p.doc()[1])
+
+        p = _Param(name='foo', param_type=PARAM_TYPE_BYTES, default="512MiB",
+                   allowed_range=dict(min="1kB", max=None),
+                   cmd_line=( None, "size" ),
+                   doc_spec=dict(text="Cache size."))
+        self.assertEqual(512*1024**2, p.value)
+        self.assertEqual(1500, p.validate("1.5kB"))
+        self.assertRaisesRegexp(ParamError,
+                                "'999B' is not in the allowed range.",
+                                p.validate, 999)
+        self.assertTrue("Default value: 512MiB\n" in p.doc()[1])
+
+    def test_param_custom_type(self):
+        """
+        Testing registration and use of a custom parameter type.
+
+        """
+        def convert_ports(value, param):
+            if isinstance(value, frozenset):
+                return value
+            ports = set()
+            for r in str(value).split(","):
+                lo, _, hi = r.strip().partition("-")
+                ports.update(range(int(lo), int(hi or lo) + 1))
+            return frozenset(ports)
+        def convert_ports_batch(values, param):
+            batch_calls.append(values)
+            return [ convert_ports(v, param) for v in values ]
+        def validate_ports(value, param):
+            if max(value) > 65535:
+                raise ParamError(param.name, "Port number too large.")
+        def doc_ports(value):
+            return ",".join(str(p) for p in sorted(value))
+
+        batch_calls = []
+        self.addCleanup(pyparams._param_types.pop, "port-set", None)
+        register_param_type(ParamType("port-set", convert_ports,
+                                      convert_batch=convert_ports_batch,
+                                      validate=validate_ports,
+                                      doc=doc_ports),
+                            replace=True)
+        self.assertTrue(get_param_type("port-set").validate is validate_ports)
+        self.assertRaisesRegexp(ParamError,
+                                "Parameter type port-set: Already registered.",
+                                register_param_type,
+                                get_param_type("port-set"))
+        self.assertRaisesRegexp(ParamError,
+                                "Parameter type xyz: Not registered.",
+                                get_param_type, "xyz")
+
+        conf = Conf({ "ports" : { "param_type"     : "port-set",
+                                  "default"        : "80,443",
+                                  "allowed_values" : [ "80,443", "8000-8002",
+                                                       "70000" ],
+                                  "doc_spec"       : { "text" : "Ports." } } })
+        self.assertEqual([ [ "80,443", "8000-8002", "70000" ] ], batch_calls)
+        self.assertEqual(frozenset([ 80, 443 ]), conf.get("ports"))
+        conf._process_cmd_line([ "--ports", "8000-8002" ])
+        self.assertEqual(frozenset([ 8000, 8001, 8002 ]), conf.get("ports"))
+        self.assertRaisesRegexp(ParamError,
+                                "'8000' is not one of the allowed values.",
+                                conf.set, "ports", "8000")
+        self.assertRaisesRegexp(ParamError,
+                                "Parameter 'ports': Port number too large.",
+                                conf.set, "ports", "70000")
+        self.assertRaisesRegexp(ParamError,
+                                "Cannot convert 'x' to type 'port-set'.",
+                                conf.set, "ports", "x")
+        self.assertTrue("Default value: 80,443\n" in conf.make_doc())
+
+        # List values, as they come from YAML or JSON config files, are
+        # converted by the batch converter of list types.
+        conf = Conf({ "lst" : { "param_type" : PARAM_TYPE_STR_LIST,
+                                "default"    : "a,b" } })
+        conf.set("lst", [ 1, "x" ])
+        self.assertEqual([ "1", "x" ], conf.get("lst"))
+
+    def test_param_allowed_values_file(self):
+        """
+        Test allowed values, which are listed in a file.
+
+        """
+        dir_name = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(dir_name, "regions")
+            with open(fname, "w") as f:
+                f.write("\n".join([ "r%05d" % i
+                                    for i in range(0, 20000, 2) ]) + "\n")
+            unsorted = os.path.join(dir_name, "unsorted")
+            with open(unsorted, "w") as f:
+                f.write("b\na\n\nc")
+            blanks = os.path.join(dir_name, "blanks")
+            with open(blanks, "wb") as f:
+                f.write(b"a\r\nb\r\n\r\nc\r\nd\r\n")
+            crlf = os.path.join(dir_name, "crlf")
+            with open(crlf, "wb") as f:
+                f.write(b"a\r\nb\r\nc\r\nd\r\n")
+            numbers = os.path.join(dir_name, "numbers")
+            with open(numbers, "w") as f:
+                f.write("1\n 20\n300\n")
+
+            # Without a default, the file is not read until a value is
+            # checked.
+            p = _Param("foo", allowed_values_file=fname,
+                       cmd_line=( "f", "foo" ))
+            self.assertTrue(p._value_index._set is None)
+            self.assertEqual("r00010", p.validate("r00010"))
+            self.assertTrue(isinstance(p._value_index._set, frozenset))
+            self.assertRaisesRegexp(ParamError,
+                                    "'r00011' is not one of the allowed "
+                                    "values.", p.validate, "r00011")
+            self.assertTrue("Allowed values: 10000 values, listed in %s" %
+                            fname in p.doc()[1])
+
+            p = _Param("foo", param_type=PARAM_TYPE_INT,
+                       allowed_values_file=numbers)
+            self.assertEqual(20, p.validate("20"))
+            self.assertRaises(ParamError, p.validate, 2)
+
+            # The default value is checked against the file.
+            p = _Param("foo", default="r00002", allowed_values_file=fname)
+            self.assertEqual("r00002", p.value)
+            self.assertRaisesRegexp(ParamError,
+                                    "'xyz' is not one of the allowed values.",
+                                    _Param, "foo", default="xyz",
+                                    allowed_values_file=fname)
+
+            # Large files are searched in place, if they are sorted.
+            old_threshold = pyparams._VALUES_MMAP_THRESHOLD
+            pyparams._VALUES_MMAP_THRESHOLD = 0
+            try:
+                p = _Param("foo", allowed_values_file=fname)
+                for i in [ 0, 2, 10000, 19998 ]:
+                    self.assertEqual("r%05d" % i, p.validate("r%05d" % i))
+                for v in [ "r00001", "r19999", "", "a", "z", "r0000" ]:
+                    self.assertRaises(ParamError, p.validate, v)
+                self.assertTrue(p._value_index._set is None)
+                self.assertEqual(10000, len(p._value_index))
+
+                p = _Param("foo", allowed_values_file=unsorted)
+                self.assertEqual("a", p.validate("a"))
+                self.assertRaises(ParamError, p.validate, "")
+                self.assertEqual(frozenset([ "a", "b", "c" ]),
+                                 p._value_index._set)
+
+                # CRLF line ends are stripped. Files with empty lines are
+                # not searched in place.
+                p = _Param("foo", allowed_values_file=crlf)
+                for v in [ "a", "b", "c", "d" ]:
+                    self.assertEqual(v, p.validate(v))
+                self.assertRaises(ParamError, p.validate, "")
+                self.assertRaises(ParamError, p.validate, "a\r")
+                self.assertTrue(p._value_index._set is None)
+                index = p._value_index
+                p.allowed_values_file = blanks
+                self.assertTrue(index._mm is None)
+                for v in [ "a", "b", "c", "d" ]:
+                    self.assertEqual(v, p.validate(v))
+                self.assertEqual(frozenset([ "a", "b", "c", "d" ]),
+                                 p._value_index._set)
+            finally:
+                pyparams._VALUES_MMAP_THRESHOLD = old_threshold
+
+            # Changing the file takes effect.
+            p.allowed_values_file = numbers
+            self.assertRaises(ParamError, p.validate, "a")
+
+            p = _Param("foo", allowed_values_file=fname+"-missing")
+            self.assertRaisesRegexp(ParamError,
+                                    "Cannot read allowed values file",
+                                    p.validate, "a")
+            self.assertRaisesRegexp(ParamError, "Only one of allowed values",
+                                    _Param, "foo", allowed_values=[ "a" ],
+                                    allowed_values_file=fname)
+            self.assertRaisesRegexp(ParamError, "not allowed for boolean",
+                                    _Param, "foo", param_type=PARAM_TYPE_BOOL,
+                                    allowed_values_file=fname)
+        finally:
+            shutil.rmtree(dir_name)
+
+    def test_param_validate_cache(self):
+        """
+        Testing the cache of converted and validated values.
+
+        """
+        p = _Param(name='foo', param_type=PARAM_TYPE_STR_DICT,
+                   default="{ a : 1 }", allowed_keys=[ "a", "b" ],
+                   cache_size=2)
+        self.assertEqual((0, 0, 2, 0), p.cache_info())
+        d = p.validate("{ a : 1, 2 ; b : x }")
+        self.assertEqual({ "a" : [ "1", "2" ], "b" : "x" }, d)
+
+        # Changing a result doesn't change the cached one
+        d["a"].append("3")
+        d["c"] = "y"
+        d2 = p.validate("{ a : 1, 2 ; b : x }")
+        self.assertEqual({ "a" : [ "1", "2" ], "b" : "x" }, d2)
+        d2["a"].append("3")
+        self.assertEqual({ "a" : [ "1", "2" ], "b" : "x" },
+                         p.validate("{ a : 1, 2 ; b : x }"))
+        self.assertEqual((2, 1, 2, 1), p.cache_info())
+
+        # Errors and unhashable values are not cached
+        for i in range(2):
+            self.assertRaisesRegexp(ParamError,
+                                    "'c' is not an allowable key value.",
+                                    p.validate, "{ c : 1 }")
+        self.assertEqual({ "a" : "1" }, p.validate({ "a" : "1" }))
+        self.assertEqual((2, 1, 2, 1), p.cache_info())
+
+        # Least recently used entries are evicted
+        p.validate("{ a : 1 }")
+        p.validate("{ b : 1 }")
+        p.validate("{ a : 1 }")
+        self.assertEqual((3, 3, 2, 2), p.cache_info())
+        p.validate("{ a : 1, 2 ; b : x }")
+        self.assertEqual((3, 4, 2, 2), p.cache_info())
+
+        # Changing the definition invalidates the cache
+        p.allowed_keys = [ "b" ]
+        self.assertEqual((0, 0, 2, 0), p.cache_info())
+        self.assertRaisesRegexp(ParamError,
+                                "'a' is not an allowable key value.",
+                                p.validate, "{ a : 1 }")
+
+        # Equal values of different types are cached separately
+        p = _Param(name='foo', cache_size=10)
+        self.assertEqual("1", p.validate(1))
+        self.assertEqual("True", p.validate(True))
+
+        conf = Conf({ "foo" : { "param_type" : PARAM_TYPE_STR_LIST,
+                                "default"    : "a,b",
+                                "cache_size" : 10 },
+                      "bar" : { "default" : "x" } })
+        conf.set("foo", "a,b")
+        conf.set("foo", "a,b")
+        self.assertEqual({ "foo" : (1, 1, 10, 1) }, conf.cache_info())
+
     def test_param_getopt_str_output(self):
         """
         Testing that we create correct specs for getopt.
@@ -313,6 +698,49 @@ class ParamClassTests(unittest.TestCase):
                                     "    Conf file equivalent: FOOBAR\n"))
 
 
+def _private_dirty_kb():
+    """
+    Return the private dirty memory of this process in KiB, or None if it
+    cannot be determined.
+
+    """
+    for fname in [ "/proc/self/smaps_rollup", "/proc/self/smaps" ]:
+        try:
+            with open(fname) as f:
+                return sum([ int(line.split()[1]) for line in f
+                             if line.startswith("Private_Dirty:") ])
+        except IOError:
+            pass
+    return None
+
+
+def _dirtied_by_forked_reads(conf, names):
+    """
+    Fork a worker, which reads the parameters and runs a garbage collection
+    if gc.freeze() exists. Returns the private memory (KiB) it gained.
+
+    """
+    r, w = os.pipe()
+    pid  = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            get    = conf.get
+            before = _private_dirty_kb()
+            for name in names:
+                get(name)
+            if hasattr(gc, "freeze"):
+                gc.collect()
+            os.write(w, str(_private_dirty_kb() - before).encode("ascii"))
+        finally:
+            os._exit(0)
+    os.close(w)
+    with os.fdopen(r, "rb") as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return int(result)
+
+
 class ConfigClassTests(unittest.TestCase):
     """
     Tests for the Config class.
@@ -543,6 +971,99 @@ class ConfigClassTests(unittest.TestCase):
         p.value = "foo"
         self.assertEqual(conf.get_by_conffile_name("ZIP_BAR"), "foo")
 
+    def test_conf_add_many(self):
+        """
+        Testing adding many parameters in one go.
+
+        """
+        conf = Conf(self.sample_param_dict)
+        conf.add_many(dict(("opt-%d" % i, { "default"  : str(i),
+                                            "cmd_line" : ( None, "opt-%d" % i )
+                                          }) for i in range(1000)))
+        self.assertEqual("999", conf.get("opt-999"))
+        self.assertEqual("5", conf.get_by_conffile_name("OPT_5"))
+        conf.acquire([ "--opt-7", "x", "-g" ])
+        self.assertEqual("x", conf.get("opt-7"))
+
+        # All conflicts are reported, and nothing is added.
+        try:
+            conf.add_many({
+                "new-1" : { "cmd_line" : ( 'f', None ) },
+                "new-2" : { "conffile" : "OPT_1", "cmd_line" : None },
+                "new-3" : { "cmd_line" : ( None, "same" ) },
+                "new-4" : { "cmd_line" : ( None, "same" ) },
+                "new-5" : { "param_type" : "FOO", "cmd_line" : None },
+                "new-6" : { "FOO" : 1 },
+                "new-7" : { "cmd_line" : None },
+                "opt-1" : { } })
+            self.fail("No exception raised")
+        except ParamError as e:
+            self.assertEqual(6, len(e.errors))
+            self.assertTrue(str(e).startswith("Parameter definitions: 6 "
+                                              "errors: "))
+            msgs = sorted([ str(err) for err in e.errors ])
+            self.assertEqual([
+                "Parameter 'FOO': Invalid parameter config attribute.",
+                "Parameter 'OPT_1': Duplicate definition.",
+                "Parameter 'new-1': Short option '-f' already in use.",
+                "Parameter 'new-5': Unknown parameter type 'FOO'.",
+                "Parameter 'opt-1': Duplicate definition." ],
+                [ m for m in msgs if "--same" not in m ])
+            self.assertTrue("Long option '--same' already in use." in
+                            " ".join(msgs))
+        self.assertFalse("new-7" in conf.params)
+        self.assertFalse("new-3" in conf.params or "new-4" in conf.params)
+
+        # A single error is raised as it is.
+        self.assertRaisesRegexp(ParamError,
+                                "^Parameter 'new-1': Short option '-f' "
+                                "already in use.$",
+                                conf.add_many,
+                                { "new-1" : { "cmd_line" : ( 'f', None ) },
+                                  "new-7" : { "cmd_line" : None } })
+        conf.add_many({ "new-7" : { "cmd_line" : None } })
+        self.assertTrue("new-7" in conf.params)
+
+        conf = Conf(schema=conf.schema)
+        self.assertRaisesRegexp(ParamError, "Cannot add to a shared schema.",
+                                conf.add_many, {})
+
+    def test_conf_shared_schema(self):
+        """
+        Testing Conf objects that share a schema.
+
+        """
+        schema = Schema(self.sample_param_dict)
+        conf_a = Conf(schema=schema, default_env_prefix="A_")
+        conf_b = Conf(schema=schema, default_env_prefix="B_")
+        self.assertTrue(conf_a.params is conf_b.params)
+
+        conf_a.set("baz", 12)
+        self.assertEqual(12, conf_a.get("baz"))
+        self.assertEqual(123, conf_b.get("baz"))
+        self.assertEqual({ "baz" : 12 }, conf_a._values)
+        self.assertEqual({}, conf_b._values)
+        self.assertEqual(12, conf_a.get_by_conffile_name("BAZ"))
+        self.assertEqual(12, conf_a.items()["baz"])
+        self.assertEqual(123, conf_b.items()["baz"])
+
+        # Only values that differ from the default are stored
+        conf_a.set("baz", "123")
+        self.assertEqual({}, conf_a._values)
+        self.assertEqual(123, conf_a.get("baz"))
+
+        conf_b.acquire([ "-f", "foobar", "-g" ])
+        self.assertEqual("foobar", conf_b.get("foo"))
+        self.assertEqual("some-value", conf_a.get("foo"))
+
+        self.assertRaisesRegexp(ParamError,
+                                "Parameter 'xyz': Cannot add to a shared "
+                                "schema.",
+                                conf_a.add, "xyz")
+        self.assertRaisesRegexp(ParamError,
+                                "Specify either a param_dict or a schema.",
+                                Conf, self.sample_param_dict, schema=schema)
+
     def _make_file(self, buf):
         fname = self.dir_two_name+"/t1.conf"
         f = open(fname, "w")
@@ -611,6 +1132,234 @@ class ConfigClassTests(unittest.TestCase):
         self.assertEqual(d['bar'], "123")
         self.assertEqual(d['baz'], [ "foo", "bar", "blah", "fff" ])
 
+        # Values containing ': ' also parse as YAML, but are in the default
+        # format (example from the README).
+        fname = self._make_file("""
+        MY_DICT     { foo : 123 ;
+                      bar : aa, bb, cc;
+                      baz : This is a test ; # Trailing ; ignored in this case
+                    }
+        """)
+        conf = Conf(self.sample_param_dict)
+        with open(fname, "r") as f:
+            conf._parse_config_file(f)
+        self.assertEqual({ 'foo' : "123",
+                           'bar' : [ "aa", "bb", "cc" ],
+                           'baz' : "This is a test" }, conf.get('ddd'))
+
+        fname = self._make_file("""
+        MY_DICT { baz : 1 }
+        FOO a: b
+        """)
+        conf = Conf({ "ddd" : { "default"    : {},
+                                "conffile"   : "MY_DICT",
+                                "param_type" : PARAM_TYPE_STR_DICT },
+                      "foo" : { "default"    : "",
+                                "conffile"   : "FOO" } })
+        with open(fname, "r") as f:
+            conf._parse_config_file(f)
+        self.assertEqual({ 'baz' : "1" }, conf.get('ddd'))
+        self.assertEqual("a: b", conf.get('foo'))
+
+        # All errors are collected, with the line on which the value starts.
+        # Ignored and explicitly skipped parameters are not errors.
+        fname = self._make_file("""
+        FOO    1
+        BAZ    1234
+        MY_DICT {
+            bar : 1 ;
+            }
+        SKIPPED x
+        IGN     x
+        BAZ     12
+        """)
+        conf = Conf(dict(self.sample_param_dict,
+                         ign=dict(default="a", ignore=True)),
+                    ignore_config_file_params=[ "SKIPPED" ])
+        errors = []
+        with open(fname, "r") as f:
+            conf._parse_default_format_config_file(f, errors=errors)
+        self.assertEqual([ (2, "Unknown parameter 'FOO'."),
+                           (3, "Parameter 'baz': '1234' is not in the "
+                               "allowed range."),
+                           (4, "Parameter 'ddd': Mandatory key 'baz' not "
+                               "present.") ],
+                         errors)
+        self.assertEqual(12, conf.get('baz'))
+
+    def test_conf_configfile_locations(self):
+        """
+        Testing the search for config files in several locations.
+
+        """
+        one = os.path.join(self.dir_one_name, "t2.conf")
+        two = os.path.join(self.dir_two_name, "t2.conf")
+        locations = [ self.dir_one_name + "/does-not-exist",
+                      self.dir_two_name, self.dir_one_name ]
+        with open(two, "w") as f:
+            f.write("MY_PARAM foobar\nBAZ 12\n")
+        try:
+            conf = Conf(self.sample_param_dict,
+                        default_conf_file_locations=locations,
+                        default_allow_unset_values=True)
+            conf._process_config_file("t2.conf", False)
+            self.assertEqual([ two ], conf.config_files)
+            self.assertEqual([ self.dir_one_name + "/does-not-exist/t2.conf",
+                               two ], conf.config_files_tried)
+            self.assertEqual("foobar", conf.get("foo"))
+
+            # Only the first file is processed, unless all are merged.
+            with open(one, "w") as f:
+                f.write("BAZ 13\n")
+            conf._process_config_file("t2.conf", False)
+            self.assertEqual(12, conf.get("baz"))
+            conf = Conf(self.sample_param_dict,
+                        default_conf_file_locations=locations,
+                        conf_file_mode=CONF_FILE_MERGE_ALL)
+            conf._process_config_file("t2.conf", False)
+            self.assertEqual([ two, one ], conf.config_files)
+            self.assertEqual(one, conf.config_file)
+            self.assertEqual("foobar", conf.get("foo"))
+            self.assertEqual(13, conf.get("baz"))
+        finally:
+            for fname in [ one, two ]:
+                if os.path.exists(fname):
+                    os.unlink(fname)
+
+        self.assertRaisesRegexp(ParamError, "Unknown conf_file_mode 'x'.",
+                                Conf, conf_file_mode="x")
+
+    def test_conf_configfile_yaml(self):
+        """
+        Testing parsing of YAML config files.
+
+        """
+        fname = self._make_file("""
+MY_PARAM: xyz baz
+BAZ: 12
+MY_DICT: { baz : 1, foo : 2 }
+""")
+        conf = Conf(self.sample_param_dict)
+        with open(fname, "r") as f:
+            conf._parse_config_file(f)
+        self.assertEqual("xyz baz", conf.get('foo'))
+        self.assertEqual(12, conf.get('baz'))
+        self.assertEqual({ 'baz' : 1, 'foo' : 2 }, conf.get('ddd'))
+
+        # Multiple documents are applied as successive layers.
+        fname = self._make_file("""
+MY_PARAM: xyz baz
+BAZ: 12
+---
+---
+BAZ: 13
+GGG: yes
+""")
+        conf = Conf(self.sample_param_dict)
+        with open(fname, "r") as f:
+            conf._parse_config_file(f)
+        self.assertEqual("xyz baz", conf.get('foo'))
+        self.assertEqual(13, conf.get('baz'))
+        self.assertTrue(conf.get('ggg'))
+
+        # Both loaders return the same
+        with open(fname, "r") as f:
+            docs = _yaml_load_all(f)
+        with open(fname, "r") as f:
+            self.assertEqual(docs, _yaml_load_all(f, pure=True))
+
+        fname = self._make_file("""
+BAZ: 12
+---
+FOO: 1
+""")
+        conf = Conf(self.sample_param_dict)
+        with open(fname, "r") as f:
+            self.assertRaisesRegexp(ParamError,
+                                    "Line 4: Unknown parameter 'FOO'.",
+                                    conf._parse_config_file, f)
+        fname = self._make_file("BAZ: 1234\n")
+        with open(fname, "r") as f:
+            self.assertRaisesRegexp(ParamError,
+                                    "Line 1: Parameter 'baz': '1234' is "
+                                    "not in the allowed range.",
+                                    conf._parse_config_file, f)
+
+        # Errors are collected with the line of the key
+        fname = self._make_file("""
+BAZ: 1234
+---
+---
+MY_PARAM: xyz
+GGG: maybe
+MY_DICT:
+  baz: 1
+  xyz: 2
+""")
+        errors = []
+        with open(fname, "r") as f:
+            conf._parse_config_file(f, errors=errors)
+        errors = dict(errors)
+        self.assertEqual([ 2, 5, 6, 7 ], sorted(errors))
+        self.assertTrue("'1234' is not in the allowed range" in errors[2])
+        self.assertTrue("'xyz' is not one of the allowed values" in errors[5])
+        self.assertTrue("'maybe'" in errors[6])
+        self.assertTrue("'xyz'" in errors[7])
+
+    def test_conf_configfile_json(self):
+        """
+        Testing parsing of JSON config files.
+
+        """
+        fname = self._make_file("""
+{
+    "MY_PARAM" : "xyz baz",
+    "UNKNOWN"  : { "a" : [ 1, 2, { "b" : "}]\\"\\\\" } ], "c" : null },
+    "BAZ"      : 12,
+    "MY_\\u0044ICT" : { "baz" : "1", "foo" : [ "2", "3" ] },
+    "OTHER"    : -1.5e3
+}
+""")
+        conf = Conf(self.sample_param_dict, default_allow_unknown_params=True)
+        with open(fname, "r") as f:
+            conf._parse_config_file(f)
+        self.assertEqual("xyz baz", conf.get('foo'))
+        self.assertEqual(12, conf.get('baz'))
+        self.assertEqual({ 'baz' : '1', 'foo' : [ '2', '3' ] },
+                         conf.get('ddd'))
+
+        # Errors are reported with their line
+        conf = Conf(self.sample_param_dict)
+        with open(fname, "r") as f:
+            self.assertRaisesRegexp(ParamError,
+                                    "Line 4: Unknown parameter 'UNKNOWN'.",
+                                    conf._parse_config_file, f)
+        errors = []
+        with open(fname, "r") as f:
+            conf._parse_json_format_config_file(f, errors=errors)
+        self.assertEqual([ (4, "Unknown parameter 'UNKNOWN'."),
+                           (7, "Unknown parameter 'OTHER'.") ], errors)
+
+        # Malformed JSON is rejected before any value is set.
+        for buf in [ '{ "BAZ" : 12, "FOO" : [ 1, 2 }',
+                     '{ "BAZ" : 12 } x',
+                     '{ "BAZ" : 12, }',
+                     '[ 1 ]',
+                     '' ]:
+            conf = Conf(self.sample_param_dict)
+            fname = self._make_file(buf)
+            with open(fname, "r") as f:
+                self.assertRaises(FileFormatException,
+                                  conf._parse_json_format_config_file, f)
+            self.assertEqual(123, conf.get('baz'))
+
+        # Also works on file objects that can't be memory-mapped.
+        conf = Conf(self.sample_param_dict)
+        conf._parse_json_format_config_file(io.StringIO(u'{ "BAZ" : 77 }'))
+        self.assertEqual(77, conf.get('baz'))
+        conf._parse_json_format_config_file(io.StringIO(u'{}'))
+        self.assertEqual(77, conf.get('baz'))
+
     def test_conf_envvars(self):
         """
         Testing parsing of environment variables.
@@ -638,6 +1387,17 @@ class ConfigClassTests(unittest.TestCase):
         self.assertEqual("something-else", conf.get('foo'))
         self.assertTrue(conf.get('ggg'))
 
+        # Errors can be collected
+        os.environ['FOOBAR_BAZ'] = "xyz"
+        try:
+            errors = []
+            conf._process_env_vars(errors=errors)
+        finally:
+            del os.environ['FOOBAR_BAZ']
+        self.assertEqual([ ("FOOBAR_BAZ", "Parameter 'baz': Cannot convert "
+                                          "'xyz' to type 'integer'.") ],
+                         errors)
+
     def test_conf_cmdline(self):
         """
         Testing parsing of command line arguments.
@@ -687,6 +1447,559 @@ class ConfigClassTests(unittest.TestCase):
         self.assertEqual(d['baz'], ["1", "2", "3"])
         self.assertEqual(d['a'], "X  Y Z")
 
+    def test_conf_cmdline_parser(self):
+        """
+        Testing that the option parser behaves like getopt.
+
+        """
+        conf = Conf(self.sample_param_dict)
+        conf.add("some-other", cmd_line=( None, "some-other" ))
+        parser = _OptionParser(conf.params.values())
+        short_opts_str = "f:Q:b:g"
+        long_opts_list = [ "configfile=", "some-param=", "baz=",
+                           "some-other=" ]
+
+        for args in [ [],
+                      [ "-g", "pos1", "-f", "foo" ],
+                      [ "-gffoo", "--baz", "12", "--", "-g" ],
+                      [ "-gf", "foo", "-" ],
+                      [ "--some-p=x", "--ba=3", "--conf", "c", "pos" ],
+                      [ "--some-param=", "--configfile=a=b" ] ]:
+            opts, rest = parser.parse(args)
+            getopt_opts, getopt_rest = getopt.getopt(args, short_opts_str,
+                                                     long_opts_list)
+            self.assertEqual(rest, getopt_rest)
+            self.assertEqual(len(opts), len(getopt_opts))
+            for (param, value), (o, a) in zip(opts, getopt_opts):
+                self.assertTrue(o in [ "-%s" % param.cmd_line[0],
+                                       "--%s" % param.cmd_line[1] ])
+                self.assertEqual(value, a if param.name != "ggg" else None)
+
+        for args, msg in [
+                ( [ "--xyz" ],        "option --xyz not recognized" ),
+                ( [ "--some" ],       "option --some not a unique prefix" ),
+                ( [ "--baz" ],        "option --baz requires argument" ),
+                ( [ "-gf" ],          "option -f requires argument" ),
+                ( [ "-x" ],           "option -x not recognized" ),
+                ( [ "--=x" ],         "option -- not recognized" ) ]:
+            self.assertRaisesRegexp(ParamError, msg, parser.parse, args)
+
+        # Also with no long option or a single one.
+        for params in [ [], [ conf.params["baz"] ] ]:
+            for args, msg in [
+                    ( [ "--=x" ],     "option -- not recognized" ),
+                    ( [ "--x" ],      "option --x not recognized" ) ]:
+                self.assertRaisesRegexp(ParamError, msg,
+                                        _OptionParser(params).parse, args)
+        self.assertRaisesRegexp(ParamError, "option -- not recognized",
+                                conf.acquire, [ "--=x" ])
+
+        # Remaining positional arguments are returned
+        self.assertEqual([ "a", "-g" ],
+                         conf._process_cmd_line([ "-g", "a", "-g" ]))
+
+    def test_conf_subscribe(self):
+        """
+        Testing callbacks for changed parameter values.
+
+        """
+        conf = Conf(self.sample_param_dict,
+                    default_env_prefix="SUBTEST_",
+                    default_allow_unset_values=True)
+        calls = []
+        sub = conf.subscribe([ "foo", "baz" ], calls.append)
+        conf.subscribe("ggg", lambda changes: calls.append(("ggg", changes)))
+        self.assertRaisesRegexp(ParamError, "Parameter 'xyz': Unknown",
+                                conf.subscribe, [ "xyz" ], calls.append)
+
+        # Setting the same value again is not a change
+        conf.set("baz", 123)
+        conf.set("ddd", { "baz" : 1 })
+        self.assertEqual([], calls)
+
+        conf.set("baz", 12)
+        self.assertEqual([ { "baz" : ( 123, 12 ) } ], calls)
+
+        # All changes during acquire are reported in one call. Values that
+        # end up unchanged are not reported.
+        del calls[:]
+        os.environ["SUBTEST_MY_PARAM"] = "foobar"
+        os.environ["SUBTEST_BAZ"] = "50"
+        try:
+            conf.acquire([ "-b", "12", "--some-param", "something-else" ])
+        finally:
+            del os.environ["SUBTEST_MY_PARAM"]
+            del os.environ["SUBTEST_BAZ"]
+        self.assertEqual([ { "foo" : ( "some-value", "something-else" ) } ],
+                         calls)
+
+        # Callbacks can be handed to an executor
+        class Executor(object):
+            def __init__(self):
+                self.submitted = []
+            def submit(self, func, *args):
+                self.submitted.append((func, args))
+        executor = Executor()
+        del calls[:]
+        conf.unsubscribe(sub)
+        conf.subscribe("foo", calls.append, executor=executor)
+        conf.acquire([ "-g", "-f", "foobar" ])
+        self.assertEqual([ ("ggg", { "ggg" : ( None, True ) }) ], calls)
+        self.assertEqual([ (calls.append,
+                            ({ "foo" : ( "something-else", "foobar" ) },)) ],
+                         executor.submitted)
+
+        # A failed acquire doesn't report anything.
+        del calls[:]
+        del executor.submitted[:]
+        os.environ["SUBTEST_MY_PARAM"] = "some-value"
+        try:
+            self.assertRaises(ParamError, conf.acquire,
+                              [ "--baz", "not-a-number" ])
+        finally:
+            del os.environ["SUBTEST_MY_PARAM"]
+        self.assertEqual([], calls)
+        self.assertEqual([], executor.submitted)
+        conf.set("foo", "something-else")
+        self.assertEqual(1, len(executor.submitted))
+
+    def test_conf_follow(self):
+        """
+        Testing a live feed of updates from a pipe.
+
+        """
+        def feed(buf, **kwargs):
+            r, w = os.pipe()
+            os.write(w, buf)
+            os.close(w)
+            try:
+                return conf.follow(r, **kwargs)
+            finally:
+                os.close(r)
+
+        conf = Conf({ "num" : { "default" : 0,
+                                "param_type" : PARAM_TYPE_INT },
+                      "txt" : { "default" : "0" },
+                      "ign" : { "default" : None, "ignore" : True } })
+        calls = []
+        conf.subscribe([ "num", "txt" ], calls.append)
+
+        # Records that are available together form one batch, which is
+        # reported once. A last line without a newline is a record, too.
+        self.assertEqual(1, feed(b"NUM 1\n# comment\n\nTXT a\nIGN 1\n"
+                                 b"NUM 2"))
+        self.assertEqual({ "num" : 2, "txt" : "a" }, conf.items())
+        self.assertEqual([ { "num" : ( 0, 2 ), "txt" : ( "0", "a" ) } ],
+                         calls)
+        self.assertEqual("feed line 6", conf._origins["num"])
+        self.assertEqual(3, feed(b"NUM 3\nNUM 4\nNUM 5\n", max_batch=1))
+
+        # An error stops following. Nothing of the failed batch is applied.
+        self.assertRaisesRegexp(ParamError, "Line 2: Parameter 'num': "
+                                "Cannot convert 'x'",
+                                feed, b"TXT b\nNUM x\n")
+        self.assertRaisesRegexp(ParamError, "Line 1: Unknown parameter 'XYZ'",
+                                feed, b"XYZ 1\n")
+        self.assertRaisesRegexp(ParamError, "Line 1: Malformed line",
+                                feed, b"NUM\n")
+        self.assertEqual({ "num" : 5, "txt" : "a" }, conf.items())
+
+        # Errors can skip the record or the whole batch instead.
+        errors = []
+        self.assertEqual(1, feed(b"TXT b\nNUM x\nNUM 6\n", errors=errors,
+                                 on_error=FEED_ERROR_SKIP_RECORD))
+        self.assertEqual({ "num" : 6, "txt" : "b" }, conf.items())
+        self.assertEqual(0, feed(b"TXT c\nXYZ 1\n", errors=errors,
+                                 on_error=FEED_ERROR_SKIP_BATCH))
+        self.assertEqual(1, feed(b"TXT c\nXYZ 1\n", errors=errors,
+                                 on_error=FEED_ERROR_SKIP_BATCH,
+                                 allow_unknown_params=True))
+        self.assertEqual({ "num" : 6, "txt" : "c" }, conf.items())
+        self.assertEqual([ 2, 2 ], [ line for line, _ in errors ])
+
+        # JSON lines, with only the latest value of each parameter of a
+        # batch being validated.
+        self.assertEqual(1, feed(b'{ "NUM" : 7, "TXT" : "d" }\n'
+                                 b'{ "NUM" : "x" }\n{ "NUM" : 8 }\n',
+                                 format=CONF_FORMAT_JSON,
+                                 backlog=FEED_BACKLOG_COALESCE))
+        self.assertEqual({ "num" : 8, "txt" : "d" }, conf.items())
+        self.assertRaisesRegexp(ParamError, "Line 1: Not a JSON object",
+                                feed, b'[ 1 ]\n', format=CONF_FORMAT_JSON)
+        self.assertRaisesRegexp(ParamError, "Unsupported record format",
+                                feed, b"", format=CONF_FORMAT_YAML)
+
+        # Following a writer that is still running: Every batch becomes
+        # visible at once, readers never see half of one.
+        feed(b"NUM 0\nTXT 0\n")
+        r, w      = os.pipe()
+        published = []
+        torn      = []
+        stop      = threading.Event()
+        def read():
+            while not stop.is_set():
+                items = conf.items()
+                if items["txt"] != str(items["num"]):
+                    torn.append(items)
+        follower = threading.Thread(target=conf.follow, args=(r,),
+                                    kwargs={ "on_batch" : published.append,
+                                             "stop_event" : stop,
+                                             "poll_interval" : 0.01 })
+        reader = threading.Thread(target=read)
+        follower.start()
+        reader.start()
+        try:
+            for i in range(200):
+                os.write(w, ("NUM %d\nTXT %d\n" % (i, i)).encode("ascii"))
+            deadline = time.time() + 10
+            while conf.get("num") != 199:
+                if time.time() > deadline:
+                    self.fail("Follower didn't apply all records in time.")
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            follower.join(5)
+            reader.join(5)
+            os.close(r)
+            os.close(w)
+        self.assertFalse(follower.is_alive())
+        self.assertEqual([], torn)
+        self.assertTrue(published)
+        self.assertTrue(all([ c is conf for c in published ]))
+
+
+    def test_conf_write(self):
+        """
+        Testing writing the configuration in all formats.
+
+        """
+        param_dict = {
+            "foo"      : { "default" : "some value" },
+            "baz"      : { "default" : 1, "param_type" : PARAM_TYPE_INT },
+            "ratio"    : { "default" : 0.5, "param_type" : PARAM_TYPE_FLOAT },
+            "timeout"  : { "default" : "30s",
+                           "param_type" : PARAM_TYPE_DURATION },
+            "size"     : { "default" : "1MiB",
+                           "param_type" : PARAM_TYPE_BYTES },
+            "ggg"      : { "default" : False, "param_type" : PARAM_TYPE_BOOL },
+            "lll"      : { "default" : "a,b",
+                           "param_type" : PARAM_TYPE_STR_LIST },
+            "ddd"      : { "default" : { 'baz' : 123 },
+                           "param_type" : PARAM_TYPE_STR_DICT },
+            "unset"    : { "default" : None },
+            "internal" : { "default" : "x", "conffile" : None },
+            "ignored"  : { "default" : "x", "ignore" : True }
+        }
+        for name, spec in param_dict.items():
+            spec["cmd_line"] = ( None, name )
+        fname = os.path.join(self.dir_one_name, "written.conf")
+        os.environ["WRITETEST_BAZ"] = "42"
+        try:
+            conf = Conf(param_dict, default_env_prefix="WRITETEST_",
+                        default_allow_unset_values=True)
+            conf.acquire([ "--foo", "from: the command line" ])
+        finally:
+            del os.environ["WRITETEST_BAZ"]
+        conf.set("ratio", 1.0/3)
+        conf.set("timeout", "1h 30m")
+        conf.set("size", "1.5kB")
+        conf.set("ggg", "yes")
+        conf.set("lll", "x y,z")
+        conf.set("ddd", "{ baz : 1 ; a : b, c }")
+        parsers = {
+            CONF_FORMAT_DEFAULT : Conf._parse_default_format_config_file,
+            CONF_FORMAT_JSON    : Conf._parse_json_format_config_file,
+            CONF_FORMAT_YAML    : Conf._parse_yml_format_config_file }
+
+        for fmt in [ CONF_FORMAT_DEFAULT, CONF_FORMAT_JSON, CONF_FORMAT_YAML ]:
+            for annotate in [ False, True ]:
+                if annotate and fmt == CONF_FORMAT_JSON:
+                    continue
+                with conf.override(baz=7):
+                    with open(fname, "w") as f:
+                        conf.write(f, format=fmt, annotate=annotate)
+                    expected = conf.items()
+                other = Conf(param_dict, default_allow_unset_values=True)
+                other.set("internal", "x")
+                with open(fname, "r") as f:
+                    parsers[fmt](other, f)
+                self.assertEqual(expected, other.items())
+                self.assertTrue(isinstance(other.get("ratio"), float))
+
+                # The format is also detected when reading the file back as
+                # acquire() does, even though default format lines with a
+                # dict or a ': ' in a value parse as YAML as well.
+                other = Conf(param_dict, default_allow_unset_values=True)
+                other.set("internal", "x")
+                with open(fname, "r") as f:
+                    other._parse_config_file(f)
+                self.assertEqual(expected, other.items())
+                self.assertEqual("from: the command line", other.get("foo"))
+                self.assertEqual({ "baz" : "1", "a" : [ "b", "c" ] },
+                                 other.get("ddd"))
+
+        # Written on their own, such lines form a valid YAML mapping.
+        small = { "ddd" : param_dict["ddd"], "foo" : param_dict["foo"] }
+        small_conf = Conf(small)
+        small_conf.set("ddd", "{ a : 1 }")
+        small_conf.set("foo", "a: b")
+        small_fname = os.path.join(self.dir_one_name, "small.conf")
+        with open(small_fname, "w") as f:
+            small_conf.write(f)
+        other = Conf(small)
+        with open(small_fname, "r") as f:
+            other._parse_config_file(f)
+        os.unlink(small_fname)
+        self.assertEqual({ "ddd" : { "a" : "1" }, "foo" : "a: b" },
+                         other.items())
+
+        with open(fname, "r") as f:
+            text = f.read()
+        self.assertTrue('"FOO": "from: the command line"    # command line'
+                        in text)
+        self.assertTrue('"BAZ": 7    # override' in text)
+        self.assertTrue('"GGG": true    # set' in text)
+        self.assertTrue('"TIMEOUT": "90m"    # set' in text)
+        self.assertFalse("UNSET" in text or "IGNORED" in text or
+                         "INTERNAL" in text)
+        conf.set("timeout", "30s")
+        with open(fname, "w") as f:
+            conf.write(f, annotate=True)
+        with open(fname, "r") as f:
+            lines = f.read().split("\n")
+        self.assertTrue("TIMEOUT 30s    # default" in lines)
+        self.assertTrue("BAZ 42    # environment variable WRITETEST_BAZ"
+                        in lines)
+        self.assertTrue("LLL x y,z    # set" in lines)
+        self.assertTrue("DDD { a : b,c ; baz : 1 }    # set" in lines)
+
+        # The default format cannot hold every value. Defaults that can't
+        # be written are left out.
+        conf.set("ddd", { "baz" : 123 })
+        conf.set("foo", "a # b")
+        devnull = open(os.devnull, "w")
+        try:
+            self.assertRaisesRegexp(ParamError, "Parameter 'foo': Value "
+                                    "cannot be written in default format.",
+                                    conf.write, devnull)
+            conf.set("foo", "a,")
+            self.assertRaises(ParamError, conf.write, devnull)
+            self.assertRaisesRegexp(ParamError, "Unknown format 'xml'.",
+                                    conf.write, devnull, format="xml")
+            self.assertRaisesRegexp(ParamError, "cannot be annotated",
+                                    conf.write, devnull,
+                                    format=CONF_FORMAT_JSON, annotate=True)
+        finally:
+            devnull.close()
+        with open(fname, "w") as f:
+            conf.write(f, format=CONF_FORMAT_JSON)
+        with open(fname, "r") as f:
+            self.assertEqual("a,", json.load(f)["FOO"])
+
+    def test_conf_metrics(self):
+        """
+        Testing the access metrics.
+
+        """
+        now     = [ 100.0 ]
+        exports = []
+        conf    = Conf(self.sample_param_dict,
+                       default_allow_unset_values=True)
+        get     = conf.get
+        metrics = conf.enable_metrics(sample_every=2, export=exports.append,
+                                      export_interval=10,
+                                      clock=lambda: now[0])
+        self.assertTrue(conf.metrics is metrics)
+        conf.get("foo")
+        now[0] = 105.0
+        conf.get("foo")
+        conf.get_by_conffile_name("BAZ")
+        conf.acquire([])
+        self.assertRaises(ParamError, conf.get, "unknown")
+        report = metrics.report()
+        self.assertEqual([ "baz", "foo" ], sorted(report))
+        self.assertEqual(2, report["foo"].count)
+        self.assertEqual(105.0, report["foo"].last_read)
+        # Only the second read was sampled.
+        site = list(report["foo"].call_sites.items())
+        self.assertEqual(1, len(site))
+        self.assertEqual(( __file__.rstrip("c"), "test_conf_metrics" ),
+                         ( site[0][0][0].rstrip("c"), site[0][0][2] ))
+        self.assertEqual([ "configfile", "ddd", "ggg" ],
+                         metrics.unread(conf.keys()))
+        self.assertEqual(0, metrics.report([ "ddd" ])["ddd"].count)
+        self.assertEqual([], exports)
+
+        now[0] = 110.0
+        conf.items()
+        self.assertEqual(1, len(exports))
+        self.assertEqual(3, exports[0]["foo"].count)
+        self.assertEqual([], metrics.unread(conf.keys()))
+
+        # Disabled, the original methods are used.
+        conf.disable_metrics()
+        self.assertTrue(conf.metrics is None)
+        self.assertEqual(get, conf.get)
+        conf.get("foo")
+        self.assertEqual(3, metrics.report()["foo"].count)
+        metrics.reset()
+        self.assertEqual({}, metrics.report())
+
+    def test_conf_override(self):
+        """
+        Testing context-local override layers.
+
+        """
+        conf = Conf(self.sample_param_dict)
+        calls = []
+        conf.subscribe("baz", calls.append)
+
+        with conf.override(baz="12"):
+            self.assertEqual(12, conf.get("baz"))
+            with conf.override({ "baz" : 13, "foo" : "foobar" }):
+                self.assertEqual(13, conf.get("baz"))
+                self.assertEqual("foobar",
+                                 conf.get_by_conffile_name("MY_PARAM"))
+                self.assertEqual(13, conf.items()["baz"])
+            self.assertEqual(12, conf.get("baz"))
+            self.assertEqual("some-value", conf.items()["foo"])
+
+            # Other threads don't see the override
+            seen = []
+            t = threading.Thread(target=lambda: seen.append(conf.get("baz")))
+            t.start()
+            t.join()
+            self.assertEqual([ 123 ], seen)
+
+            # Changes to the base value are hidden by the override
+            conf.set("baz", 50)
+            self.assertEqual(12, conf.get("baz"))
+
+        self.assertEqual(50, conf.get("baz"))
+        self.assertEqual(0, conf._num_override_layers)
+        self.assertEqual([ { "baz" : ( 123, 50 ) } ], calls)
+
+        self.assertRaisesRegexp(ParamError,
+                                "Parameter 'baz': '1234' is not in the "
+                                "allowed range.",
+                                conf.override, baz=1234)
+        self.assertRaisesRegexp(ParamError, "Parameter 'xyz': Unknown",
+                                conf.override, xyz=1)
+
+        # Each context (as used by asyncio tasks) has its own layers
+        try:
+            import contextvars
+        except ImportError:
+            return
+        def in_context(value):
+            with conf.override(baz=value):
+                return conf.get("baz"), conf.items()["baz"]
+        with conf.override(baz=12):
+            self.assertEqual(( 13, 13 ),
+                             contextvars.copy_context().run(in_context, 13))
+            self.assertEqual(12, conf.get("baz"))
+
+    def test_conf_freeze_for_fork(self):
+        """
+        Testing a configuration that is frozen for forked workers.
+
+        """
+        conf = Conf(dict(self.sample_param_dict,
+                         lll={ "default" : "a,b",
+                               "param_type" : PARAM_TYPE_STR_LIST },
+                         iii={ "default" : "x", "ignore" : True }),
+                    default_allow_unset_values=True)
+        conf.set("baz", 12)
+        metrics = conf.enable_metrics()
+        conf.freeze_for_fork(freeze_gc=False)
+        self.assertEqual(12, conf.get("baz"))
+        self.assertEqual(( "a", "b" ), conf.get("lll"))
+        self.assertEqual("some-value", conf.get_by_conffile_name("MY_PARAM"))
+        self.assertEqual(12, conf.items()["baz"])
+        self.assertEqual(2, metrics.report()["baz"].count)
+        self.assertRaises(ParamIgnored, conf.get, "iii")
+        self.assertRaisesRegexp(ParamError, "Unknown parameter",
+                                conf.get, "xyz")
+        # Reading by conffile name doesn't look at the parameters anymore.
+        conf.params_by_conffile_name = None
+        self.assertEqual(12, conf.get_by_conffile_name("BAZ"))
+        self.assertEqual(3, metrics.report()["baz"].count)
+        self.assertRaises(ParamIgnored, conf.get_by_conffile_name, "III")
+        self.assertRaisesRegexp(ParamError, "Unknown parameter",
+                                conf.get_by_conffile_name, "XYZ")
+        for func, args in [ (conf.set, ( "baz", 13 )),
+                            (conf.acquire, ( [], )),
+                            (conf.override, ( { "baz" : 13 }, )),
+                            (conf.add, ( "new", )) ]:
+            self.assertRaisesRegexp(ParamError, "Frozen for fork",
+                                    func, *args)
+        # The frozen read path remains when metrics are disabled.
+        conf.disable_metrics()
+        self.assertEqual(( "a", "b" ), conf.get("lll"))
+        self.assertEqual(3, metrics.report()["baz"].count)
+
+        # Reading every parameter of a large configuration in a forked
+        # worker: Frozen, far fewer shared pages become private.
+        if not hasattr(os, "fork") or _private_dirty_kb() is None:
+            return
+        param_dict = dict([ ("p%d" % i, { "default"  : "value-%d" % i,
+                                          "cmd_line" : None })
+                            for i in range(20000) ])
+        names  = sorted(param_dict)
+        plain  = _dirtied_by_forked_reads(Conf(param_dict), names)
+        frozen = Conf(param_dict)
+        frozen.freeze_for_fork()
+        try:
+            self.assertTrue(_dirtied_by_forked_reads(frozen, names) * 1.5
+                            < plain)
+        finally:
+            if hasattr(gc, "unfreeze"):
+                gc.unfreeze()
+
+    def test_conf_feature_flag(self):
+        """
+        Testing feature flag parameters.
+
+        """
+        conf = Conf({ "new-ui" : { "default" : "10%",
+                                   "param_type" : PARAM_TYPE_FLAG },
+                      "baz"    : { "default" : 1,
+                                   "param_type" : PARAM_TYPE_INT } })
+        keys = range(1000)
+        self.assertEqual(Rollout(10), conf.get("new-ui"))
+        self.assertTrue(70 < len([ k for k in keys
+                                        if conf.enabled("new-ui", k) ]) < 130)
+        conf.acquire([ "--new-ui", "{ percent : 0 ; allow : 7 }" ])
+        self.assertEqual([ 7 ], [ k for k in keys
+                                        if conf.enabled("new-ui", k) ])
+        with conf.override({ "new-ui" : "on" }):
+            self.assertTrue(conf.enabled("new-ui", 8))
+        self.assertFalse(conf.enabled("new-ui", 8))
+        self.assertRaisesRegexp(ParamError,
+                                "Parameter 'new-ui': Rollout percentage "
+                                "150% is not between 0 and 100.",
+                                conf.set, "new-ui", "150%")
+        self.assertRaisesRegexp(ParamError, "Parameter 'baz': Not a feature",
+                                conf.enabled, "baz", 8)
+        self.assertRaisesRegexp(ParamError, "Allowed values or range not "
+                                            "allowed for type 'flag'",
+                                Conf, { "f" : {
+                                        "default"        : "on",
+                                        "param_type"     : PARAM_TYPE_FLAG,
+                                        "allowed_values" : [ "on" ] } })
+
+        # Flags are written in a form that reads back the same.
+        fname = os.path.join(self.dir_one_name, "flags.conf")
+        with open(fname, "w") as f:
+            conf.write(f)
+        other = Conf({ "new-ui" : { "default" : "off",
+                                    "param_type" : PARAM_TYPE_FLAG },
+                       "baz"    : { "default" : 1,
+                                    "param_type" : PARAM_TYPE_INT } })
+        with open(fname) as f:
+            other._parse_config_file(f)
+        self.assertEqual(conf.get("new-ui"), other.get("new-ui"))
+
     def test_conf_acquire(self):
         """
         Testing full run of acquire, using defaults, config files, environment
@@ -729,6 +2042,785 @@ class ConfigClassTests(unittest.TestCase):
         conf.acquire([ "-f", "some-value" ])
         self.assertEqual("some-value", conf.get('foo'))
 
+    def test_conf_acquire_transaction(self):
+        """
+        Testing that a failed acquire leaves the configuration unchanged.
+
+        """
+        fname = self._make_file("""
+        MY_PARAM foobar
+        """)
+        conf = Conf(self.sample_param_dict,
+                    default_conf_file_locations=[self.dir_two_name],
+                    default_env_prefix="TXTEST_",
+                    conf_file_parameter="configfile")
+        calls = []
+        conf.subscribe([ "foo", "baz", "ggg" ], calls.append)
+        conf.set("baz", 12)
+        conf.acquire([ "-g" ])
+        self.assertEqual(fname, conf.config_file)
+        del calls[:]
+        before = conf.items()
+
+        # The environment and the first option would change values, the last
+        # option fails. So does a missing config file.
+        os.environ["TXTEST_BAZ"] = "50"
+        try:
+            self.assertRaisesRegexp(ParamError, "Parameter 'baz': '500' is "
+                                    "not in the allowed range",
+                                    conf.acquire,
+                                    [ "--configfile", fname,
+                                      "-f", "xyz baz", "--baz", "500" ])
+            self.assertRaises(IOError, conf.acquire,
+                              [ "--configfile", "/nonexistent" ])
+        finally:
+            del os.environ["TXTEST_BAZ"]
+        self.assertEqual(before, conf.items())
+        self.assertEqual(fname, conf.config_file)
+        self.assertEqual([], calls)
+
+        # A missing value is detected before anything is changed, too.
+        conf._reset_values()
+        self.assertRaisesRegexp(ParamError, "Parameter 'ggg': Requires a "
+                                "value", conf.acquire, [ "-f", "xyz baz" ])
+        self.assertEqual("some-value", conf.get("foo"))
+
+        # Reload on SIGHUP, which keeps the old values if it fails.
+        if not hasattr(signal, "SIGHUP"):
+            return
+        reloaded = []
+        failed   = []
+        threads  = []
+        def on_reload(c):
+            threads.append(threading.current_thread())
+            reloaded.append(c)
+        previous = conf.reload_on_sighup([ "-g" ], on_reload=on_reload,
+                                         on_error=failed.append)
+        try:
+            def hup():
+                num = len(reloaded) + len(failed)
+                os.kill(os.getpid(), signal.SIGHUP)
+                for _ in range(500):
+                    if len(reloaded) + len(failed) > num:
+                        break
+                    time.sleep(0.01)
+            os.environ["TXTEST_BAZ"] = "60"
+            hup()
+            self.assertEqual([ conf ], reloaded)
+            self.assertEqual(( "foobar", 60, True ),
+                             ( conf.get("foo"), conf.get("baz"),
+                               conf.get("ggg") ))
+            # The reload runs outside of the signal handler.
+            self.assertFalse(threads[0] is threading.current_thread())
+            os.environ["TXTEST_BAZ"] = "600"
+            hup()
+            self.assertEqual(1, len(failed))
+            self.assertTrue("'600' is not in the allowed range" in
+                                                            str(failed[0]))
+            self.assertEqual(60, conf.get("baz"))
+
+            # A signal that interrupts a writer doesn't reload in the
+            # middle of it, the reload follows afterwards.
+            os.environ["TXTEST_BAZ"] = "70"
+            with conf._write_lock:
+                os.kill(os.getpid(), signal.SIGHUP)
+                time.sleep(0.1)
+                self.assertEqual(1, len(reloaded))
+                self.assertEqual(60, conf.get("baz"))
+            for _ in range(500):
+                if len(reloaded) > 1:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(70, conf.get("baz"))
+
+            # Another call replaces the reload thread.
+            conf.reload_on_sighup([ "-g" ], on_reload=on_reload)
+            hup()
+            self.assertEqual(3, len(reloaded))
+            self.assertEqual(1, len(failed))
+        finally:
+            del os.environ["TXTEST_BAZ"]
+            signal.signal(signal.SIGHUP, previous)
+
+
+
+_worker_shared_conf = None
+
+def _init_shared_conf_worker(shared):
+    global _worker_shared_conf
+    _worker_shared_conf = shared
+
+def _read_shared_conf(name):
+    return _worker_shared_conf.version(), _worker_shared_conf.get(name)
+
+def _shared_conf_access():
+    # Return whether the worker's segment is writable, and whether its
+    # mapping really accepts writes.
+    try:
+        _worker_shared_conf._mm[0:1] = b"P"
+        mapped_writable = True
+    except TypeError:
+        mapped_writable = False
+    return _worker_shared_conf.writable, mapped_writable
+
+
+class SharedConfTests(unittest.TestCase):
+    """
+    Tests for configuration snapshots shared with worker processes.
+
+    """
+    def _check_pool(self, pool_maker):
+        conf = Conf({ "foo"    : { "default" : "bar" },
+                      "baz"    : { "default" : 1,
+                                   "param_type" : PARAM_TYPE_INT },
+                      "new-ui" : { "default" : "{ percent:5 ; allow:bob }",
+                                   "param_type" : PARAM_TYPE_FLAG } })
+        shared = SharedConf.create(size=4096)
+        try:
+            self.assertEqual(1, shared.publish(conf))
+            pool = pool_maker(1, _init_shared_conf_worker, (shared,))
+            try:
+                self.assertEqual((1, "bar"),
+                                 pool.apply(_read_shared_conf, ("foo",)))
+                self.assertEqual((1, Rollout(5, [ "bob" ])),
+                                 pool.apply(_read_shared_conf, ("new-ui",)))
+                self.assertEqual((False, False),
+                                 pool.apply(_shared_conf_access))
+
+                # Updates in the parent are seen by the running worker.
+                conf.set("foo", "xyz")
+                conf.set("baz", 12)
+                self.assertEqual(2, shared.publish(conf))
+                self.assertEqual((2, "xyz"),
+                                 pool.apply(_read_shared_conf, ("foo",)))
+                self.assertEqual((2, 12),
+                                 pool.apply(_read_shared_conf, ("baz",)))
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            shared.unlink()
+
+    def test_shared_conf_fork(self):
+        """
+        Test workers that inherit the segment via fork.
+
+        """
+        self._check_pool(multiprocessing.Pool)
+
+    def test_shared_conf_spawn(self):
+        """
+        Test workers that attach to the segment after being spawned.
+
+        """
+        if not hasattr(multiprocessing, "get_context"):
+            self.skipTest("No spawn start method available.")
+        self._check_pool(multiprocessing.get_context("spawn").Pool)
+
+    def test_shared_conf_errors(self):
+        """
+        Test the read-only attachment and size checks.
+
+        """
+        conf = Conf({ "foo" : { "default" : "x"*100 } })
+        shared = SharedConf.create(size=50)
+        try:
+            self.assertRaisesRegexp(ParamError, "exceeds segment size",
+                                    shared.publish, conf)
+            reader = SharedConf.attach(shared.path)
+            metrics = reader.enable_metrics()
+            self.assertEqual(0, reader.version())
+            self.assertEqual({}, reader.items())
+            self.assertRaisesRegexp(ParamError, "attached read-only",
+                                    reader.publish, conf)
+            self.assertRaisesRegexp(ParamError, "Unknown parameter",
+                                    reader.get, "foo")
+            self.assertEqual([ "foo" ], metrics.unread([ "foo" ]))
+            reader.close()
+        finally:
+            shared.unlink()
+
+    def test_shared_conf_dead_writer(self):
+        """
+        Test that readers give up on a snapshot that is never finished.
+
+        """
+        conf = Conf({ "foo" : { "default" : "bar" } })
+        shared = SharedConf.create(size=4096)
+        old_timeout = pyparams.shared._WRITE_TIMEOUT
+        try:
+            shared.publish(conf)
+            reader = SharedConf.attach(shared.path)
+            # A writer that died in the middle of publishing leaves an odd
+            # sequence counter behind.
+            pyparams.shared._HEADER.pack_into(shared._mm, 0,
+                                              pyparams.shared._MAGIC, 3, 0)
+            pyparams.shared._WRITE_TIMEOUT = 0.05
+            self.assertRaisesRegexp(ParamError, "writer may have died",
+                                    reader.get, "foo")
+            reader.close()
+        finally:
+            pyparams.shared._WRITE_TIMEOUT = old_timeout
+            shared.unlink()
+
+
+class ConfDaemonTests(unittest.TestCase):
+    """
+    Tests for serving a configuration over a unix domain socket.
+
+    """
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        self.path     = os.path.join(self.dir_name, "conf.sock")
+        self.conf     = Conf({ "foo" : { "default" : "bar" },
+                               "baz" : { "default" : 1,
+                                         "param_type" : PARAM_TYPE_INT,
+                                         "allowed_range" : dict(min=1,
+                                                                max=10) } },
+                             default_env_prefix="DAEMONTEST_")
+        self.daemon   = ConfDaemon(self.conf, self.path, args=[ "-f", "x" ])
+        self.daemon.bind()
+        self.thread   = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        os.environ.pop("DAEMONTEST_FOO", None)
+        os.environ.pop("DAEMONTEST_BAZ", None)
+        self.daemon.shutdown()
+        self.thread.join(5)
+        shutil.rmtree(self.dir_name)
+
+    def test_daemon_snapshot_and_notifications(self):
+        """
+        Test fetching the configuration and receiving changes.
+
+        """
+        client = DaemonConf(self.path, timeout=5)
+        other  = DaemonConf(self.path, subscribe=False, timeout=5)
+        try:
+            self.assertEqual(1, client.version)
+            self.assertEqual("x", client.get("foo"))
+            self.assertEqual({ "foo" : "x", "baz" : 1 }, client.items())
+            self.assertFalse(client.poll())
+
+            # Reload without any changes doesn't produce a new version
+            self.assertFalse(self.daemon.reload())
+            self.assertFalse(client.poll())
+
+            os.environ["DAEMONTEST_BAZ"] = "5"
+            self.assertTrue(self.daemon.reload())
+            self.assertTrue(client.poll(timeout=5))
+            self.assertEqual(2, client.version)
+            self.assertEqual(5, client.get("baz"))
+
+            # Non-subscribed clients need to ask.
+            self.assertEqual(1, other.get("baz"))
+            other.refresh()
+            self.assertEqual(5, other.get("baz"))
+
+            # Reloads can be triggered by clients, errors are reported back.
+            os.environ["DAEMONTEST_BAZ"] = "7"
+            other.reload()
+            self.assertEqual(7, other.get("baz"))
+            self.assertTrue(client.poll(timeout=5))
+            self.assertEqual(7, client.get("baz"))
+
+            os.environ["DAEMONTEST_BAZ"] = "70"
+            self.assertRaisesRegexp(ParamError,
+                                    "'70' is not in the allowed range.",
+                                    other.reload)
+            self.assertRaisesRegexp(ParamError, "Unknown parameter.",
+                                    client.get, "xyz")
+        finally:
+            client.close()
+            other.close()
+
+    def test_daemon_failed_reload(self):
+        """
+        Test that a failed reload leaves the configuration unchanged.
+
+        """
+        os.environ["DAEMONTEST_FOO"] = "from-env"
+        self.daemon.args = [ "--baz", "70" ]
+        self.assertRaisesRegexp(ParamError, "not in the allowed range",
+                                self.daemon.reload)
+        self.assertEqual({ "foo" : "x", "baz" : 1 }, self.conf.items())
+        self.assertEqual(1, self.daemon.version)
+
+    def test_daemon_slow_subscriber(self):
+        """
+        Test that a subscriber which doesn't read is dropped.
+
+        """
+        old_timeout = pyparams.daemon.SEND_TIMEOUT
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client = DaemonConf(self.path, timeout=5)
+        try:
+            stuck.connect(self.path)
+            pyparams.daemon._send_frame(stuck, pyparams.daemon.MSG_SUBSCRIBE)
+            self.assertEqual(pyparams.daemon.MSG_SNAPSHOT,
+                             pyparams.daemon._recv_frame(stuck)[0])
+
+            # A snapshot too large for the socket buffers.
+            pyparams.daemon.SEND_TIMEOUT = 0.2
+            self.daemon.args = []
+            os.environ["DAEMONTEST_FOO"] = "y" * 4*1024*1024
+            reloader = threading.Thread(target=self.daemon.reload)
+            reloader.start()
+            # The client which reads gets the snapshot...
+            self.assertTrue(client.poll(timeout=5))
+            self.assertEqual(4*1024*1024, len(client.get("foo")))
+            reloader.join(5)
+            self.assertFalse(reloader.is_alive())
+            # ... while the stuck one was disconnected.
+            self.assertEqual(1, len(self.daemon._subscribers))
+        finally:
+            pyparams.daemon.SEND_TIMEOUT = old_timeout
+            stuck.close()
+            client.close()
+
+    def test_daemon_feature_flag(self):
+        """
+        Test that feature flags are served, and that values which cannot be
+        encoded are reported as errors.
+
+        """
+        self.addCleanup(pyparams._param_types.pop, "int-set", None)
+        register_param_type(ParamType("int-set",
+                                      lambda v, p: frozenset(
+                                            [ int(i) for i in v.split(",") ])),
+                            replace=True)
+        path   = os.path.join(self.dir_name, "flags.sock")
+        conf   = Conf({ "new-ui" : { "default" : "5%",
+                                     "param_type" : PARAM_TYPE_FLAG },
+                        "ids"    : { "default" : None,
+                                     "param_type" : "int-set" } },
+                      default_allow_unset_values=True)
+        daemon = ConfDaemon(conf, path)
+        daemon.bind()
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = DaemonConf(path, timeout=5)
+        try:
+            self.assertEqual(Rollout(5), client.get("new-ui"))
+            daemon.args = [ "--new-ui", "{ percent : 10 ; allow : bob }" ]
+            client.reload()
+            self.assertEqual(Rollout(10, [ "bob" ]), client.get("new-ui"))
+            self.assertTrue(client.get("new-ui").enabled("bob"))
+
+            daemon.args = [ "--ids", "1,2" ]
+            self.assertRaisesRegexp(ParamError, "Cannot serialize snapshot",
+                                    daemon.reload)
+            self.assertRaisesRegexp(ParamError, "Cannot serialize snapshot",
+                                    client.reload)
+            # The connection is still served.
+            client.refresh()
+            self.assertEqual(2, client.version)
+        finally:
+            client.close()
+            daemon.shutdown()
+            thread.join(5)
+
+
+class _CountingSource(Source):
+    """
+    A custom source, which counts how often it is read.
+
+    """
+    def __init__(self, values):
+        self.values = values
+        self.reads  = 0
+
+    def token(self, conf, args):
+        return sorted(self.values.items())
+
+    def read(self, conf, args):
+        self.reads += 1
+        return self.values
+
+
+class _BlockingSource(Source):
+    """
+    A custom source, which blocks until it is released.
+
+    """
+    def __init__(self, values):
+        self.values   = values
+        self.started  = threading.Event()
+        self.released = threading.Event()
+
+    def read(self, conf, args):
+        self.started.set()
+        self.released.wait(5)
+        return self.values
+
+
+class SourceTests(unittest.TestCase):
+    """
+    Tests for acquiring values from a configured list of sources.
+
+    """
+    def setUp(self):
+        self.dir_name   = tempfile.mkdtemp()
+        self.param_dict = {
+            "configfile" : { "default"  : "s.conf",
+                             "conffile" : None },
+            "foo"        : { "default"  : "bar" },
+            "baz"        : { "default"  : 1,
+                             "param_type" : PARAM_TYPE_INT,
+                             "allowed_range" : dict(min=1, max=100) },
+            "lll"        : { "default"  : "a,b",
+                             "param_type" : PARAM_TYPE_STR_LIST } }
+
+    def tearDown(self):
+        os.environ.pop("SOURCETEST_BAZ", None)
+        shutil.rmtree(self.dir_name)
+
+    def test_sources_order_and_positional_args(self):
+        """
+        Test that later sources take precedence.
+
+        """
+        with open(os.path.join(self.dir_name, "s.conf"), "w") as f:
+            f.write("FOO xyz\nBAZ 10\n")
+        os.mkdir(os.path.join(self.dir_name, "conf.d"))
+        with open(os.path.join(self.dir_name, "conf.d", "20.json"), "w") as f:
+            f.write('{ "BAZ" : 30 }')
+        with open(os.path.join(self.dir_name, "conf.d", "10.conf"), "w") as f:
+            f.write("BAZ 20\nLLL x,y\n")
+        with open(os.path.join(self.dir_name, "conf.d", ".x.conf"), "w") as f:
+            f.write("BAZ 1000\n")
+        os.environ["SOURCETEST_BAZ"] = "40"
+        conf = Conf(self.param_dict,
+                    conf_file_parameter="configfile",
+                    default_conf_file_locations=[ self.dir_name ],
+                    default_env_prefix="SOURCETEST_",
+                    sources=[ ConfigFileSource(),
+                              DirectorySource(os.path.join(self.dir_name,
+                                                           "conf.d")),
+                              EnvSource(),
+                              DictSource({ "LLL" : "p,q" },
+                                         by_conffile_name=True),
+                              ArgvSource() ])
+        self.assertEqual([ "pos" ], conf.acquire([ "--baz", "50", "pos" ]))
+        self.assertEqual({ "configfile" : "s.conf", "foo" : "xyz",
+                           "baz" : 50, "lll" : [ "p", "q" ] }, conf.items())
+        files = [ os.path.join(self.dir_name, "s.conf"),
+                  os.path.join(self.dir_name, "conf.d", "10.conf"),
+                  os.path.join(self.dir_name, "conf.d", "20.json") ]
+        self.assertEqual(files, conf.config_files)
+        self.assertEqual(files[2], conf.config_file)
+        self.assertEqual([ "pos", "x" ], conf.acquire([ "pos", "x" ]))
+        # Also for sources that were not loaded again
+        self.assertEqual(files, conf.config_files)
+        self.assertEqual(40, conf.get("baz"))
+        del os.environ["SOURCETEST_BAZ"]
+        conf.acquire([])
+        self.assertEqual(30, conf.get("baz"))
+
+        # Values that are set outside of the sources are replaced.
+        conf.set("foo", "other")
+        conf.acquire([])
+        self.assertEqual("xyz", conf.get("foo"))
+
+        # Errors of a source are raised.
+        conf.sources.append(DictSource({ "baz" : 1000 }))
+        self.assertRaisesRegexp(ParamError,
+                                "'1000' is not in the allowed range.",
+                                conf.acquire, [])
+
+    def test_sources_change_tokens(self):
+        """
+        Test that unchanged sources are not read again.
+
+        """
+        fname    = os.path.join(self.dir_name, "f.conf")
+        counting = _CountingSource({ "foo" : "counted" })
+        changes  = []
+        with open(fname, "w") as f:
+            f.write("BAZ 10\n")
+        conf = Conf(self.param_dict,
+                    sources=[ FileSource(fname), Source(), counting ])
+        conf.subscribe([ "baz" ], changes.append)
+        conf.acquire([])
+        self.assertEqual(1, counting.reads)
+        self.assertEqual(10, conf.get("baz"))
+        self.assertEqual("counted", conf.get("foo"))
+        self.assertEqual(1, len(changes))
+
+        conf.acquire([])
+        self.assertEqual(1, counting.reads)
+        self.assertEqual(10, conf.get("baz"))
+        self.assertEqual("counted", conf.get("foo"))
+        self.assertEqual(1, len(changes))
+
+        counting.values = { "foo" : "again" }
+        with open(fname, "w") as f:
+            f.write("BAZ 20 # longer\n")
+        conf.acquire([])
+        self.assertEqual(2, counting.reads)
+        self.assertEqual(20, conf.get("baz"))
+        self.assertEqual("again", conf.get("foo"))
+        self.assertEqual(2, len(changes))
+
+        # A source without a token is read every time, a missing file has no
+        # values.
+        os.unlink(fname)
+        counting.token = lambda conf, args: None
+        conf.acquire([])
+        conf.acquire([])
+        self.assertEqual(4, counting.reads)
+        self.assertEqual(1, conf.get("baz"))
+        self.assertEqual(3, len(changes))
+        self.assertEqual(None, conf.config_file)
+        self.assertEqual([], conf.config_files)
+        self.assertEqual([ fname ], conf.config_files_tried)
+
+    def test_sources_concurrent_writers(self):
+        """
+        Test that values set while acquire() runs are not undone by it.
+
+        """
+        blocking = _BlockingSource({ "foo" : "from-source" })
+        conf     = Conf(self.param_dict, sources=[ blocking ])
+        changes  = []
+        conf.subscribe([ "foo", "baz", "lll" ], changes.append)
+        acquirer = threading.Thread(target=conf.acquire, args=([],))
+        acquirer.start()
+        self.assertTrue(blocking.started.wait(5))
+        # Other writers wait for acquire() to commit its values...
+        setter = threading.Thread(target=conf.set, args=("baz", 5))
+        batch  = threading.Thread(target=conf._apply_batch,
+                                  args=([ ( conf.params["lll"], [ "x" ],
+                                            None ) ],))
+        setter.start()
+        batch.start()
+        setter.join(0.2)
+        self.assertTrue(setter.is_alive())
+        self.assertTrue(batch.is_alive())
+        blocking.released.set()
+        for t in [ acquirer, setter, batch ]:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+        # ... and are then applied on top of them.
+        self.assertEqual(( "from-source", 5, [ "x" ] ),
+                         ( conf.get("foo"), conf.get("baz"),
+                           conf.get("lll") ))
+        self.assertEqual(3, len(changes))
+
+
+class CommandLineToolTests(unittest.TestCase):
+    """
+    Tests for the 'python -m pyparams' commands.
+
+    """
+    SCHEMA = """
+import pyparams
+CONF = pyparams.Conf({
+    "foo" : { "default" : "a", "allowed_values" : [ "a", "b" ] },
+    "baz" : { "default" : None, "param_type" : pyparams.PARAM_TYPE_INT },
+})
+"""
+
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        with open(os.path.join(self.dir_name, "pyparams_test_schema.py"),
+                  "w") as f:
+            f.write(self.SCHEMA)
+        sys.path.insert(0, self.dir_name)
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.path.join(self.dir_name, "out.txt"),
+                                       "w+")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        sys.path.remove(self.dir_name)
+        shutil.rmtree(self.dir_name)
+
+    def _output(self):
+        sys.stdout.seek(0)
+        return sys.stdout.read()
+
+    def _make_file(self, name, buf):
+        fname = os.path.join(self.dir_name, name)
+        with open(fname, "w") as f:
+            f.write(buf)
+        return fname
+
+    def test_validate(self):
+        """
+        Test validating config files on a process pool.
+
+        """
+        good = [ self._make_file("good%d.conf" % i, "FOO b\nBAZ %d\n" % i)
+                 for i in range(10) ]
+        bad  = self._make_file("bad.conf", "FOO c\nXYZ 1\n\nBAZ x\n")
+        missing = self._make_file("missing.conf", "FOO a\n")
+        report  = os.path.join(self.dir_name, "report.json")
+
+        self.assertEqual(0, pyparams_main.main(
+                [ "validate", "-j", "2", "pyparams_test_schema" ] + good))
+        self.assertTrue("10 file(s) checked, 0 with errors." in self._output())
+
+        self.assertEqual(1, pyparams_main.main(
+                [ "validate", "-j", "2", "--json", report,
+                  "pyparams_test_schema:CONF", bad, missing ] + good))
+        out = self._output()
+        self.assertTrue("%s:1: Parameter 'foo': 'c' is not one of the "
+                        "allowed values." % bad in out)
+        self.assertTrue("%s:2: Unknown parameter 'XYZ'." % bad in out)
+        self.assertTrue("%s:4: Parameter 'baz': Cannot convert 'x' to type "
+                        "'integer'." % bad in out)
+        self.assertTrue("%s: Parameter 'baz': Requires a value" % missing
+                        in out)
+        with open(report) as f:
+            doc = json.load(f)
+        self.assertEqual(12, doc["files"])
+        self.assertEqual(2, doc["failed"])
+        self.assertEqual([ 1, 2, 4, None ],
+                         [ e["line"] for e in doc["errors"] ])
+
+        # Unknown parameters and unset values can be allowed.
+        self.assertEqual(0, pyparams_main.main(
+                [ "validate", "-j", "1", "--allow-unknown", "--allow-unset",
+                  "pyparams_test_schema", missing,
+                  self._make_file("unknown.conf", "XYZ 1\n") ]))
+
+        self.assertEqual(1, pyparams_main.main(
+                [ "validate", "pyparams_test_schema:FOO", missing ]))
+
+    CODEGEN_SCHEMA = """
+import pyparams
+CONF = pyparams.Conf({
+    "configfile" : { "default" : "pyparams_codegen.conf",
+                     "conffile" : None },
+    "foo" : { "default" : "a", "allowed_values" : [ "a", "b" ] },
+    "baz" : { "default" : None, "param_type" : pyparams.PARAM_TYPE_INT,
+              "allowed_range" : { "min" : 1, "max" : 100 } },
+    "lst" : { "default" : "x,y", "param_type" : pyparams.PARAM_TYPE_STR_LIST,
+              "allowed_values" : [ "x", "y", "z" ],
+              "cmd_line" : ( "l", "list" ) },
+    "dct" : { "default" : "{a:1}", "param_type" : pyparams.PARAM_TYPE_STR_DICT,
+              "allowed_keys" : [ "a", "b" ], "mandatory_keys" : [ "a" ],
+              "default_key" : "a" },
+    "timeout" : { "default" : "30s",
+                  "param_type" : pyparams.PARAM_TYPE_DURATION,
+                  "allowed_range" : { "min" : "1s", "max" : "1h" } },
+    "size" : { "default" : "1KiB", "param_type" : pyparams.PARAM_TYPE_BYTES },
+    "verbose" : { "default" : False, "param_type" : pyparams.PARAM_TYPE_BOOL },
+    "new-ui" : { "default" : "5%", "param_type" : pyparams.PARAM_TYPE_FLAG,
+                 "cmd_line" : ( None, "new-ui" ) },
+    "ign" : { "default" : "q", "ignore" : True },
+    "opt-x" : { "default" : pyparams.IGNORE_IF_NOT_SPECIFIED,
+                "cmd_line" : None },
+}, conf_file_parameter="configfile", default_env_prefix="CGTEST_")
+"""
+
+    def test_profile(self):
+        """
+        Test measuring the startup of a schema in a child process.
+
+        """
+        stacks = os.path.join(self.dir_name, "stacks.txt")
+        self.assertEqual(0, pyparams_main.main(
+                [ "profile", "-r", "2", "--stacks", stacks,
+                  "pyparams_test_schema", "--", "--baz", "3", "pos" ]))
+        out = self._output()
+        for stage in [ "import pyparams ", "import pyparams_test_schema ",
+                       "  building Conf ", "acquire() ", "  config file ",
+                       "  environment ", "  command line ", "total " ]:
+            self.assertTrue("\n" + stage in out, stage)
+        with open(stacks) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(re.match(r"^[^ ;][^;]*(;[^;]+)* \d+$", line),
+                            line)
+        roots = set([ line.split(";")[0] for line in lines ])
+        self.assertTrue("import pyparams" in roots)
+        self.assertTrue("acquire()" in roots)
+
+        # Errors of a stage are reported in its place.
+        self.assertEqual(0, pyparams_main.main(
+                [ "profile", "-r", "1", "pyparams_test_schema",
+                  "--", "--baz", "x" ]))
+        self.assertTrue("Cannot convert 'x' to type 'integer'." in
+                                                            self._output())
+        self.assertEqual(0, pyparams_main.main(
+                [ "profile", "-r", "1", "pyparams_test_schema:FOO" ]))
+        self.assertTrue("Not a Conf object." in self._output())
+
+    def test_codegen(self):
+        """
+        Test that a generated configuration module loads the same values,
+        and raises the same errors, as acquire().
+
+        """
+        self._make_file("pyparams_codegen_schema.py", self.CODEGEN_SCHEMA)
+        fname = os.path.join(self.dir_name, "pyparams_codegen_config.py")
+        self.assertEqual(0, pyparams_main.main(
+                [ "codegen", "-o", fname, "pyparams_codegen_schema" ]))
+        import pyparams_codegen_config as generated
+        conf = pyparams_main.load_conf("pyparams_codegen_schema")
+
+        files = [ self._make_file(name, buf) for name, buf in [
+            ("good.conf",  "FOO b\nBAZ 5\nDCT {a:1;\n b:2,3}\n"),
+            ("bad.conf",   "FOO b\n\nBAZ 500\n"),
+            ("unk.conf",   "XYZ 1\n"),
+            ("good.json",  '{ "BAZ" : 7, "DCT" : { "a" : "q" }, '
+                           '"VERBOSE" : true, "IGN" : 3 }'),
+            ("bad.json",   '{\n "BAZ" : 7,\n "FOO" : "c"\n}') ] ]
+        cases = [ [], [ "-b", "3", "pos" ], [ "--ba=3", "-vf", "b" ],
+                  [ "-b", "x" ], [ "--x" ], [ "-b" ], [ "--verbose=1" ],
+                  [ "-b1", "-l", "x,q" ], [ "-b1", "-d", "{c:1}" ],
+                  [ "-b1", "-d", "{b:1}" ], [ "-b1", "-t", "2h" ],
+                  [ "-b1", "-i", "zz", "-s", "2MiB", "--", "-f" ],
+                  [ "-b1", "--new-ui", "{ percent:5 ; allow:a }" ],
+                  [ "-b1", "--new-ui", "150%" ] ] + \
+                [ [ "-c", fn ] for fn in files ] + \
+                [ [ "-c", os.path.join(self.dir_name, "missing.conf") ] ]
+        for env in [ {}, { "CGTEST_BAZ" : "8", "CGTEST_OPT_X" : "zz" },
+                     { "CGTEST_BAZ" : "800" } ]:
+            os.environ.update(env)
+            try:
+                for argv in cases:
+                    conf._reset_values()
+                    try:
+                        args     = conf.acquire(argv)
+                        expected = ( conf.items(), args )
+                    except (ParamError, IOError) as e:
+                        expected = ( type(e), str(e) )
+                    try:
+                        config, args = generated.load(argv)
+                        result       = ( config._asdict(), args )
+                    except (ParamError, IOError) as e:
+                        result       = ( type(e), str(e) )
+                    self.assertEqual(expected, result)
+            finally:
+                for name in env:
+                    del os.environ[name]
+
+        config, args = generated.load([ "-b", "1", "x" ],
+                                      environ={ "CGTEST_FOO" : "b" })
+        self.assertEqual(( 1, "b", 30.0, [ "x" ] ),
+                         ( config.baz, config.foo, config.timeout, args ))
+        self.assertRaises(AttributeError, setattr, config, "ign", 1)
+
+        # Schemas that cannot be turned into code.
+        self.assertRaises(ParamError, codegen.generate,
+                          Conf({ "foo" : { "default" : "a" } },
+                               sources=[]))
+        self.assertRaises(ParamError, codegen.generate,
+                          Conf({ "f-o" : { "default" : "a",
+                                           "conffile" : None },
+                                 "f_o" : { "default" : "a",
+                                           "cmd_line" : None } }))
+        del sys.modules["pyparams_codegen_config"]
+        del sys.modules["pyparams_codegen_schema"]
+
 
 if __name__ == "__main__":
     unittest.main()